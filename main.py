@@ -36,11 +36,11 @@ def start():
     # Load image
     original_image = load_image(config)
     # Get tile vectors
-    tiles = get_rhombi_by_division_and_scale(original_image.size, config)
-    # Slice image
-    slices = slice_and_place_images(original_image, tiles, config)
+    tiles = get_rhombi_by_division_and_scale(original_image.size, config, image=original_image)
+    # Slice image and measure tile colors
+    tile_colors = slice_and_place_images(original_image, tiles, config)
     # Replace slices with target
-    mosaic, color_mosaic = create_mosaic(slices, original_image.size, config)
+    mosaic, color_mosaic = create_mosaic(tiles, tile_colors, original_image.size, config)
     # Save result
     if save_mosaic(mosaic, color_mosaic, config):
         print(f'Finished. Mosaics saved to {config["output_path"]}.')
@@ -3,6 +3,11 @@ __all__ = [
     'create_tiles',
     'replace_slices', 
     'utils',
+    'caches',
+    'pyramids',
+    'image_pool',
+    'matching',
+    'assignment',
     'update_database',
     'database_visualize',
     'gradio_ui',
@@ -11,6 +16,11 @@ __all__ = [
 # Convenience imports (adjust as per actual use-cases)
 from .create_tiles import *
 from .utils import *
+from .pyramids import *
+from .image_pool import *
+from .caches import *
+from .matching import *
+from .assignment import *
 from .replace_slices import *
 from .update_database import *
 from .database_visualize import *
@@ -0,0 +1,136 @@
+from typing import Tuple
+import numpy as np
+from .utils import *
+from .create_tiles import find_tile_adjacency
+
+def unique_sorted(values: np.ndarray) -> np.ndarray:
+    """
+    Sort integers and drop the repeated ones, faster than np.unique for large arrays of pair keys.
+
+    Parameters:
+    values (np.ndarray): The integers.
+
+    Returns:
+    np.ndarray: The distinct integers, sorted.
+    """
+    values = np.sort(values)
+    return values[np.concatenate(([True], values[1:] != values[:-1]))] if len(values) else values
+
+def expand_neighborhoods(indptr: np.ndarray, indices: np.ndarray, distance: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the tiles within a number of edge steps of every tile.
+
+    Parameters:
+    indptr (np.ndarray): The adjacency offsets, see find_tile_adjacency.
+    indices (np.ndarray): The adjacent tiles, see find_tile_adjacency.
+    distance (int): The largest number of steps.
+
+    Returns:
+    Tuple[np.ndarray, np.ndarray]: The neighborhoods in the same layout as the adjacency, without the tile itself.
+    """
+    tiles = len(indptr) - 1
+    degrees = np.diff(indptr)
+    # Pairs are encoded as source * tiles + target, so they can be deduplicated with a flat unique
+    sources = np.repeat(np.arange(tiles, dtype=np.int64), degrees)
+    pairs = sources * tiles + indices
+    reached = pairs
+    for _ in range(distance - 1):
+        # One more step from every reached pair, through the adjacency of its target
+        reached_sources, reached_targets = np.divmod(reached, tiles)
+        steps = degrees[reached_targets]
+        offsets = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+        next_targets = indices[np.repeat(indptr[reached_targets], steps) + offsets]
+        next_sources = np.repeat(reached_sources, steps)
+        keep = next_sources != next_targets
+        reached = unique_sorted(next_sources[keep] * tiles + next_targets[keep])
+        pairs = np.concatenate((pairs, reached))
+    neighborhood_sources, neighborhood_targets = np.divmod(unique_sorted(pairs), tiles)
+    neighborhood_indptr = np.concatenate(([0], np.cumsum(np.bincount(neighborhood_sources, minlength=tiles))))
+    return neighborhood_indptr, neighborhood_targets
+
+def assign_images(candidates: np.ndarray, distances: np.ndarray, neighborhoods: Tuple[np.ndarray, np.ndarray], assignment: np.ndarray, uses: np.ndarray, max_uses: int = 0, rng: np.random.Generator = None, rows: np.ndarray = None) -> None:
+    """
+    Assign images to the tiles that have none, using every image at most max_uses times and never an image that a
+    tile in the neighborhood already has. The (tile, candidate) pairs are taken greedily from the closest to the
+    farthest, with equally close pairs in random order, so it takes one sort and one pass.
+
+    Parameters:
+    candidates (np.ndarray): The candidate images (R, C) of the tiles, nearest first, -1 for no candidate.
+    distances (np.ndarray): The distances (R, C) of the candidates.
+    neighborhoods (Tuple[np.ndarray, np.ndarray]): The tiles that cannot share an image, see expand_neighborhoods.
+    assignment (np.ndarray): The image (M,) of every tile, -1 for none. Updated in place.
+    uses (np.ndarray): The number of tiles of every image. Updated in place.
+    max_uses (int): The largest number of tiles per image, 0 for no limit.
+    rng (np.random.Generator): The random generator used to break ties.
+    rows (np.ndarray): The tile (R,) of every row of candidates, all the tiles in order if not given.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    rows = rows if rows is not None else np.arange(len(candidates))
+    count = candidates.shape[1]
+    order = np.lexsort((rng.random(candidates.size), distances.ravel()))
+    pair_tiles = rows[order // count].tolist()
+    pair_images = candidates.ravel()[order].tolist()
+    indptr, indices = neighborhoods[0].tolist(), neighborhoods[1].tolist()
+    assigned = assignment.tolist()
+    used = uses.tolist()
+    limit = max_uses if max_uses > 0 else len(assigned)
+    for tile, image in zip(pair_tiles, pair_images):
+        if assigned[tile] >= 0 or image < 0 or used[image] >= limit:
+            continue
+        if any(assigned[neighbor] == image for neighbor in indices[indptr[tile]:indptr[tile + 1]]):
+            continue
+        assigned[tile] = image
+        used[image] += 1
+    assignment[:] = assigned
+    uses[:] = used
+
+def assign_tiles(tiles: Rhombi_array, tile_colors: Tile_colors, matcher, tile_classes: np.ndarray = None, max_uses: int = 0, neighbor_distance: int = 0, candidate_count: int = 16, rng: np.random.Generator = None, verbose: bool = False) -> np.ndarray:
+    """
+    Match every tile to an image, spreading the images out: each image is used at most max_uses times and
+    no two tiles within neighbor_distance edge steps get the same image. Every tile picks among its nearest
+    candidate_count images, and the tiles left without one try again with four times as many.
+
+    Parameters:
+    tiles (Rhombi_array): The tiles.
+    tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+    matcher (ColorMatcher): The matcher over the database, see create_matcher.
+    tile_classes (np.ndarray): The crop class of every tile, see CropColorMatcher.
+    max_uses (int): The largest number of tiles per image, 0 for no limit.
+    neighbor_distance (int): The tiles within this many edge steps get different images, 0 to allow neighbors to repeat.
+    candidate_count (int): The nearest images considered per tile in the first round.
+    rng (np.random.Generator): The random generator used to break ties.
+    verbose (bool): Print when the caps cannot be met.
+
+    Returns:
+    np.ndarray: The index (M,) of the image of every tile in matcher.names.
+    """
+    if max_uses <= 0 and neighbor_distance <= 0:
+        return matcher.match_tiles(tile_colors, rng, tile_classes)
+    image_count = len(matcher.names)
+    if verbose and max_uses > 0 and max_uses * image_count < len(tiles):
+        print(f'WARNING: {image_count} images used at most {max_uses} times cannot cover {len(tiles)} tiles, the remaining tiles get their nearest image')
+    if neighbor_distance > 0:
+        neighborhoods = expand_neighborhoods(*find_tile_adjacency(tiles), neighbor_distance)
+    else:
+        neighborhoods = (np.zeros(len(tiles) + 1, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    assignment = np.full(len(tiles), -1, dtype=np.int64)
+    uses = np.zeros(image_count, dtype=np.int64)
+    nearest = None
+    count = candidate_count
+    while True:
+        unassigned = np.flatnonzero(assignment < 0)
+        round_colors = tuple(None if values is None else values[unassigned] for values in tile_colors)
+        round_classes = None if tile_classes is None else tile_classes[unassigned]
+        candidates, distances = matcher.candidates(round_colors, count, round_classes)
+        if nearest is None:
+            nearest = candidates[:, 0].copy()
+        assign_images(candidates, distances, neighborhoods, assignment, uses, max_uses, rng, unassigned)
+        if np.all(assignment >= 0) or count >= image_count:
+            break
+        count *= 4
+    fallbacks = assignment < 0
+    if np.any(fallbacks):
+        if verbose:
+            print(f'{int(fallbacks.sum())} tiles had no candidate left and got their nearest image')
+        assignment[fallbacks] = nearest[fallbacks]
+    return assignment
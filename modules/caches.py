@@ -0,0 +1,209 @@
+from collections import OrderedDict
+from PIL import Image, ImageDraw
+from typing import Tuple
+import math, os, threading
+import numpy as np
+from .utils import *
+from .pyramids import choose_pyramid_level, get_pyramid_path, load_pyramid_level, read_pyramid_sizes
+from .image_pool import ImagePool
+
+# Half diagonals of a rhombus with unit edges, (long, short) for each shape code
+HALF_DIAGONALS = {
+    THIN: (math.cos(math.radians(18)), math.sin(math.radians(18))),
+    THICK: (math.cos(math.radians(36)), math.sin(math.radians(36))),
+}
+
+def rhombus_template_vertices(shape: int, orientation: int, edge: float) -> np.ndarray:
+    """
+    Get the vertices of the canonical rhombus of a shape, orientation and edge length, centered on 0.
+
+    Parameters:
+    shape (int): The shape code, THIN or THICK.
+    orientation (int): The orientation code, the long diagonal points at orientation * 18 degrees.
+    edge (float): The edge length.
+
+    Returns:
+    np.ndarray: The 4 vertices (complex).
+    """
+    long_half, short_half = HALF_DIAGONALS[shape]
+    axis = np.exp(1j * np.radians(orientation * 18))
+    return edge * np.array([long_half * axis, short_half * 1j * axis, -long_half * axis, -short_half * 1j * axis])
+
+def matches_rhombus_template(tiles: Rhombi_array, shapes: np.ndarray, orientations: np.ndarray, tolerance: float = 0.02) -> np.ndarray:
+    """
+    Tell which tiles are Penrose rhombi that their template describes, so their mask can be shared.
+
+    Parameters:
+    tiles (Rhombi_array): The tiles.
+    shapes (np.ndarray): The shape codes of the tiles, see classify_rhombi.
+    orientations (np.ndarray): The orientation codes of the tiles, see classify_rhombi.
+    tolerance (float): The largest vertex error allowed, relative to the edge length.
+
+    Returns:
+    np.ndarray: True (N,) for the tiles that match their template.
+    """
+    edges = np.abs(tiles - np.roll(tiles, 1, axis=1)).mean(axis=1)
+    long_half = np.where(shapes == THIN, HALF_DIAGONALS[THIN][0], HALF_DIAGONALS[THICK][0])
+    short_half = np.where(shapes == THIN, HALF_DIAGONALS[THIN][1], HALF_DIAGONALS[THICK][1])
+    axis = np.exp(1j * np.radians(orientations * 18.0))
+    templates = edges[:, None] * np.stack((long_half * axis, short_half * 1j * axis, -long_half * axis, -short_half * 1j * axis), axis=1)
+    relative = tiles - tiles.mean(axis=1, keepdims=True)
+    errors = np.abs(relative[:, :, None] - templates[:, None, :]).min(axis=2).max(axis=1)
+    return errors <= tolerance * np.maximum(edges, 1e-12)
+
+class MaskCache:
+    """
+    Cache of rhombus alpha masks keyed by (shape, orientation, quantized size, sub-pixel phase).
+    Penrose tiles come in two shapes and ten orientations, and all tiles of one class have the same
+    size, so a mosaic only needs a few hundred distinct masks. The least recently used masks are
+    evicted once the masks take more than max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20, size_steps: int = 8, phase_steps: int = 4):
+        """
+        Parameters:
+        max_bytes (int): The memory budget for the masks.
+        size_steps (int): The edge length is quantized to 1 / size_steps pixels.
+        phase_steps (int): The sub-pixel position is quantized to 1 / phase_steps pixels.
+        """
+        self.max_bytes = max_bytes
+        self.size_steps = size_steps
+        self.phase_steps = phase_steps
+        self.masks = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_mask(self, tile: np.ndarray, shape: int, orientation: int) -> Tuple[Image.Image, Tuple[int, int]]:
+        """
+        Get the mask of a tile and the integer position to paste it at.
+
+        Parameters:
+        tile (np.ndarray): The 4 vertices (complex) of the tile, in output pixels.
+        shape (int): The shape code of the tile.
+        orientation (int): The orientation code of the tile.
+
+        Returns:
+        Tuple[Image.Image, Tuple[int, int]]: The 'L' mask and the top-left position of the mask.
+        """
+        size = round(float(np.abs(tile - np.roll(tile, 1)).mean()) * self.size_steps)
+        top_left = (float(tile.real.min()), float(tile.imag.min()))
+        origin = [math.floor(value) for value in top_left]
+        phase = [round((value - start) * self.phase_steps) for value, start in zip(top_left, origin)]
+        # A phase of a whole pixel moves the origin instead
+        for axis in range(2):
+            if phase[axis] == self.phase_steps:
+                origin[axis], phase[axis] = origin[axis] + 1, 0
+        key = (int(shape), int(orientation), size, phase[0], phase[1])
+        mask = self.masks.get(key)
+        if mask is None:
+            self.misses += 1
+            mask = self.create_mask(*key)
+            self.masks[key] = mask
+            self.bytes += mask.size[0] * mask.size[1]
+            while self.bytes > self.max_bytes and len(self.masks) > 1:
+                _, evicted = self.masks.popitem(last=False)
+                self.bytes -= evicted.size[0] * evicted.size[1]
+        else:
+            self.hits += 1
+            self.masks.move_to_end(key)
+        return mask, (origin[0], origin[1])
+
+    def create_mask(self, shape: int, orientation: int, size: int, phase_x: int, phase_y: int) -> Image.Image:
+        """
+        Rasterize the mask of a cache key.
+
+        Parameters:
+        shape (int): The shape code.
+        orientation (int): The orientation code.
+        size (int): The quantized edge length.
+        phase_x (int): The quantized sub-pixel x position of the bounding box.
+        phase_y (int): The quantized sub-pixel y position of the bounding box.
+
+        Returns:
+        Image.Image: The 'L' mask.
+        """
+        vertices = rhombus_template_vertices(shape, orientation, size / self.size_steps)
+        vertices = vertices - complex(vertices.real.min(), vertices.imag.min()) + complex(phase_x, phase_y) / self.phase_steps
+        mask = Image.new('L', (max(1, math.ceil(vertices.real.max())), max(1, math.ceil(vertices.imag.max()))), 0)
+        ImageDraw.Draw(mask).polygon([(v.real, v.imag) for v in vertices], outline=1, fill=255)
+        return mask
+
+class ImageCache:
+    """
+    Cache of decoded database images keyed by path and modification time, so a mosaic decodes each image once
+    instead of once per tile. With a pyramid folder, the smallest pyramid level that covers the tile is loaded
+    instead of the full image, and with an image pool the level is read from the pool with no decoding at all.
+    The least recently used images are evicted once the decoded pixels take more than max_bytes. The images
+    are shared, callers must not modify them in place. The cache can be used from several threads: the images
+    are decoded outside of the lock, so the threads decode side by side.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 2 ** 20, pyramid_folder: str = None, image_pool: ImagePool = None):
+        """
+        Parameters:
+        max_bytes (int): The memory budget for the decoded images.
+        pyramid_folder (str): The folder with the image pyramids, see update_pyramids.
+        image_pool (ImagePool): The packed pool of decoded images, see update_image_pool.
+        """
+        self.max_bytes = max_bytes
+        self.pyramid_folder = pyramid_folder
+        self.image_pool = image_pool
+        # Level sizes of the pyramids, {pyramid path: (modification time, sizes)}
+        self.pyramid_sizes = {}
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_image(self, path: str, min_size: Tuple[int, int] = None) -> Image.Image:
+        """
+        Get the decoded RGB image at a path.
+
+        Parameters:
+        path (str): The path to the image.
+        min_size (Tuple[int, int]): The size the image will be scaled to cover. The full image is returned if not given.
+
+        Returns:
+        Image.Image: The decoded image, or the pyramid level that covers min_size.
+        """
+        image_name = os.path.basename(path)
+        pyramid_path = get_pyramid_path(self.pyramid_folder, image_name) if self.pyramid_folder else None
+        pooled = self.image_pool is not None and self.image_pool.is_current(image_name, path)
+        if pooled:
+            pixels, level = self.image_pool.get_level(image_name, min_size)
+            key = (self.image_pool, image_name, level)
+        elif min_size is not None and pyramid_path is not None and os.path.exists(pyramid_path):
+            modified = os.stat(pyramid_path).st_mtime_ns
+            if self.pyramid_sizes.get(pyramid_path, (None,))[0] != modified:
+                self.pyramid_sizes[pyramid_path] = (modified, read_pyramid_sizes(pyramid_path))
+            level = choose_pyramid_level(self.pyramid_sizes[pyramid_path][1], min_size)
+            key = (pyramid_path, modified, level)
+        else:
+            level = None
+            key = (path, os.stat(path).st_mtime_ns)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.hits += 1
+                self.images.move_to_end(key)
+                return image
+            self.misses += 1
+        if pooled:
+            image = Image.fromarray(pixels)
+        elif level is None:
+            with Image.open(path) as file:
+                image = file.convert('RGB')
+        else:
+            image = load_pyramid_level(pyramid_path, level)
+        with self.lock:
+            # Another thread may have decoded the same image meanwhile
+            if key in self.images:
+                return self.images[key]
+            self.images[key] = image
+            self.bytes += image.size[0] * image.size[1] * 3
+            while self.bytes > self.max_bytes and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= evicted.size[0] * evicted.size[1] * 3
+        return image
@@ -1,9 +1,10 @@
 import math, cmath, os, time
-from typing import List, Tuple
+from typing import Callable, List, Tuple, Union
+import numpy as np
 import matplotlib.pyplot as plt
 from .utils import *
 
-def create_tiles_and_scale(divisions: int, canvas_size: Tuple[int, int]) -> List[Rhombi]:
+def create_tiles_and_scale(divisions: int, canvas_size: Tuple[int, int]) -> Rhombi_array:
     """
     Create the tiles for the mosaic.
     
@@ -12,25 +13,210 @@ def create_tiles_and_scale(divisions: int, canvas_size: Tuple[int, int]) -> List
     canvas_size (Tuple[int, int]): The size of the original image.
     
     Returns:
-    List[Rhombi]: The tiles for the mosaic.
+    Rhombi_array: The tiles for the mosaic.
     """
     rhombi = create_tiles(divisions)
     scaled_tiles = normalize_and_scale_tiles(rhombi, canvas_size)
     return scaled_tiles
 
-def create_tiles(divisions: int, save_partial: bool = True) -> List[Rhombi]:
+def create_tiles(divisions: int, save_partial: bool = True) -> Rhombi_array:
     if divisions < 15:
         base = 5
         phi = (5 ** 0.5 + 1) / 2
-        triangles = create_initial_triangles(base)
-        divided_triangles = divide_triangles(triangles, divisions, phi)
-        if save_partial: draw_triangles(divided_triangles, "Divided Triangles")
+        shapes, vertices = triangles_to_arrays(create_initial_triangles(base))
+        divided_triangles = divide_triangle_arrays(shapes, vertices, divisions, phi)
+        if save_partial: draw_triangles(arrays_to_triangles(*divided_triangles), "Divided Triangles")
         rhombi = pair_triangles_and_form_rhombi(divided_triangles)
         if save_partial: draw_rhombi(rhombi, "Formed Rhombi")
         return rhombi
     else:
         return False # AVOID CREATING RHOMBI VECTORS FOR DIVISIONS > 15
 
+def create_tiles_for_canvas(divisions: int, canvas_size: Tuple[int, int]) -> Rhombi_array:
+    """
+    Create the tiles for the mosaic using the canvas as a viewport.
+    The tiles have the same size as create_tiles(divisions) scaled to the canvas, but the initial
+    patch is inflated by phi per extra division until it covers the corners of the canvas, and
+    triangles outside the viewport are dropped at every level, so the work scales with the
+    visible tiles and non-square canvases are fully covered.
+    
+    Parameters:
+    divisions (int): The number of divisions to make.
+    canvas_size (Tuple[int, int]): The size of the original image.
+    
+    Returns:
+    Rhombi_array: The tiles for the mosaic, already scaled to the canvas.
+    """
+    phi = (5 ** 0.5 + 1) / 2
+    shapes, vertices, viewport, extra_divisions = create_canvas_patch(divisions, canvas_size)
+    for _ in range(divisions + extra_divisions):
+        shapes, vertices = cull_triangle_arrays(shapes, vertices, viewport)
+        shapes, vertices = divide_triangle_arrays(shapes, vertices, 1, phi)
+    shapes, vertices = cull_triangle_arrays(shapes, vertices, viewport)
+    rhombi = pair_triangles_and_form_rhombi((shapes, vertices))
+    return scale_tiles_to_canvas(rhombi, canvas_size, crop=True)
+
+def create_canvas_patch(divisions: int, canvas_size: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray, Tuple[float, float, float, float], int]:
+    """
+    Create the initial triangles of a patch that covers the whole canvas.
+    
+    Parameters:
+    divisions (int): The number of divisions the tiles should match.
+    canvas_size (Tuple[int, int]): The size of the original image.
+    
+    Returns:
+    Tuple: The shape codes and vertices of the inflated initial triangles, the viewport (expanded by
+    one final edge length so both halves of border rhombi survive) and the number of extra divisions.
+    """
+    base = 5
+    phi = (5 ** 0.5 + 1) / 2
+    # Viewport in patch units, the shortest side of the canvas spans [-1, 1] like in normalize_and_scale_tiles
+    half_width, half_height = canvas_size[0] / min(canvas_size), canvas_size[1] / min(canvas_size)
+    # Longest triangle side after all divisions, halves of a visible rhombus are never further away than this
+    margin = phi ** -divisions
+    # The initial decagon only covers a disk of radius cos(pi / 10)
+    cover_radius = (math.hypot(half_width, half_height) + margin) / math.cos(math.pi / (base * 2))
+    extra_divisions = max(0, math.ceil(math.log(cover_radius) / math.log(phi)))
+
+    shapes, vertices = triangles_to_arrays(create_initial_triangles(base))
+    vertices = vertices * phi ** extra_divisions
+    viewport = (-half_width - margin, -half_height - margin, half_width + margin, half_height + margin)
+    return shapes, vertices, viewport, extra_divisions
+
+def scale_tiles_to_canvas(rhombi: Rhombi_array, canvas_size: Tuple[int, int], crop: bool = False) -> Rhombi_array:
+    """
+    Scale rhombi in patch units (the shortest side of the canvas spans [-1, 1]) to the canvas.
+    
+    Parameters:
+    rhombi (Rhombi_array): The rhombi in patch units.
+    canvas_size (Tuple[int, int]): The size of the original image.
+    crop (bool): Drop the rhombi that do not touch the canvas.
+    
+    Returns:
+    Rhombi_array: The scaled rhombi.
+    """
+    scale = min(canvas_size) / 2
+    rhombi = (rhombi.real * scale + canvas_size[0] / 2) + 1j * (rhombi.imag * scale + canvas_size[1] / 2)
+    if crop:
+        visible = (rhombi.real.max(axis=1) > 0) & (rhombi.real.min(axis=1) < canvas_size[0]) & \
+                  (rhombi.imag.max(axis=1) > 0) & (rhombi.imag.min(axis=1) < canvas_size[1])
+        rhombi = rhombi[visible]
+    return rhombi
+
+def create_adaptive_tiles(image: Image.Image, max_divisions: int, min_divisions: int = 4, variance_threshold: float = 150.0, cover_canvas: bool = False) -> Rhombi_array:
+    """
+    Create the tiles for the mosaic with a subdivision depth that follows the detail of the image.
+    All rhombi are divided min_divisions times. After that a rhombus is only divided again while
+    the color variance of the target pixels under its bounding box is above the threshold, up to
+    max_divisions. Both halves of a rhombus are always divided together.
+    
+    Penrose halves always join across the edges of their parent, so where a divided rhombus meets
+    one that stopped, some children have no partner. Those halves are kept as tiles of their own,
+    half rhombi with their unique vertex repeated, so the tiles never overlap. Requiring the
+    neighbours to divide together instead would spread to every tile of the patch, since the
+    children of every edge pair across it.
+    
+    Parameters:
+    image (Image.Image): The original image.
+    max_divisions (int): The number of divisions in the most detailed areas.
+    min_divisions (int): The number of divisions everywhere.
+    variance_threshold (float): The color variance below which a rhombus is not divided anymore.
+    cover_canvas (bool): Cover the whole image rectangle, see create_tiles_for_canvas.
+    
+    Returns:
+    Rhombi_array: The tiles for the mosaic, already scaled to the canvas.
+    """
+    base = 5
+    phi = (5 ** 0.5 + 1) / 2
+    canvas_size = image.size
+    min_divisions = max(1, min(min_divisions, max_divisions))
+    if cover_canvas:
+        shapes, vertices, viewport, extra_divisions = create_canvas_patch(max_divisions, canvas_size)
+        # Halves outside the viewport are culled already, the rest may stick out of it
+        in_patch = lambda v: np.ones(len(v), dtype=bool)
+    else:
+        shapes, vertices = triangles_to_arrays(create_initial_triangles(base))
+        viewport, extra_divisions = None, 0
+        # Inside the initial decagon: within cos(pi / 10) of the center along all ten edge normals
+        normals = np.exp(-1j * np.pi * np.arange(base * 2) / base)
+        in_patch = lambda v: (v[:, None] * normals).real.max(axis=1) <= math.cos(math.pi / (base * 2)) + 1e-9
+    tables = calculate_summed_area_tables(image)
+    scale = min(canvas_size) / 2
+
+    for _ in range(min_divisions + extra_divisions):
+        if viewport: shapes, vertices = cull_triangle_arrays(shapes, vertices, viewport)
+        shapes, vertices = divide_triangle_arrays(shapes, vertices, 1, phi)
+    leaves = []
+    for level in range(min_divisions, max_divisions + 1):
+        if viewport: shapes, vertices = cull_triangle_arrays(shapes, vertices, viewport)
+        shapes, halves_a, halves_b, single, border = pair_halves_and_keep_orphans(shapes, vertices, in_patch)
+        join_side = find_join_sides(shapes, halves_a)
+        # Orphan halves are paired with themselves, so their unique vertex is repeated
+        rhombi = form_rhombi(halves_a, halves_b, join_side, join_side)
+        pixels = scale_tiles_to_canvas(rhombi, canvas_size)
+        boxes = np.stack((pixels.real.min(axis=1), pixels.imag.min(axis=1), pixels.real.max(axis=1), pixels.imag.max(axis=1)), axis=1)
+        divide = calculate_box_variances(tables, boxes) > variance_threshold
+        # Stop at the maximum depth and once tiles are too small to show any detail
+        divide &= (level < max_divisions) & (np.abs(rhombi[:, 1] - rhombi[:, 0]) * scale >= 2)
+        # Halves on the border of the patch are dropped like in pair_triangles_and_form_rhombi, unless
+        # they are divided: their children can still pair with the children of the neighbours
+        leaves.append(rhombi[~divide & ~border])
+        shapes = np.concatenate((shapes[divide], shapes[divide & ~single]))
+        vertices = np.concatenate((halves_a[divide], halves_b[divide & ~single]))
+        shapes, vertices = divide_triangle_arrays(shapes, vertices, 1, phi)
+    rhombi = sort_rhombi_vertices(np.concatenate(leaves))
+    return scale_tiles_to_canvas(rhombi, canvas_size, crop=cover_canvas)
+
+def pair_halves_and_keep_orphans(shapes: np.ndarray, vertices: np.ndarray, in_patch: Callable[[np.ndarray], np.ndarray], lattice_scale: float = 1e6) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pair the triangles into halves of rhombi, keeping the halves without a partner on their own.
+    
+    Parameters:
+    shapes (np.ndarray): The shape codes (N,) of the triangles.
+    vertices (np.ndarray): The vertices (N, 3) of the triangles.
+    in_patch (Callable[[np.ndarray], np.ndarray]): Tells which points (complex) are inside the patch.
+    lattice_scale (float): The number of lattice steps per unit used to pair the halves.
+    
+    Returns:
+    Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]: The shape codes (M,) of the tiles, the vertices (M, 3)
+    of their first and second halves (the same half twice for orphans), True (M,) for the orphan halves and True (M,) for
+    the orphans whose missing partner would fall outside the patch.
+    """
+    lattice = np.rint(vertices.real * lattice_scale) + 1j * np.rint(vertices.imag * lattice_scale)
+    join_side = find_join_sides(shapes, vertices)
+    half_a, half_b = pair_triangle_halves(lattice, join_side)
+    orphans = np.setdiff1d(np.arange(len(shapes)), np.concatenate((half_a, half_b)))
+
+    # Where the unique vertex of the missing partner would be: mirrored across the join side
+    unique = vertices[orphans, 3 - TRIANGLE_SIDES[join_side[orphans]].sum(axis=1)]
+    edge_a = vertices[orphans, TRIANGLE_SIDES[join_side[orphans], 0]]
+    edge_b = vertices[orphans, TRIANGLE_SIDES[join_side[orphans], 1]]
+    mirrored = edge_a + (edge_b - edge_a) * np.conj((unique - edge_a) / (edge_b - edge_a))
+    paired = np.zeros(len(half_a), dtype=bool)
+    return (np.concatenate((shapes[half_a], shapes[orphans])),
+            np.concatenate((vertices[half_a], vertices[orphans])),
+            np.concatenate((vertices[half_b], vertices[orphans])),
+            np.concatenate((paired, np.ones(len(orphans), dtype=bool))),
+            np.concatenate((paired, ~in_patch(mirrored))))
+
+def cull_triangle_arrays(shapes: np.ndarray, vertices: np.ndarray, viewport: Tuple[float, float, float, float]) -> Triangle_arrays:
+    """
+    Drop the triangles whose bounding box does not intersect the viewport.
+    Children always lie inside their parent, so culled triangles never need to be divided.
+    
+    Parameters:
+    shapes (np.ndarray): The shape codes (N,) of the triangles.
+    vertices (np.ndarray): The vertices (N, 3) of the triangles.
+    viewport (Tuple[float, float, float, float]): The viewport as (min_x, min_y, max_x, max_y).
+    
+    Returns:
+    Triangle_arrays: The shape codes and vertices of the triangles inside the viewport.
+    """
+    min_x, min_y, max_x, max_y = viewport
+    inside = (vertices.real.max(axis=1) >= min_x) & (vertices.real.min(axis=1) <= max_x) & \
+             (vertices.imag.max(axis=1) >= min_y) & (vertices.imag.min(axis=1) <= max_y)
+    return shapes[inside], vertices[inside]
+
 def create_initial_triangles(base: int) -> List[Triangle]:
     """
     Create the initial triangles for the mosaic.
@@ -50,6 +236,33 @@ def create_initial_triangles(base: int) -> List[Triangle]:
         triangles.append(("thin", 0, v2, v3))
     return triangles
 
+def triangles_to_arrays(triangles: List[Triangle]) -> Triangle_arrays:
+    """
+    Convert a list of triangles to the array layout used by the subdivision engine.
+    
+    Parameters:
+    triangles (List[Triangle]): The triangles.
+    
+    Returns:
+    Triangle_arrays: The shape codes (N,) and the vertices (N, 3) of the triangles.
+    """
+    shapes = np.array([SHAPE_NAMES.index(shape) for shape, *_ in triangles], dtype=np.uint8)
+    vertices = np.array([vertices for _, *vertices in triangles], dtype=np.complex128).reshape(-1, 3)
+    return shapes, vertices
+
+def arrays_to_triangles(shapes: np.ndarray, vertices: np.ndarray) -> List[Triangle]:
+    """
+    Convert the array layout of the subdivision engine back to a list of triangles.
+    
+    Parameters:
+    shapes (np.ndarray): The shape codes (N,) of the triangles.
+    vertices (np.ndarray): The vertices (N, 3) of the triangles.
+    
+    Returns:
+    List[Triangle]: The triangles.
+    """
+    return [(SHAPE_NAMES[shape], v1, v2, v3) for shape, (v1, v2, v3) in zip(shapes.tolist(), vertices.tolist())]
+
 def divide_triangles(triangles: List[Triangle], divisions: int, phi: float) -> List[Triangle]:
     """
     Divide the triangles for the mosaic.
@@ -62,56 +275,184 @@ def divide_triangles(triangles: List[Triangle], divisions: int, phi: float) -> L
     Returns:
     List[Triangle]: The divided triangles for the mosaic.
     """
+    shapes, vertices = divide_triangle_arrays(*triangles_to_arrays(triangles), divisions, phi)
+    return arrays_to_triangles(shapes, vertices)
+
+def divide_triangle_arrays(shapes: np.ndarray, vertices: np.ndarray, divisions: int, phi: float) -> Triangle_arrays:
+    """
+    Divide the triangles for the mosaic, one whole level at a time.
+    Every thin triangle is replaced by a thin and a thick one, and every thick triangle
+    by two thick ones and a thin one. Children are written right after each other, so
+    the output keeps the same order as dividing the triangles one by one.
+    
+    Parameters:
+    shapes (np.ndarray): The shape codes (N,) of the initial triangles.
+    vertices (np.ndarray): The vertices (N, 3) of the initial triangles.
+    divisions (int): The number of divisions to make.
+    phi (float): The golden ratio.
+    
+    Returns:
+    Triangle_arrays: The shape codes and vertices of the divided triangles.
+    """
     for _ in range(divisions):
-        new_triangles = []
-        for shape, v1, v2, v3 in triangles:
-            if shape == "thin":
-                p1 = v1 + (v2 - v1) / phi
-                new_triangles += [("thin", v3, p1, v2), ("thick", p1, v3, v1)]
-            else:
-                p2 = v2 + (v1 - v2) / phi
-                p3 = v2 + (v3 - v2) / phi
-                new_triangles += [("thick", p3, v3, v1), ("thick", p2, p3, v2), ("thin", p3, p2, v1)]
-        triangles = new_triangles
-    return triangles
+        thin = shapes == THIN
+        child_counts = np.where(thin, 2, 3)
+        starts = np.cumsum(child_counts) - child_counts
+        new_shapes = np.empty(int(child_counts.sum()), dtype=np.uint8)
+        new_vertices = np.empty((len(new_shapes), 3), dtype=np.complex128)
+
+        # Thin triangles -> ("thin", v3, p1, v2), ("thick", p1, v3, v1)
+        v1, v2, v3 = vertices[thin].T
+        start = starts[thin]
+        p1 = v1 + (v2 - v1) / phi
+        new_shapes[start], new_vertices[start] = THIN, np.stack((v3, p1, v2), axis=1)
+        new_shapes[start + 1], new_vertices[start + 1] = THICK, np.stack((p1, v3, v1), axis=1)
 
-def pair_triangles_and_form_rhombi(triangles: List[Triangle]) -> List[Rhombi]:
+        # Thick triangles -> ("thick", p3, v3, v1), ("thick", p2, p3, v2), ("thin", p3, p2, v1)
+        v1, v2, v3 = vertices[~thin].T
+        start = starts[~thin]
+        p2 = v2 + (v1 - v2) / phi
+        p3 = v2 + (v3 - v2) / phi
+        new_shapes[start], new_vertices[start] = THICK, np.stack((p3, v3, v1), axis=1)
+        new_shapes[start + 1], new_vertices[start + 1] = THICK, np.stack((p2, p3, v2), axis=1)
+        new_shapes[start + 2], new_vertices[start + 2] = THIN, np.stack((p3, p2, v1), axis=1)
+
+        shapes, vertices = new_shapes, new_vertices
+    return shapes, vertices
+
+def pair_triangles_and_form_rhombi(triangles: Union[List[Triangle], Triangle_arrays], lattice_scale: float = 1e6) -> Rhombi_array:
     """
     Pair the triangles and form rhombi.
+    Vertices are snapped to an integer lattice, every triangle gets one integer key for its
+    join side, and halves with the same key are paired after a single sort of the keys.
+    Triangles without a partner (on the border of the patch) are dropped.
     
     Parameters:
-    triangles (List[Triangle]): The divided triangles for the mosaic.
+    triangles (Union[List[Triangle], Triangle_arrays]): The divided triangles for the mosaic, as a list or as shape codes and vertices.
+    lattice_scale (float): The number of lattice steps per unit, 1e6 matches rounding to 6 decimals.
     
     Returns:
-    List[Rhombi]: The rhombi for the mosaic.
+    Rhombi_array: The rhombi for the mosaic, with the vertices of each rhombus sorted by angle around its centroid.
     """
-    triangle_halves = {}
-    rhombi = []
-    for shape, v1, v2, v3 in triangles:
-        v1_rounded, v2_rounded, v3_rounded = round_complex(v1, 6), round_complex(v2, 6), round_complex(v3, 6)
-        long_side = find_join_side(v1_rounded, v2_rounded, v3_rounded, shape)
-        hashed_edge = hash_edge(*long_side)
-
-        if hashed_edge in triangle_halves:
-            matching_triangle = [round_complex(v, 6) for v in triangle_halves[hashed_edge]]
-            shared_vertices = set(long_side)
-            unique_vertices = set([v1_rounded, v2_rounded, v3_rounded]) - shared_vertices
-
-            matching_unique = set(matching_triangle) - shared_vertices
-            rhombus_vertices = list(unique_vertices) + list(matching_unique) + list(shared_vertices)
-            if len(shared_vertices) > 2:
-                print(f'Error: Matching edge has more than 2 vertices: {shared_vertices}')
-            if len(matching_triangle) > 3:
-                print(f'Error: Matching triangle has more than 3 vertices: {matching_triangle}')
-            if len(rhombus_vertices) == 4:
-                sorted_rhombus = sort_vertices(rhombus_vertices)
-                rhombi.append(tuple(sorted_rhombus))
-            else:
-                print(f"Error: Incorrect vertices count for a rhombus:, {len(rhombus_vertices)}")
-            del triangle_halves[hashed_edge]
-        else:
-            triangle_halves[hashed_edge] = [v1, v2, v3]
-    return rhombi
+    shapes, vertices = triangles if isinstance(triangles, tuple) else triangles_to_arrays(triangles)
+    if len(shapes) == 0:
+        return np.empty((0, 4), dtype=np.complex128)
+    lattice = np.rint(vertices.real * lattice_scale) + 1j * np.rint(vertices.imag * lattice_scale)
+    join_side = find_join_sides(shapes, vertices)
+    half_a, half_b = pair_triangle_halves(lattice, join_side)
+    rhombi = form_rhombi(lattice[half_a], lattice[half_b], join_side[half_a], join_side[half_b]) / lattice_scale
+    return sort_rhombi_vertices(rhombi)
+
+def find_join_sides(shapes: np.ndarray, vertices: np.ndarray) -> np.ndarray:
+    """
+    Find the side to join the triangles: the shortest side for 'thin' triangles and the longest side for 'thick' triangles.
+    
+    Parameters:
+    shapes (np.ndarray): The shape codes (N,) of the triangles.
+    vertices (np.ndarray): The vertices (N, 3) of the triangles.
+    
+    Returns:
+    np.ndarray: The index (N,) of the join side of each triangle in TRIANGLE_SIDES.
+    """
+    lengths = np.abs(vertices[:, TRIANGLE_SIDES[:, 0]] - vertices[:, TRIANGLE_SIDES[:, 1]])
+    return np.where(shapes == THIN, lengths.argmin(axis=1), lengths.argmax(axis=1))
+
+def pair_triangle_halves(lattice: np.ndarray, join_side: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pair the triangles that share their join side, with one sort of integer edge keys.
+    
+    Parameters:
+    lattice (np.ndarray): The vertices (N, 3) of the triangles, snapped to integer coordinates.
+    join_side (np.ndarray): The index (N,) of the join side of each triangle.
+    
+    Returns:
+    Tuple[np.ndarray, np.ndarray]: The indices of the first and second half of every rhombus, in the order in which the rhombi are completed.
+    """
+    rows = np.arange(len(lattice))
+    edge_a = lattice[rows, TRIANGLE_SIDES[join_side, 0]]
+    edge_b = lattice[rows, TRIANGLE_SIDES[join_side, 1]]
+    # Order the endpoints of every edge so both halves produce the same key
+    swap = (edge_a.real > edge_b.real) | ((edge_a.real == edge_b.real) & (edge_a.imag > edge_b.imag))
+    edge_a[swap], edge_b[swap] = edge_b[swap], edge_a[swap]
+    keys = np.stack((edge_a.real, edge_a.imag, edge_b.real, edge_b.imag), axis=1).astype(np.int64)
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    same = np.all(sorted_keys[1:] == sorted_keys[:-1], axis=1)
+    # Only the first two triangles of a key form a rhombus
+    first = same & np.concatenate(([True], ~same[:-1]))
+    if np.any(same[1:] & same[:-1]):
+        print(f'Error: {int(np.sum(same[1:] & same[:-1]))} edges are shared by more than 2 triangles')
+    half_a, half_b = order[:-1][first], order[1:][first]
+    # Keep the order in which the rhombi are completed
+    completed = np.argsort(np.maximum(half_a, half_b), kind='stable')
+    return half_a[completed], half_b[completed]
+
+def find_tile_adjacency(tiles: Rhombi_array, lattice_scale: float = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the tiles that share an edge, with the same integer edge keys used to pair the triangles.
+    
+    Parameters:
+    tiles (Rhombi_array): The tiles.
+    lattice_scale (float): The number of lattice steps per unit, 1000 steps per median edge length if not given.
+    
+    Returns:
+    Tuple[np.ndarray, np.ndarray]: The neighbors of tile i are indices[indptr[i]:indptr[i + 1]].
+    """
+    tiles = np.asarray(tiles, dtype=np.complex128)
+    if lattice_scale is None:
+        lattice_scale = 1000 / max(float(np.median(np.abs(tiles[:, 1] - tiles[:, 0]))), 1e-12) if len(tiles) else 1.0
+    lattice = np.rint(tiles.real * lattice_scale) + 1j * np.rint(tiles.imag * lattice_scale)
+    edge_a = lattice.ravel()
+    edge_b = np.roll(lattice, -1, axis=1).ravel()
+    # Half rhombi repeat a vertex, their empty edge is not shared with anything
+    edges = np.flatnonzero(edge_a != edge_b)
+    edge_a, edge_b = edge_a[edges], edge_b[edges]
+    # Order the endpoints of every edge so both tiles produce the same key
+    swap = (edge_a.real > edge_b.real) | ((edge_a.real == edge_b.real) & (edge_a.imag > edge_b.imag))
+    edge_a[swap], edge_b[swap] = edge_b[swap], edge_a[swap]
+    keys = np.stack((edge_a.real, edge_a.imag, edge_b.real, edge_b.imag), axis=1).astype(np.int64)
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys, order = keys[order], edges[order]
+    same = np.all(sorted_keys[1:] == sorted_keys[:-1], axis=1)
+    first, second = order[:-1][same] // 4, order[1:][same] // 4
+    sources = np.concatenate((first, second))
+    targets = np.concatenate((second, first))
+    order = np.argsort(sources, kind='stable')
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=len(tiles)))))
+    return indptr, targets[order]
+
+def form_rhombi(vertices_a: np.ndarray, vertices_b: np.ndarray, join_side_a: np.ndarray, join_side_b: np.ndarray) -> Rhombi_array:
+    """
+    Form rhombi from paired halves: the unique vertex of each half plus the shared join side.
+    
+    Parameters:
+    vertices_a (np.ndarray): The vertices (N, 3) of the first halves.
+    vertices_b (np.ndarray): The vertices (N, 3) of the second halves.
+    join_side_a (np.ndarray): The join side (N,) of the first halves.
+    join_side_b (np.ndarray): The join side (N,) of the second halves.
+    
+    Returns:
+    Rhombi_array: The (unsorted) rhombi.
+    """
+    rows = np.arange(len(vertices_a))
+    unique_a = vertices_a[rows, 3 - TRIANGLE_SIDES[join_side_a].sum(axis=1)]
+    unique_b = vertices_b[rows, 3 - TRIANGLE_SIDES[join_side_b].sum(axis=1)]
+    edge_a = vertices_a[rows, TRIANGLE_SIDES[join_side_a, 0]]
+    edge_b = vertices_a[rows, TRIANGLE_SIDES[join_side_a, 1]]
+    return np.stack((unique_a, edge_a, unique_b, edge_b), axis=1)
+
+def sort_rhombi_vertices(rhombi: Rhombi_array) -> Rhombi_array:
+    """
+    Sort the vertices of every rhombus based on their angle with respect to its centroid.
+    
+    Parameters:
+    rhombi (Rhombi_array): The rhombi.
+    
+    Returns:
+    Rhombi_array: The rhombi with sorted vertices.
+    """
+    angles = np.angle(rhombi - rhombi.mean(axis=1, keepdims=True))
+    return np.take_along_axis(rhombi, np.argsort(angles, axis=1), axis=1)
 
 def sort_vertices(vertices: List[complex]) -> List[complex]:
     """
@@ -134,27 +475,22 @@ def sort_vertices(vertices: List[complex]) -> List[complex]:
     sorted_vertices = sorted(vertices, key=angle)
     return sorted_vertices
 
-def normalize_and_scale_tiles(rhombi: List[Rhombi], canvas_size: Tuple[int, int]) -> List[Rhombi]:
+def normalize_and_scale_tiles(rhombi: Union[List[Rhombi], Rhombi_array], canvas_size: Tuple[int, int]) -> Rhombi_array:
     """
     Normalize and scale the rhombi.
     
     Parameters:
-    rhombi (List[Rhombi]): The rhombi for the mosaic.
+    rhombi (Union[List[Rhombi], Rhombi_array]): The rhombi for the mosaic.
     canvas_size (Tuple[int, int]): The size of the original image.
     
     Returns:
-    List[Rhombi]: The normalized and scaled rhombi.
+    Rhombi_array: The normalized and scaled rhombi.
     """
-    scaled_tiles = []
+    rhombi = np.asarray(rhombi, dtype=np.complex128).reshape(-1, 4)
     # Finding the maximum dimension to scale rhombi
-    max_dimension = max(max(abs(v.real), abs(v.imag)) for rhombus in rhombi for v in rhombus) * 2
+    max_dimension = max(np.abs(rhombi.real).max(), np.abs(rhombi.imag).max()) * 2
     scale = min(canvas_size) / max_dimension
-
-    for rhombus in rhombi:
-        scaled_rhombus = tuple(complex(v.real * scale + canvas_size[0] / 2, v.imag * scale + canvas_size[1] / 2) for v in rhombus)
-        scaled_tiles.append(scaled_rhombus)
-
-    return scaled_tiles
+    return (rhombi.real * scale + canvas_size[0] / 2) + 1j * (rhombi.imag * scale + canvas_size[1] / 2)
 
 def draw_triangles(triangles: List[Triangle], title: str) -> None:
     """
@@ -174,12 +510,12 @@ def draw_triangles(triangles: List[Triangle], title: str) -> None:
     ax.set_aspect('equal')
     plt.savefig('photomosaic/output/triangles.png')
     
-def draw_rhombi(rhombi: List[Rhombi], title: str) -> None:
+def draw_rhombi(rhombi: Rhombi_array, title: str) -> None:
     """
     Draw the rhombi.
     
     Parameters:
-    rhombi (List[Rhombi]): The rhombi for the mosaic.
+    rhombi (Rhombi_array): The rhombi for the mosaic.
     title (str): The title of the plot.
     """
     fig, ax = plt.subplots()
@@ -240,27 +576,37 @@ def hash_edge(v1: complex, v2: complex) -> int:
     edge_hash = hash(edge)
     return edge_hash
 
-def get_rhombi_by_division_and_scale(image_size: Tuple[int, int], config: dict, color: Tuple[int, int, int]=(255, 0, 0)) -> List[Rhombi]:
+def get_rhombi_by_division_and_scale(image_size: Tuple[int, int], config: dict, color: Tuple[int, int, int]=(255, 0, 0), image: Image.Image = None) -> Rhombi_array:
     """
     Get the tiles for the mosaic by division and scale them.
     
     Parameters:
-    image (Image.Image): The original image.
+    image_size (Tuple[int, int]): The size of the original image.
     config (dict): The configuration settings.
+    color (Tuple[int, int, int]): The color of the tile borders in the saved tile canvas.
+    image (Image.Image): The original image, required for adaptive tiles.
     
     Returns:
-    List[Rhombi]: The tiles for the mosaic.
+    Rhombi_array: The tiles for the mosaic.
     """
     config['timing']['getting_tiles'] = time.time()
     log_message(f'4- Creating tiles for {config["divisions"]} divisions in a {image_size} canvas', config)
-    if config['divisions'] in config['available_vectors']:
-        base_tiles = load_vector(f'rhombi_{config["divisions"]}')
-        source = 'Loaded'
+    scaled = True
+    if config.get('adaptive', False) and image is not None:
+        base_tiles = create_adaptive_tiles(image, config['divisions'], config.get('adaptive_min_divisions', 4),
+                                           config.get('adaptive_variance_threshold', 150.0), config.get('cover_canvas', False))
+        source = 'Created adaptive'
+    elif config.get('cover_canvas', False):
+        base_tiles = create_tiles_for_canvas(config['divisions'], image_size)
+        source = 'Created canvas covering'
+    elif config['divisions'] in config['available_vectors']:
+        base_tiles = load_vector(f'rhombi_{config["divisions"]}', config['vector_dir'])
+        source, scaled = 'Loaded', False
     else:
         base_tiles = create_tiles(config['divisions'], config['save_partial'])
-        source = 'Created'
-    if base_tiles and source:
-        tiles = normalize_and_scale_tiles(base_tiles, image_size)
+        source, scaled = 'Created', False
+    if base_tiles is not False and source:
+        tiles = base_tiles if scaled else normalize_and_scale_tiles(base_tiles, image_size)
         canvas = create_canvas(image_size)
         draw_borders(canvas, tiles, color)
         canvas.save(os.path.join(config['output_path'], config['tile_canvas_name']), optimize=True)
@@ -276,6 +622,6 @@ def create_and_save_rhombi_vectors_from_division(config: dict):
     rhombi = create_tiles(division, False)
     print(f'Created {len(rhombi)} rhombi.')
     if save_vector(rhombi, f'rhombi_{division}', config):
-        print(f'Saved rhombi_{division}.json')
+        print(f'Saved rhombi_{division}.npy')
     else:
-        print(f'Failed to save rhombi_{division}.json')
\ No newline at end of file
+        print(f'Failed to save rhombi_{division}.npy')
\ No newline at end of file
@@ -2,29 +2,32 @@ import gradio as gr
 from modules.utils import *
 from modules.database_visualize import *
 import matplotlib.pyplot as plt
-from modules.replace_slices import place_slices_on_canvas, replace_slices, slice_image
-from modules.create_tiles import normalize_and_scale_tiles, de_serialize_vector_complex
+from matplotlib.collections import PolyCollection
+from modules.replace_slices import render_mosaic, calculate_tile_colors
+from modules.create_tiles import normalize_and_scale_tiles, create_tiles_for_canvas, create_adaptive_tiles
+from modules.update_database import find_matching_indices
+from modules.matching import create_matcher
+from modules.caches import ImageCache
+from modules.image_pool import ImagePool, update_image_pool
+
+# Decoded photos, kept between mosaics
+image_pool_path = "photomosaic/images_temp_pool.bin"
+image_cache = ImageCache()
+# Threads that load and resize the photos while the canvas is drawn
+render_threads = os.cpu_count() or 1
 
 def plot_pattern(pattern_type):
     pattern = load_vector_file(pattern_type)
     ## Return a matplotlib figure
     fig = plt.figure()
     scale_factor = 100
-    for vector in pattern:
-        vector = vector
-        x, y = zip(*vector)
-        # scale
-        x = tuple(i * scale_factor for i in x)
-        y = tuple(i * scale_factor for i in y)
-        # Closing the shape by appending the first point at the end
-        x += (x[0],)
-        y += (y[0],)
-
-        # Plotting the shape
-        plt.plot(x, y)
+    # Draw every rhombus in one collection straight from the memory mapped store
+    polygons = PolyCollection(pattern['vertices'] * scale_factor, closed=True, facecolors='none', edgecolors=plt.cm.tab10(pattern['orientation'] % 10), linewidths=0.5)
+    plt.gca().add_collection(polygons)
 
     # Setting plot limits
-    lim = (scale_factor * 1)+0.1
+    bbox = pattern['bbox']
+    lim = (scale_factor * max(np.abs(bbox).max(), 1))+0.1
     plt.xlim(-lim, lim)
     plt.ylim(-lim, lim)
 
@@ -76,6 +79,8 @@ def update_photo_database(photo_database_upload: gr.File, photo_database_json: d
                 img.thumbnail((1024,1024), Image.Resampling.LANCZOS)
                 photo_database[filename] = get_color_profile_of_image(img)
                 img.save(database_image_path, optimize=True)
+    update_image_pool(image_folder, image_pool_path, sorted(photo_database.keys()))
+    image_cache.image_pool = ImagePool(image_pool_path)
     
     return gr.State(photo_database)
 
@@ -89,25 +94,28 @@ def get_color_profile_of_image(image: Image.Image) -> Tuple:
     color_var = calculate_color_variance(image)
     return (r, b, g, color_var)
 
-def call_create_mosaic(target_image: Image.Image, pattern_dropdown: gr.Dropdown, photo_database: gr.State, scale_chosen: int):
+def call_create_mosaic(target_image: Image.Image, pattern_dropdown: gr.Dropdown, photo_database: gr.State, scale_chosen: int, cover_canvas: bool = False, adaptive: bool = False, perceptual: bool = False, match_mode: str = 'color', neighbor_exclusion: int = 0, blend_strength: float = 0, blend_opacity: float = 0.5, blend_mode: str = 'overlay'):
     print('Creating mosaic')
     if isinstance(pattern_dropdown, gr.Dropdown):
         pattern_dropdown = pattern_dropdown.value
     if isinstance(photo_database, gr.State):
         photo_database = photo_database.value
     image_folder = "photomosaic/images_temp"
-    tiles = de_serialize_vector_complex(load_vector_file(pattern_dropdown))
-    tiles = normalize_and_scale_tiles(tiles, target_image.size)
-    slices = slice_image(target_image, tiles)
-    mosaic_tiles, color_mosaic_tiles = replace_slices(slices, photo_database, scale_chosen, image_folder)
-    
-    print('Placing slices on canvas')
-    new_canvas = create_canvas((target_image.size[0]*scale_chosen, target_image.size[1]*scale_chosen))
-    place_slices_on_canvas(new_canvas, color_mosaic_tiles)
-    color_image = gr.Image(new_canvas, label="Color Mosaic", show_label=True, show_download_button=True)
-    
-    photo_canvas = create_canvas((target_image.size[0]*scale_chosen, target_image.size[1]*scale_chosen))
-    place_slices_on_canvas(photo_canvas, mosaic_tiles)  
+    divisions = int(os.path.splitext(pattern_dropdown)[0].split('_')[-1])
+    if adaptive:
+        tiles = create_adaptive_tiles(target_image, divisions, cover_canvas=cover_canvas)
+    elif cover_canvas:
+        tiles = create_tiles_for_canvas(divisions, target_image.size)
+    else:
+        tiles = load_vector(os.path.splitext(pattern_dropdown)[0])
+        tiles = normalize_and_scale_tiles(tiles, target_image.size)
+    tile_colors = calculate_tile_colors(target_image, tiles, grid=match_mode == 'grid')
+    matcher = create_matcher(photo_database, 'lab' if perceptual else 'rgb', match_mode, image_folder=image_folder)
+    canvas_size = (target_image.size[0]*scale_chosen, target_image.size[1]*scale_chosen)
+    photo_canvas, color_canvas = render_mosaic(tiles, tile_colors, photo_database, scale_chosen, image_folder, canvas_size, matcher=matcher, neighbor_distance=int(neighbor_exclusion), image_cache=image_cache,
+                                               blend_mode=blend_mode, blend_strength=blend_strength, blend_opacity=blend_opacity, threads=render_threads, verbose=True)
+    print(f'Image cache: {len(image_cache.images)} images, {image_cache.hits} hits, {image_cache.misses} misses')
+    color_image = gr.Image(color_canvas, label="Color Mosaic", show_label=True, show_download_button=True)
     photo_image = gr.Image(photo_canvas, label="Photo Mosaic", show_label=True, show_download_button=True)
     print('Mosaic created')
     return photo_image, color_image
@@ -116,7 +124,7 @@ pm_theme = gr.themes.Soft(
     primary_hue="indigo",
     secondary_hue="emerald",
 )
-list_vectors = list_files_in_folder("photomosaic/vectors")
+list_vectors = [f'rhombi_{division}.npy' for division in sorted(find_matching_indices("photomosaic/vectors"))]
 
 with gr.Blocks(theme=pm_theme, title="Photomosaic generator") as mosaic_interface:
     photo_database_json = gr.State({})
@@ -140,6 +148,11 @@ with gr.Blocks(theme=pm_theme, title="Photomosaic generator") as mosaic_interfac
             with gr.Group():
                 pattern_dropdown = gr.Dropdown(label="Select pattern", value=list_vectors[0], choices=list_vectors)
                 pattern_selected = get_pattern_plot(pattern_dropdown.value)
+                cover_canvas = gr.Checkbox(label="Cover the whole image (tiles are generated for the image rectangle instead of the pattern disk)", value=False, interactive=True)
+                adaptive = gr.Checkbox(label="Adaptive detail (flat areas get bigger tiles, the pattern sets the smallest tile size)", value=False, interactive=True)
+                perceptual = gr.Checkbox(label="Perceptual color matching (colors are compared the way the eye sees them, in CIELAB)", value=False, interactive=True)
+                match_mode = gr.Radio(label="Matching (color: average colors, crop: colors of the part of each photo a tile shows, grid: 2x2 grid of colors)", choices=["color", "crop", "grid"], value="color", interactive=True)
+                neighbor_exclusion = gr.Slider(label="Keep repeated photos apart (tiles within this many steps get different photos, 0 to allow repeats)", minimum=0, maximum=3, step=1, value=0, interactive=True)
     with gr.Row():
         with gr.Column(scale=1):
             gr.Markdown("""
@@ -165,12 +178,14 @@ with gr.Blocks(theme=pm_theme, title="Photomosaic generator") as mosaic_interfac
             gr.Markdown("""
                         ## 5- Color blend
                         Select color blending strength and opacity
-                        (This is currently not being used since it slows down the process)
+                        (photos further from the color of their tile get blended more, 0 strength to turn it off)
                         """)
-        with gr.Column(scale=3):
+        with gr.Column(scale=2):
             color_matching_slider = gr.Slider(label="Color Matching Strength", minimum=0, maximum=1, step=0.1, value=0.5, interactive=True)
-        with gr.Column(scale=3):
+        with gr.Column(scale=2):
             overlay_blend_slider = gr.Slider(label="Overlay Blend Opacity", minimum=0, maximum=1, step=0.1, value=0.5, interactive=True)
+        with gr.Column(scale=2):
+            blend_mode = gr.Radio(label="Blend mode", choices=["overlay", "hard_light", "multiply", "screen"], value="overlay", interactive=True)
     with gr.Row():
         with gr.Column(scale=1):
             gr.Markdown("""
@@ -200,4 +215,4 @@ with gr.Blocks(theme=pm_theme, title="Photomosaic generator") as mosaic_interfac
     pattern_dropdown.change(get_pattern_plot, pattern_dropdown, pattern_selected)
     photo_database_upload.change(update_photo_database, [photo_database_upload, photo_database_json], photo_database_json)
     show_color_analysis.click(update_color_analysis, [photo_database_json, target_image_colors], color_analysis)
-    create.click(call_create_mosaic, [target_image_upload, pattern_dropdown, photo_database_json, scale_chosen], [output_photo, output_color])
\ No newline at end of file
+    create.click(call_create_mosaic, [target_image_upload, pattern_dropdown, photo_database_json, scale_chosen, cover_canvas, adaptive, perceptual, match_mode, neighbor_exclusion, color_matching_slider, overlay_blend_slider, blend_mode], [output_photo, output_color])
\ No newline at end of file
@@ -0,0 +1,159 @@
+from PIL import Image
+from typing import List, Tuple
+import numpy as np
+from .utils import *
+from .pyramids import build_pyramid, choose_pyramid_level
+import json, os
+
+def get_pool_index_path(pool_path: str) -> str:
+    """
+    Get the path of the offset index that goes with a packed image pool.
+
+    Parameters:
+    pool_path (str): The path to the pool.
+
+    Returns:
+    str: The path to the index json.
+    """
+    return os.path.splitext(pool_path)[0] + '_index.json'
+
+def load_pool_index(pool_path: str) -> dict:
+    """
+    Load the offset index of a packed image pool.
+
+    Parameters:
+    pool_path (str): The path to the pool.
+
+    Returns:
+    dict: {'images': {image name: {'modified': mtime, 'levels': [[offset, width, height], ...]}}, 'dead_bytes': int},
+    empty if there is no pool yet.
+    """
+    index_path = get_pool_index_path(pool_path)
+    if not os.path.exists(index_path) or not os.path.exists(pool_path):
+        return {'images': {}, 'dead_bytes': 0}
+    with open(index_path, 'r') as file:
+        return json.load(file)
+
+def update_image_pool(image_folder: str, pool_path: str, image_names: List[str], changed: List[str] = None) -> Tuple[int, int]:
+    """
+    Update the packed pool with the decoded pyramid levels of every database image, see build_pyramid.
+    New and modified images are appended to the end of the pool and removed ones only leave dead bytes,
+    the pool is compacted once the dead bytes outweigh the live ones.
+
+    Parameters:
+    image_folder (str): The folder with the database images.
+    pool_path (str): The path to the pool.
+    image_names (List[str]): The images in the database.
+    changed (List[str]): The images modified since the last update, see update_image_database. Only these and the
+    images missing from the pool are read. Every image is checked by modification time if not given.
+
+    Returns:
+    Tuple[int, int]: The number of images added and removed.
+    """
+    index = load_pool_index(pool_path)
+    images = index['images']
+    if changed is None:
+        modified = {name: os.path.getmtime(os.path.join(image_folder, name)) for name in image_names if os.path.exists(os.path.join(image_folder, name))}
+        removed = [name for name in images if name not in modified or images[name]['modified'] != modified[name]]
+    else:
+        changed = set(changed)
+        current = set(image_names)
+        removed = [name for name in images if name not in current or name in changed]
+        modified = {name: os.path.getmtime(os.path.join(image_folder, name)) for name in image_names
+                    if (name not in images or name in changed) and os.path.exists(os.path.join(image_folder, name))}
+    for name in removed:
+        index['dead_bytes'] += sum(width * height * 3 for _, width, height in images.pop(name)['levels'])
+    added = [name for name in modified if name not in images]
+    changed = bool(removed)
+    if not os.path.exists(pool_path):
+        open(pool_path, 'wb').close()
+    with open(pool_path, 'ab') as file:
+        for name in added:
+            try:
+                with Image.open(os.path.join(image_folder, name)) as img:
+                    levels = build_pyramid(img)
+            except IOError:
+                print(f"Error opening {name} to add it to the image pool. Skipping.")
+                continue
+            entries = []
+            for level in levels:
+                entries.append([file.tell(), level.shape[1], level.shape[0]])
+                file.write(np.ascontiguousarray(level).tobytes())
+            images[name] = {'modified': modified[name], 'levels': entries}
+            changed = True
+    live_bytes = sum(width * height * 3 for image in images.values() for _, width, height in image['levels'])
+    if index['dead_bytes'] > live_bytes:
+        compact_image_pool(pool_path, index)
+        changed = True
+    # The index only changes with the pool, an update with nothing to do writes nothing
+    if changed:
+        with open(get_pool_index_path(pool_path), 'w') as file:
+            json.dump(index, file)
+    return len(added), len(removed)
+
+def compact_image_pool(pool_path: str, index: dict) -> None:
+    """
+    Rewrite the pool with only the live levels, updating the offsets of the index in place.
+
+    Parameters:
+    pool_path (str): The path to the pool.
+    index (dict): The offset index, see load_pool_index.
+    """
+    compacted_path = pool_path + '.tmp'
+    pool = np.memmap(pool_path, dtype=np.uint8, mode='r') if os.path.getsize(pool_path) else np.zeros(0, dtype=np.uint8)
+    with open(compacted_path, 'wb') as file:
+        for image in index['images'].values():
+            for entry in image['levels']:
+                offset, width, height = entry
+                start = file.tell()
+                file.write(pool[offset:offset + width * height * 3].tobytes())
+                entry[0] = start
+    del pool
+    os.replace(compacted_path, pool_path)
+    index['dead_bytes'] = 0
+
+class ImagePool:
+    """
+    Read-only view of a packed image pool. The pool is memory mapped, so every process that opens it shares
+    the same pages and every level is a zero-copy array with no decoding.
+    """
+
+    def __init__(self, pool_path: str):
+        """
+        Parameters:
+        pool_path (str): The path to the pool, see update_image_pool.
+        """
+        self.index = load_pool_index(pool_path)['images']
+        self.data = np.memmap(pool_path, dtype=np.uint8, mode='r') if self.index and os.path.getsize(pool_path) else None
+        self.sizes = {name: np.array([(width, height) for _, width, height in image['levels']]) for name, image in self.index.items()}
+
+    def __contains__(self, image_name: str) -> bool:
+        return self.data is not None and image_name in self.index
+
+    def is_current(self, image_name: str, path: str) -> bool:
+        """
+        Tell if the pool holds an image and the image was not modified since it was packed.
+
+        Parameters:
+        image_name (str): The name of the image in the database.
+        path (str): The path to the image.
+
+        Returns:
+        bool: True if the levels in the pool can be used for the image.
+        """
+        return image_name in self and os.path.exists(path) and self.index[image_name]['modified'] == os.path.getmtime(path)
+
+    def get_level(self, image_name: str, min_size: Tuple[int, int] = None) -> Tuple[np.ndarray, int]:
+        """
+        Get the smallest level of an image that covers a size, see choose_pyramid_level.
+
+        Parameters:
+        image_name (str): The name of the image in the database.
+        min_size (Tuple[int, int]): The size the level will be scaled to cover. The largest level is returned if not given.
+
+        Returns:
+        Tuple[np.ndarray, int]: The read-only RGB view (H, W, 3) and the level.
+        """
+        level = choose_pyramid_level(self.sizes[image_name], min_size) if min_size is not None else 0
+        offset, width, height = self.index[image_name]['levels'][level]
+        return self.data[offset:offset + width * height * 3].reshape(height, width, 3), level
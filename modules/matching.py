@@ -0,0 +1,792 @@
+from PIL import Image, ImageDraw
+from typing import List, Tuple
+import numpy as np
+from .utils import *
+from .caches import rhombus_template_vertices
+import hashlib, json, math, os
+
+# Bounds of the colors of each matching space, every sRGB color falls inside
+COLOR_SPACE_BOUNDS = {
+    'rgb': (np.array([0.0, 0.0, 0.0]), np.array([256.0, 256.0, 256.0])),
+    'lab': (np.array([0.0, -128.0, -128.0]), np.array([101.0, 128.0, 128.0])),
+}
+
+def group_ties(features: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Group the database images with identical features, a tile matched to a group gets a random image of it.
+
+    Parameters:
+    features (np.ndarray): The features (N, D) of the images.
+
+    Returns:
+    Tuple[np.ndarray, np.ndarray, np.ndarray]: The distinct features (G, D), the images ordered by group (N,)
+    and the start of every group in that order (G + 1,).
+    """
+    unique_features, group_of_image = np.unique(features, axis=0, return_inverse=True)
+    group_of_image = group_of_image.ravel()
+    group_members = np.argsort(group_of_image, kind='stable')
+    group_starts = np.concatenate(([0], np.cumsum(np.bincount(group_of_image, minlength=len(unique_features)))))
+    return unique_features, group_members, group_starts
+
+def pick_group_members(groups: np.ndarray, group_members: np.ndarray, group_starts: np.ndarray, rng: np.random.Generator = None) -> np.ndarray:
+    """
+    Pick a random image of every matched tie group.
+
+    Parameters:
+    groups (np.ndarray): The matched groups (M,).
+    group_members (np.ndarray): The images ordered by group, see group_ties.
+    group_starts (np.ndarray): The start of every group, see group_ties.
+    rng (np.random.Generator): The random generator used to break ties.
+
+    Returns:
+    np.ndarray: The index (M,) of the chosen images.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    group_sizes = group_starts[groups + 1] - group_starts[groups]
+    picks = (rng.random(len(groups)) * group_sizes).astype(np.int64)
+    return group_members[group_starts[groups] + picks]
+
+# Crop classes: class = shape * 10 + orientation, see classify_rhombi
+CROP_CLASSES = len(SHAPE_NAMES) * 10
+
+def find_crop_masks(size: Tuple[int, int]) -> List[Tuple[np.ndarray, float, float]]:
+    """
+    Find the crop that a tile of every shape and orientation keeps from an image of the given size.
+    replace_slices scales the image to cover the bounding box of the tile and masks the rhombus from the
+    top-left corner, so the crop only depends on the class of the tile and not on its size.
+
+    Parameters:
+    size (Tuple[int, int]): The size of the image.
+
+    Returns:
+    List[Tuple[np.ndarray, float, float]]: The rhombus mask (height, width) and the width and height of its
+    bounding box in image pixels, by crop class.
+    """
+    width, height = size
+    crops = []
+    for shape in range(len(SHAPE_NAMES)):
+        for orientation in range(10):
+            vertices = rhombus_template_vertices(shape, orientation, 1.0)
+            vertices = vertices - complex(vertices.real.min(), vertices.imag.min())
+            # Same cover scale as replace_slices
+            vertices = vertices / max(vertices.real.max() / width, vertices.imag.max() / height)
+            mask = Image.new('L', size, 0)
+            ImageDraw.Draw(mask).polygon([(v.real, v.imag) for v in vertices], fill=255)
+            crops.append((np.asarray(mask) > 0, vertices.real.max(), vertices.imag.max()))
+    return crops
+
+def calculate_crop_colors(image: Image.Image, max_side: int = 256) -> np.ndarray:
+    """
+    Calculate the average color of the crop that a tile of every shape and orientation keeps from an image, see find_crop_masks.
+
+    Parameters:
+    image (Image.Image): The database image.
+    max_side (int): The image is reduced to this size before measuring.
+
+    Returns:
+    np.ndarray: The colors (CROP_CLASSES, 3), by crop class.
+    """
+    reduced = image.convert('RGB')
+    reduced.thumbnail((max_side, max_side), Image.Resampling.BOX)
+    pixels = np.asarray(reduced, dtype=np.float64)
+    colors = np.empty((CROP_CLASSES, 3))
+    for crop_class, (inside, _, _) in enumerate(find_crop_masks(reduced.size)):
+        colors[crop_class] = pixels[inside].mean(axis=0) if inside.any() else pixels.reshape(-1, 3).mean(axis=0)
+    return colors
+
+def calculate_crop_grid_colors(image: Image.Image, max_side: int = 256) -> np.ndarray:
+    """
+    Calculate the average color of each cell of a GRID_CELLS x GRID_CELLS grid over the crop that a tile of every
+    shape and orientation keeps from an image, see find_crop_masks. Like the grid of the tile, see calculate_tile_colors,
+    the grid splits the bounding box of the rhombus and only the pixels inside the rhombus count.
+
+    Parameters:
+    image (Image.Image): The database image.
+    max_side (int): The image is reduced to this size before measuring.
+
+    Returns:
+    np.ndarray: The colors (CROP_CLASSES * GRID_CELLS ** 2, 3), GRID_CELLS ** 2 rows per crop class, row by row.
+    """
+    reduced = image.convert('RGB')
+    reduced.thumbnail((max_side, max_side), Image.Resampling.BOX)
+    pixels = np.asarray(reduced, dtype=np.float64).reshape(-1, 3)
+    ys, xs = np.indices((reduced.size[1], reduced.size[0])).reshape(2, -1)
+    colors = np.empty((CROP_CLASSES, GRID_CELLS ** 2, 3))
+    for crop_class, (inside, crop_width, crop_height) in enumerate(find_crop_masks(reduced.size)):
+        inside = inside.ravel()
+        if not inside.any():
+            colors[crop_class] = pixels.mean(axis=0)
+            continue
+        columns = np.clip(((xs[inside] + 0.5) * GRID_CELLS // crop_width).astype(np.int64), 0, GRID_CELLS - 1)
+        rows = np.clip(((ys[inside] + 0.5) * GRID_CELLS // crop_height).astype(np.int64), 0, GRID_CELLS - 1)
+        cells = rows * GRID_CELLS + columns
+        counts = np.bincount(cells, minlength=GRID_CELLS ** 2)
+        sums = np.stack([np.bincount(cells, weights=pixels[inside, channel], minlength=GRID_CELLS ** 2) for channel in range(3)], axis=1)
+        # Empty cells get the color of the whole crop, like the empty cells of a tile
+        with np.errstate(invalid='ignore', divide='ignore'):
+            colors[crop_class] = np.where(counts[:, None] > 0, sums / counts[:, None], pixels[inside].mean(axis=0))
+    return colors.reshape(-1, 3)
+
+class ColorMatcher:
+    """
+    Nearest color matcher over the image database.
+    The database colors are loaded into an (N, 3) array once, in RGB or in CIELAB for perceptual
+    matching. Images with the same color form a tie group, and the distinct colors are indexed by a
+    coarse grid over the color space: every cell keeps the colors that can be the nearest one for
+    some point of the cell, so a batch of tile colors is resolved with one small distance matrix
+    per occupied cell.
+    With a match LUT (see build_match_lut) the grid is not built and every tile is a single lookup.
+    """
+
+    def __init__(self, image_database: dict, color_space: str = 'rgb', features: dict = None, lut: np.ndarray = None, cells_per_axis: int = 8):
+        """
+        Parameters:
+        image_database (dict): A dict with the available images, {image name: (r, g, b, color_variance)}.
+        color_space (str): The space the distances are measured in, 'rgb' or 'lab'.
+        features (dict): The stored features of the database, see load_database_features. Missing ones are computed.
+        lut (np.ndarray): The match LUT of this database, see load_match_lut.
+        cells_per_axis (int): The number of grid cells along each color axis.
+        """
+        if not image_database:
+            raise ValueError('The image database is empty')
+        if color_space not in COLOR_SPACE_BOUNDS:
+            raise ValueError(f'Unknown color space {color_space}')
+        self.names = list(image_database.keys())
+        self.color_space = color_space
+        self.colors = np.array([color[:3] for color in image_database.values()], dtype=np.float64)
+        if features and color_space in features:
+            self.features = np.asarray(features[color_space], dtype=np.float64)
+        else:
+            self.features = self.to_color_space(self.colors)
+        # Tie groups: the images of group g are group_members[group_starts[g]:group_starts[g + 1]]
+        self.unique_colors, self.group_members, self.group_starts = group_ties(self.features)
+        self.squared_norms = (self.unique_colors ** 2).sum(axis=1)
+        self.cells_per_axis = cells_per_axis
+        self.low, high = COLOR_SPACE_BOUNDS[color_space]
+        self.cell_size = (high - self.low) / cells_per_axis
+        self.lut = lut
+        self.cell_candidates = self.build_grid() if lut is None else None
+        # Built on the first call to candidates
+        self.candidate_index = None
+
+    def to_color_space(self, colors: np.ndarray) -> np.ndarray:
+        """
+        Convert RGB colors to the matching space.
+
+        Parameters:
+        colors (np.ndarray): The colors (..., 3), 0 to 255.
+
+        Returns:
+        np.ndarray: The colors (..., 3) in the matching space.
+        """
+        if self.color_space == 'lab':
+            return rgb_to_lab(colors)
+        return np.asarray(colors, dtype=np.float64)
+
+    def build_grid(self) -> List[np.ndarray]:
+        """
+        Find the candidate colors of every grid cell.
+        A color is a candidate when its distance to the cell is not larger than the distance within
+        which some color is guaranteed for every point of the cell.
+
+        Returns:
+        List[np.ndarray]: The indices of the candidate colors of every cell, in cell order.
+        """
+        candidates = []
+        steps = [self.low[axis] + np.arange(self.cells_per_axis) * self.cell_size[axis] for axis in range(3)]
+        for low in np.stack(np.meshgrid(*steps, indexing='ij'), axis=-1).reshape(-1, 3):
+            high = low + self.cell_size
+            nearest_point = np.clip(self.unique_colors, low, high)
+            min_distance = np.sqrt(((self.unique_colors - nearest_point) ** 2).sum(axis=1))
+            farthest_point = np.where(self.unique_colors - low > high - self.unique_colors, low, high)
+            max_distance = np.sqrt(((self.unique_colors - farthest_point) ** 2).sum(axis=1))
+            candidates.append(np.flatnonzero(min_distance <= max_distance.min()))
+        return candidates
+
+    def nearest_groups(self, colors: np.ndarray) -> np.ndarray:
+        """
+        Find the nearest database color of every tile color in one batched query.
+
+        Parameters:
+        colors (np.ndarray): The tile colors (M, 3), in RGB.
+
+        Returns:
+        np.ndarray: The tie group (M,) of the nearest database color.
+        """
+        if self.lut is not None:
+            # The LUT has 2 ** bits cells per axis
+            shift = 8 - int(round(np.log2(self.lut.shape[0])))
+            cells = np.clip(np.asarray(colors, dtype=np.int64).reshape(-1, 3), 0, 255) >> shift
+            return self.lut[cells[:, 0], cells[:, 1], cells[:, 2]].astype(np.int64)
+        # Tiles share colors, only look up every distinct color once
+        query_colors, query_of_tile = np.unique(np.asarray(colors, dtype=np.float64).reshape(-1, 3), axis=0, return_inverse=True)
+        query_colors = self.to_color_space(query_colors)
+        cells = np.clip(((query_colors - self.low) // self.cell_size).astype(np.int64), 0, self.cells_per_axis - 1)
+        cell_ids = (cells[:, 0] * self.cells_per_axis + cells[:, 1]) * self.cells_per_axis + cells[:, 2]
+        groups = np.empty(len(query_colors), dtype=np.int64)
+        for cell_id in np.unique(cell_ids):
+            in_cell = np.flatnonzero(cell_ids == cell_id)
+            candidates = self.cell_candidates[cell_id]
+            # |q - c|^2 without the |q|^2 term, which does not change the nearest color
+            distances = self.squared_norms[candidates] - 2 * query_colors[in_cell] @ self.unique_colors[candidates].T
+            groups[in_cell] = candidates[distances.argmin(axis=1)]
+        return groups[query_of_tile.ravel()]
+
+    def match(self, colors: np.ndarray, rng: np.random.Generator = None) -> np.ndarray:
+        """
+        Match every tile color to a random image among the ones with the nearest color.
+
+        Parameters:
+        colors (np.ndarray): The tile colors (M, 3), in RGB.
+        rng (np.random.Generator): The random generator used to break ties.
+
+        Returns:
+        np.ndarray: The index (M,) of the chosen image in self.names.
+        """
+        return pick_group_members(self.nearest_groups(colors), self.group_members, self.group_starts, rng)
+
+    def match_tiles(self, tile_colors: Tile_colors, rng: np.random.Generator = None, tile_classes: np.ndarray = None) -> np.ndarray:
+        """
+        Match every tile by its mean color, see match.
+
+        Parameters:
+        tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+        rng (np.random.Generator): The random generator used to break ties.
+        tile_classes (np.ndarray): Not used, the mean color of the whole image is compared for every class.
+
+        Returns:
+        np.ndarray: The index (M,) of the chosen image in self.names.
+        """
+        return self.match(tile_colors[0], rng)
+
+    def candidates(self, tile_colors: Tile_colors, count: int, tile_classes: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest images of every tile by its mean color, for an assignment stage that cannot always use the nearest one.
+
+        Parameters:
+        tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+        count (int): The images found per tile.
+        tile_classes (np.ndarray): Not used, see match_tiles.
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: The images (M, count) in self.names, nearest first, and their squared distances (M, count).
+        """
+        if self.candidate_index is None:
+            self.candidate_index = IVFIndex(self.features)
+        return self.candidate_index.search_candidates(self.to_color_space(tile_colors[0]), count)
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, rng: np.random.Generator = None, chunk_size: int = 4096) -> np.ndarray:
+    """
+    Cluster vectors with Lloyd's k-means, starting from random vectors.
+
+    Parameters:
+    vectors (np.ndarray): The vectors (N, D).
+    clusters (int): The number of clusters, at most N.
+    iterations (int): The number of assignment and update steps.
+    rng (np.random.Generator): The random generator for the initial centroids.
+    chunk_size (int): The vectors assigned at once, bounds the size of the distance matrix.
+
+    Returns:
+    np.ndarray: The centroids (clusters, D).
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_rows(vectors, centroids, chunk_size)
+        counts = np.bincount(assignments, minlength=clusters)
+        sums = np.stack([np.bincount(assignments, weights=vectors[:, axis], minlength=clusters) for axis in range(vectors.shape[1])], axis=1)
+        # Empty clusters keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+def nearest_rows(queries: np.ndarray, rows: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+    """
+    Find the nearest row of every query by brute force, in chunks of queries.
+
+    Parameters:
+    queries (np.ndarray): The queries (M, D).
+    rows (np.ndarray): The rows (N, D).
+    chunk_size (int): The queries compared at once.
+
+    Returns:
+    np.ndarray: The index (M,) of the nearest row.
+    """
+    squared_norms = (rows ** 2).sum(axis=1)
+    nearest = np.empty(len(queries), dtype=np.int64)
+    for start in range(0, len(queries), chunk_size):
+        # |q - r|^2 without the |q|^2 term, which does not change the nearest row
+        distances = squared_norms - 2 * queries[start:start + chunk_size] @ rows.T
+        nearest[start:start + chunk_size] = distances.argmin(axis=1)
+    return nearest
+
+class IVFIndex:
+    """
+    Approximate nearest neighbor index with an inverted file: the vectors are split into lists by
+    their nearest k-means centroid, and a query only compares the vectors of the n_probe lists with
+    the nearest centroids. Small sets use a single list, which makes the search exact.
+    """
+
+    def __init__(self, vectors: np.ndarray, lists: int = None, n_probe: int = 4, iterations: int = 10, rng: np.random.Generator = None):
+        """
+        Parameters:
+        vectors (np.ndarray): The indexed vectors (N, D).
+        lists (int): The number of lists, about 4 * sqrt(N) if not given.
+        n_probe (int): The lists searched per query.
+        iterations (int): The k-means iterations.
+        rng (np.random.Generator): The random generator for k-means.
+        """
+        self.vectors = np.asarray(vectors, dtype=np.float64)
+        self.squared_norms = (self.vectors ** 2).sum(axis=1)
+        if lists is None:
+            lists = 1 if len(self.vectors) <= 4096 else int(4 * math.sqrt(len(self.vectors)))
+        lists = max(1, min(lists, len(self.vectors)))
+        rng = rng if rng is not None else np.random.default_rng(0)
+        if lists == 1:
+            self.centroids = self.vectors.mean(axis=0, keepdims=True)
+        else:
+            # Train on a sample, the centroids do not need every vector
+            sample = self.vectors[rng.choice(len(self.vectors), min(len(self.vectors), 32 * lists), replace=False)]
+            self.centroids = kmeans(sample, lists, iterations, rng)
+        list_of_vector = nearest_rows(self.vectors, self.centroids)
+        self.list_members = np.argsort(list_of_vector, kind='stable')
+        self.list_starts = np.concatenate(([0], np.cumsum(np.bincount(list_of_vector, minlength=lists))))
+        self.n_probe = min(n_probe, lists)
+
+    def search(self, queries: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+        """
+        Find the (approximately) nearest vector of every query.
+
+        Parameters:
+        queries (np.ndarray): The queries (M, D).
+        chunk_size (int): The queries compared with one list at once.
+
+        Returns:
+        np.ndarray: The index (M,) of the nearest vector found.
+        """
+        return self.search_candidates(queries, 1, chunk_size)[0][:, 0]
+
+    def search_candidates(self, queries: np.ndarray, count: int, chunk_size: int = 4096) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the (approximately) nearest vectors of every query.
+
+        Parameters:
+        queries (np.ndarray): The queries (M, D).
+        count (int): The vectors found per query, at most the number of vectors.
+        chunk_size (int): The queries compared with one list at once.
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: The indices (M, count) of the vectors found, nearest first, -1 when a query
+        found fewer, and their squared distances (M, count).
+        """
+        queries = np.asarray(queries, dtype=np.float64)
+        count = min(count, len(self.vectors))
+        centroid_distances = (self.centroids ** 2).sum(axis=1) - 2 * queries @ self.centroids.T
+        if self.n_probe < len(self.centroids):
+            probes = np.argpartition(centroid_distances, self.n_probe - 1, axis=1)[:, :self.n_probe]
+        else:
+            probes = np.broadcast_to(np.arange(len(self.centroids)), centroid_distances.shape)
+        # Visit the (query, list) pairs list by list
+        pair_queries = np.repeat(np.arange(len(queries)), probes.shape[1])
+        pair_lists = probes.ravel()
+        order = np.argsort(pair_lists, kind='stable')
+        pair_queries, pair_lists = pair_queries[order], pair_lists[order]
+        pair_starts = np.searchsorted(pair_lists, np.arange(len(self.centroids) + 1))
+        query_norms = (queries ** 2).sum(axis=1)
+        best_distances = np.full((len(queries), count), np.inf)
+        best = np.full((len(queries), count), -1, dtype=np.int64)
+        for list_id in np.flatnonzero(np.diff(pair_starts)):
+            members = self.list_members[self.list_starts[list_id]:self.list_starts[list_id + 1]]
+            if len(members) == 0:
+                continue
+            for start in range(pair_starts[list_id], pair_starts[list_id + 1], chunk_size):
+                in_list = pair_queries[start:min(start + chunk_size, pair_starts[list_id + 1])]
+                distances = query_norms[in_list, None] + self.squared_norms[members] - 2 * queries[in_list] @ self.vectors[members].T
+                if len(members) > count:
+                    nearest = np.argpartition(distances, count - 1, axis=1)[:, :count]
+                    distances = np.take_along_axis(distances, nearest, axis=1)
+                else:
+                    nearest = np.broadcast_to(np.arange(len(members)), distances.shape)
+                # Merge with what the query found in its other lists
+                merged_distances = np.concatenate((best_distances[in_list], distances), axis=1)
+                merged = np.concatenate((best[in_list], members[nearest]), axis=1)
+                keep = np.argpartition(merged_distances, count - 1, axis=1)[:, :count]
+                best_distances[in_list] = np.take_along_axis(merged_distances, keep, axis=1)
+                best[in_list] = np.take_along_axis(merged, keep, axis=1)
+        order = np.argsort(best_distances, axis=1, kind='stable')
+        return np.take_along_axis(best, order, axis=1), np.maximum(np.take_along_axis(best_distances, order, axis=1), 0)
+
+class DescriptorMatcher:
+    """
+    Matcher over spatial color descriptors: the mean colors of a GRID_CELLS x GRID_CELLS grid over
+    the bounding box of the tile, compared with the same grid over the crop of each database image that
+    a tile of its shape and orientation keeps, see calculate_crop_grid_colors. A tile with a dark half and
+    a light half then gets an image with the same split instead of a flat one.
+    Like CropColorMatcher there is one set of descriptors per crop class, each searched with an IVFIndex
+    built the first time a tile of the class is matched, so it stays fast for large databases.
+    """
+
+    def __init__(self, image_database: dict, color_space: str = 'rgb', features: dict = None, image_folder: str = None, n_probe: int = 4):
+        """
+        Parameters:
+        image_database (dict): A dict with the available images, {image name: (r, g, b, color_variance)}.
+        color_space (str): The space the distances are measured in, 'rgb' or 'lab'.
+        features (dict): The stored features of the database, see load_database_features.
+        image_folder (str): The folder with the database images, used when the grid features are not given.
+        n_probe (int): The index lists searched per tile, see IVFIndex.
+        """
+        if not image_database:
+            raise ValueError('The image database is empty')
+        if color_space not in COLOR_SPACE_BOUNDS:
+            raise ValueError(f'Unknown color space {color_space}')
+        self.names = list(image_database.keys())
+        self.color_space = color_space
+        # Features stored before the grid followed the crop of every class have GRID_CELLS ** 2 rows
+        if not features or 'grid' not in features or np.shape(features['grid'])[1] != CROP_CLASSES * GRID_CELLS ** 2:
+            if image_folder is None:
+                raise ValueError('The grid features are missing and there is no image folder to calculate them from')
+            features = calculate_database_features(image_database, image_folder)
+        grid = np.asarray(features['grid'], dtype=np.float64).reshape(len(self.names), CROP_CLASSES, GRID_CELLS ** 2, 3)
+        self.features = [self.to_descriptors(grid[:, crop_class]) for crop_class in range(CROP_CLASSES)]
+        self.n_probe = n_probe
+        # Built on the first tile of every class, see class_index
+        self.indexes = {}
+        self.candidate_indexes = {}
+
+    def to_descriptors(self, grid_colors: np.ndarray) -> np.ndarray:
+        """
+        Flatten grid colors into descriptors in the matching space.
+
+        Parameters:
+        grid_colors (np.ndarray): The grid colors (M, GRID_CELLS ** 2, 3), in RGB.
+
+        Returns:
+        np.ndarray: The descriptors (M, GRID_CELLS ** 2 * 3).
+        """
+        if self.color_space == 'lab':
+            grid_colors = rgb_to_lab(grid_colors)
+        return np.asarray(grid_colors, dtype=np.float64).reshape(len(grid_colors), -1)
+
+    def class_index(self, crop_class: int) -> Tuple[IVFIndex, np.ndarray, np.ndarray]:
+        """
+        Get the index over the distinct descriptors of a crop class, with their tie groups, see group_ties.
+
+        Parameters:
+        crop_class (int): The crop class, shape * 10 + orientation.
+
+        Returns:
+        Tuple[IVFIndex, np.ndarray, np.ndarray]: The index, the images ordered by group and the start of every group.
+        """
+        if crop_class not in self.indexes:
+            unique_descriptors, group_members, group_starts = group_ties(self.features[crop_class])
+            self.indexes[crop_class] = (IVFIndex(unique_descriptors, n_probe=self.n_probe), group_members, group_starts)
+        return self.indexes[crop_class]
+
+    def match_tiles(self, tile_colors: Tile_colors, rng: np.random.Generator = None, tile_classes: np.ndarray = None) -> np.ndarray:
+        """
+        Match every tile by its grid colors to a random image among the ones whose crop of the tile class has the nearest descriptor.
+
+        Parameters:
+        tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+        rng (np.random.Generator): The random generator used to break ties.
+        tile_classes (np.ndarray): The crop class (M,) of every tile, shape * 10 + orientation.
+
+        Returns:
+        np.ndarray: The index (M,) of the chosen image in self.names.
+        """
+        if tile_classes is None:
+            raise ValueError('The grid matcher needs the class of every tile')
+        descriptors = self.to_descriptors(tile_colors[3])
+        matches = np.empty(len(tile_classes), dtype=np.int64)
+        for crop_class in np.unique(tile_classes):
+            in_class = np.flatnonzero(tile_classes == crop_class)
+            index, group_members, group_starts = self.class_index(crop_class)
+            matches[in_class] = pick_group_members(index.search(descriptors[in_class]), group_members, group_starts, rng)
+        return matches
+
+    def candidates(self, tile_colors: Tile_colors, count: int, tile_classes: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest images of every tile by its grid colors, see ColorMatcher.candidates.
+
+        Parameters:
+        tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+        count (int): The images found per tile.
+        tile_classes (np.ndarray): The crop class (M,) of every tile, shape * 10 + orientation.
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: The images (M, count) in self.names, nearest first, and their squared distances (M, count).
+        """
+        if tile_classes is None:
+            raise ValueError('The grid matcher needs the class of every tile')
+        descriptors = self.to_descriptors(tile_colors[3])
+        count = min(count, len(self.names))
+        images = np.empty((len(tile_classes), count), dtype=np.int64)
+        distances = np.empty((len(tile_classes), count))
+        for crop_class in np.unique(tile_classes):
+            in_class = np.flatnonzero(tile_classes == crop_class)
+            if crop_class not in self.candidate_indexes:
+                self.candidate_indexes[crop_class] = IVFIndex(self.features[crop_class])
+            images[in_class], distances[in_class] = self.candidate_indexes[crop_class].search_candidates(descriptors[in_class], count)
+        return images, distances
+
+class CropColorMatcher:
+    """
+    Matcher over the colors of the crops the tiles actually keep, see calculate_crop_colors.
+    There is one ColorMatcher per crop class, and every tile is compared with the crop of its own class.
+    """
+
+    def __init__(self, image_database: dict, color_space: str = 'rgb', features: dict = None, image_folder: str = None):
+        """
+        Parameters:
+        image_database (dict): A dict with the available images, {image name: (r, g, b, color_variance)}.
+        color_space (str): The space the distances are measured in, 'rgb' or 'lab'.
+        features (dict): The stored features of the database, see load_database_features.
+        image_folder (str): The folder with the database images, used when the crop features are not given.
+        """
+        if not image_database:
+            raise ValueError('The image database is empty')
+        self.names = list(image_database.keys())
+        if not features or 'crop' not in features:
+            if image_folder is None:
+                raise ValueError('The crop features are missing and there is no image folder to calculate them from')
+            features = calculate_database_features(image_database, image_folder)
+        crop_colors = np.asarray(features['crop'], dtype=np.float64)
+        if color_space == 'lab':
+            crop_colors = rgb_to_lab(crop_colors)
+        self.matchers = [ColorMatcher(image_database, color_space, {color_space: crop_colors[:, crop_class]}) for crop_class in range(CROP_CLASSES)]
+
+    def match_tiles(self, tile_colors: Tile_colors, rng: np.random.Generator = None, tile_classes: np.ndarray = None) -> np.ndarray:
+        """
+        Match every tile by its mean color to a random image among the ones whose crop of the tile class has the nearest color.
+
+        Parameters:
+        tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+        rng (np.random.Generator): The random generator used to break ties.
+        tile_classes (np.ndarray): The crop class (M,) of every tile, shape * 10 + orientation.
+
+        Returns:
+        np.ndarray: The index (M,) of the chosen image in self.names.
+        """
+        if tile_classes is None:
+            raise ValueError('The crop matcher needs the class of every tile')
+        matches = np.empty(len(tile_classes), dtype=np.int64)
+        for crop_class in np.unique(tile_classes):
+            in_class = np.flatnonzero(tile_classes == crop_class)
+            matches[in_class] = self.matchers[crop_class].match(tile_colors[0][in_class], rng)
+        return matches
+
+    def candidates(self, tile_colors: Tile_colors, count: int, tile_classes: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the images whose crop of the tile class is nearest to the mean color of every tile, see ColorMatcher.candidates.
+
+        Parameters:
+        tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+        count (int): The images found per tile.
+        tile_classes (np.ndarray): The crop class (M,) of every tile, shape * 10 + orientation.
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: The images (M, count) in self.names, nearest first, and their squared distances (M, count).
+        """
+        if tile_classes is None:
+            raise ValueError('The crop matcher needs the class of every tile')
+        count = min(count, len(self.names))
+        images = np.empty((len(tile_classes), count), dtype=np.int64)
+        distances = np.empty((len(tile_classes), count))
+        for crop_class in np.unique(tile_classes):
+            in_class = np.flatnonzero(tile_classes == crop_class)
+            images[in_class], distances[in_class] = self.matchers[crop_class].candidates((tile_colors[0][in_class],), count)
+        return images, distances
+
+def create_matcher(image_database: dict, color_space: str = 'rgb', match_mode: str = 'color', features: dict = None, lut: np.ndarray = None, image_folder: str = None):
+    """
+    Create the matcher of a matching mode.
+
+    Parameters:
+    image_database (dict): A dict with the available images.
+    color_space (str): The space the distances are measured in, 'rgb' or 'lab'.
+    match_mode (str): 'color' matches the mean color (fast), 'crop' matches the color of the crop each tile keeps
+    and 'grid' matches the spatial color descriptors.
+    features (dict): The stored features of the database, see load_database_features.
+    lut (np.ndarray): The match LUT of the database, only used by the 'color' mode.
+    image_folder (str): The folder with the database images, used when the grid features are not given.
+
+    Returns:
+    ColorMatcher, CropColorMatcher or DescriptorMatcher: The matcher.
+    """
+    if match_mode == 'color':
+        return ColorMatcher(image_database, color_space, features, lut)
+    if match_mode == 'crop':
+        return CropColorMatcher(image_database, color_space, features, image_folder)
+    if match_mode == 'grid':
+        return DescriptorMatcher(image_database, color_space, features, image_folder)
+    raise ValueError(f'Unknown match mode {match_mode}')
+
+def hash_image_database(image_database: dict) -> str:
+    """
+    Hash the contents of the image database, independently of the order of the entries.
+
+    Parameters:
+    image_database (dict): A dict with the available images.
+
+    Returns:
+    str: The hex digest.
+    """
+    return hashlib.sha1(json.dumps(sorted(image_database.items())).encode()).hexdigest()
+
+def get_match_lut_path(database_path: str) -> str:
+    """
+    Get the path of the match LUT that goes with a database json.
+
+    Parameters:
+    database_path (str): The path to the database.
+
+    Returns:
+    str: The path to the LUT file.
+    """
+    return os.path.splitext(database_path)[0] + '_lut.npz'
+
+def build_match_lut(image_database: dict, bits: int = 6, color_space: str = 'rgb', features: dict = None) -> np.ndarray:
+    """
+    Build the match LUT of a database: the nearest tie group of the center of every cell of a
+    quantized RGB grid. Matching through the LUT is off by at most half a cell per channel.
+
+    Parameters:
+    image_database (dict): A dict with the available images.
+    bits (int): The bits kept per channel, the LUT has (2 ** bits) ** 3 cells.
+    color_space (str): The space the distances are measured in, see ColorMatcher.
+    features (dict): The stored features of the database, see load_database_features.
+
+    Returns:
+    np.ndarray: The tie groups (2 ** bits, 2 ** bits, 2 ** bits), see ColorMatcher.
+    """
+    matcher = ColorMatcher(image_database, color_space, features)
+    cells = 2 ** bits
+    centers = (np.arange(cells) + 0.5) * (256 / cells)
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1).reshape(-1, 3)
+    return matcher.nearest_groups(grid).astype(np.int32).reshape(cells, cells, cells)
+
+def save_match_lut(lut: np.ndarray, image_database: dict, database_path: str, color_space: str = 'rgb') -> None:
+    """
+    Save the match LUT next to the database json, with the hash of the database it was built for.
+
+    Parameters:
+    lut (np.ndarray): The match LUT.
+    image_database (dict): The database the LUT was built for.
+    database_path (str): The path to the database.
+    color_space (str): The space the LUT was built in.
+    """
+    with open(get_match_lut_path(database_path), 'wb') as file:
+        np.savez(file, lut=lut, database_hash=hash_image_database(image_database), color_space=color_space)
+
+def load_match_lut(image_database: dict, database_path: str, color_space: str = 'rgb') -> np.ndarray:
+    """
+    Load the match LUT of the database, if there is one and it was built for these contents.
+
+    Parameters:
+    image_database (dict): The current database.
+    database_path (str): The path to the database.
+    color_space (str): The space the LUT has to be built in.
+
+    Returns:
+    np.ndarray: The match LUT, None if it is missing or stale.
+    """
+    lut_path = get_match_lut_path(database_path)
+    if not os.path.exists(lut_path):
+        return None
+    with np.load(lut_path) as data:
+        if 'color_space' not in data.files or str(data['color_space']) != color_space:
+            return None
+        if str(data['database_hash']) != hash_image_database(image_database):
+            return None
+        return data['lut']
+
+def get_features_path(database_path: str) -> str:
+    """
+    Get the path of the feature file that goes with a database json.
+
+    Parameters:
+    database_path (str): The path to the database.
+
+    Returns:
+    str: The path to the feature file.
+    """
+    return os.path.splitext(database_path)[0] + '_features.npz'
+
+def calculate_database_features(image_database: dict, image_folder: str = None, previous: dict = None) -> dict:
+    """
+    Calculate the matching features of the database images.
+
+    Parameters:
+    image_database (dict): A dict with the available images.
+    image_folder (str): The folder with the database images, the grid features are only calculated if given.
+    previous (dict): Features to reuse, see load_database_features with check_hash=False. Rows with NaN are recalculated.
+
+    Returns:
+    dict: The feature arrays by name, one row per image in database order. 'lab' (N, 3) holds the CIELAB average colors,
+    'grid' (N, CROP_CLASSES * GRID_CELLS ** 2, 3) the grid colors of the crops, see calculate_crop_grid_colors, and
+    'crop' (N, CROP_CLASSES, 3) the crop colors, see calculate_crop_colors.
+    """
+    colors = np.array([color[:3] for color in image_database.values()], dtype=np.float64).reshape(-1, 3)
+    features = {'lab': rgb_to_lab(colors)}
+    if image_folder is not None:
+        image_features = {'grid': (calculate_crop_grid_colors, CROP_CLASSES * GRID_CELLS ** 2), 'crop': (calculate_crop_colors, CROP_CLASSES)}
+        for key, (_, rows) in image_features.items():
+            features[key] = np.full((len(colors), rows, 3), np.nan)
+            if previous and key in previous and previous[key].shape[1:] == features[key].shape[1:]:
+                features[key][:] = previous[key]
+        names = list(image_database.keys())
+        missing = np.zeros(len(colors), dtype=bool)
+        for key in image_features:
+            missing |= np.isnan(features[key]).any(axis=(1, 2))
+        for row in np.flatnonzero(missing):
+            try:
+                with Image.open(os.path.join(image_folder, names[row])) as img:
+                    for key, (calculate, _) in image_features.items():
+                        features[key][row] = calculate(img)
+            except IOError:
+                # Flat features with the mean color
+                for key in image_features:
+                    features[key][row] = colors[row]
+    return features
+
+def save_database_features(features: dict, image_database: dict, database_path: str) -> None:
+    """
+    Save the features of the database next to the database json.
+
+    Parameters:
+    features (dict): The feature arrays, see calculate_database_features.
+    image_database (dict): The database the features were calculated for.
+    database_path (str): The path to the database.
+    """
+    with open(get_features_path(database_path), 'wb') as file:
+        np.savez(file, names=np.array(list(image_database.keys()), dtype=str), database_hash=hash_image_database(image_database), **features)
+
+def load_database_features(image_database: dict, database_path: str, check_hash: bool = True) -> dict:
+    """
+    Load the features of the database, in the order of the current database.
+
+    Parameters:
+    image_database (dict): The current database.
+    database_path (str): The path to the database.
+    check_hash (bool): Only return features calculated for these exact contents. If False, the rows of the images
+    the file does not know are NaN, so they can be recalculated.
+
+    Returns:
+    dict: The feature arrays, empty if they are missing or were calculated for other contents.
+    """
+    features_path = get_features_path(database_path)
+    if not os.path.exists(features_path):
+        return {}
+    with np.load(features_path) as data:
+        if check_hash and str(data['database_hash']) != hash_image_database(image_database):
+            return {}
+        row_of_name = {name: row for row, name in enumerate(data['names'].tolist())}
+        rows = np.array([row_of_name.get(name, -1) for name in image_database.keys()], dtype=np.int64)
+        features = {}
+        for key in data.files:
+            if key in ('names', 'database_hash'):
+                continue
+            values = data[key]
+            features[key] = np.full((len(rows),) + values.shape[1:], np.nan)
+            features[key][rows >= 0] = values[rows[rows >= 0]]
+        return features
@@ -0,0 +1,83 @@
+from typing import Tuple
+import numpy as np
+import struct, zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color types by number of channels
+PNG_COLOR_TYPES = {3: 2, 4: 6}
+
+class PngStreamWriter:
+    """
+    Write a PNG a few rows at a time, so an image taller than memory can be saved band by band.
+    Every row uses the Up filter, the difference with the row above, which compresses smooth images well.
+    """
+
+    def __init__(self, path: str, size: Tuple[int, int], channels: int = 4, compression: int = 6, chunk_bytes: int = 2 ** 20):
+        """
+        Parameters:
+        path (str): The path to the PNG.
+        size (Tuple[int, int]): The (width, height) of the image.
+        channels (int): 3 for RGB, 4 for RGBA.
+        compression (int): The zlib compression level.
+        chunk_bytes (int): The compressed bytes buffered before an IDAT chunk is written.
+        """
+        self.size = size
+        self.channels = channels
+        self.chunk_bytes = chunk_bytes
+        self.rows_written = 0
+        self.previous_row = np.zeros((size[0], channels), dtype=np.uint8)
+        self.compressor = zlib.compressobj(compression)
+        self.pending = b''
+        self.file = open(path, 'wb')
+        self.file.write(PNG_SIGNATURE)
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, PNG_COLOR_TYPES[channels], 0, 0, 0))
+
+    def write_chunk(self, chunk_type: bytes, data: bytes) -> None:
+        self.file.write(struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+    def write_rows(self, rows: np.ndarray) -> None:
+        """
+        Append rows to the image.
+
+        Parameters:
+        rows (np.ndarray): The pixels (H, W, channels) as uint8.
+        """
+        if rows.shape[1:] != (self.size[0], self.channels):
+            raise ValueError(f'Expected rows of shape (H, {self.size[0]}, {self.channels}), got {rows.shape}')
+        if self.rows_written + len(rows) > self.size[1]:
+            raise ValueError(f'The image has {self.size[1]} rows, cannot write {self.rows_written + len(rows)}')
+        if len(rows) == 0:
+            return
+        above = np.concatenate((self.previous_row[None], rows[:-1]))
+        filtered = np.empty((len(rows), self.size[0] * self.channels + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[:, 1:] = (rows - above).reshape(len(rows), -1)
+        self.pending += self.compressor.compress(filtered.tobytes())
+        if len(self.pending) >= self.chunk_bytes:
+            self.write_chunk(b'IDAT', self.pending)
+            self.pending = b''
+        self.previous_row = rows[-1].copy()
+        self.rows_written += len(rows)
+
+    def close(self) -> None:
+        """
+        Finish the image. Every row must have been written.
+        """
+        if self.file.closed:
+            return
+        try:
+            if self.rows_written != self.size[1]:
+                raise ValueError(f'Only {self.rows_written} of {self.size[1]} rows were written')
+            self.write_chunk(b'IDAT', self.pending + self.compressor.flush())
+            self.write_chunk(b'IEND', b'')
+        finally:
+            self.file.close()
+
+    def __enter__(self) -> 'PngStreamWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
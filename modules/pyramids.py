@@ -0,0 +1,129 @@
+from PIL import Image
+from typing import List, Tuple
+import numpy as np
+from .utils import *
+import os
+
+# Longest side of the smallest pyramid level
+PYRAMID_MIN_SIDE = 64
+
+def get_pyramid_path(pyramid_folder: str, image_name: str) -> str:
+    """
+    Get the path of the packed pyramid of a database image.
+
+    Parameters:
+    pyramid_folder (str): The folder with the pyramids.
+    image_name (str): The name of the image in the database.
+
+    Returns:
+    str: The path to the pyramid file.
+    """
+    return os.path.join(pyramid_folder, image_name + '.npz')
+
+def build_pyramid(image: Image.Image) -> List[np.ndarray]:
+    """
+    Build the mip pyramid of an image: the image and its halvings, until the longest side is at most PYRAMID_MIN_SIDE.
+
+    Parameters:
+    image (Image.Image): The database image, at most 1024px on the longest side.
+
+    Returns:
+    List[np.ndarray]: The RGB levels (H, W, 3), largest first.
+    """
+    level = image.convert('RGB')
+    levels = [np.asarray(level)]
+    while max(level.size) > PYRAMID_MIN_SIDE and min(level.size) >= 2:
+        # A 2x2 box filter, every level is the average of the one above
+        level = level.reduce(2)
+        levels.append(np.asarray(level))
+    return levels
+
+def save_pyramid(levels: List[np.ndarray], path: str) -> None:
+    """
+    Save the levels of a pyramid in one uncompressed file, so each level can be read on its own.
+
+    Parameters:
+    levels (List[np.ndarray]): The levels, see build_pyramid.
+    path (str): The path to the pyramid file.
+    """
+    with open(path, 'wb') as file:
+        np.savez(file, *levels, sizes=np.array([level.shape[1::-1] for level in levels]))
+
+def read_pyramid_sizes(path: str) -> np.ndarray:
+    """
+    Read the size of every level of a pyramid, without loading the levels.
+
+    Parameters:
+    path (str): The path to the pyramid file.
+
+    Returns:
+    np.ndarray: The (width, height) of every level (L, 2), largest first.
+    """
+    with np.load(path) as data:
+        return data['sizes']
+
+def choose_pyramid_level(sizes: np.ndarray, min_size: Tuple[int, int]) -> int:
+    """
+    Choose the smallest level that still covers a size without being scaled up.
+
+    Parameters:
+    sizes (np.ndarray): The level sizes, see read_pyramid_sizes.
+    min_size (Tuple[int, int]): The size the level will be scaled to cover, usually the bounding box of the tile.
+
+    Returns:
+    int: The level, 0 being the largest. The largest level if none covers the size.
+    """
+    covers = np.flatnonzero((sizes[:, 0] >= min_size[0]) & (sizes[:, 1] >= min_size[1]))
+    return int(covers[-1]) if len(covers) else 0
+
+def load_pyramid_level(path: str, level: int) -> Image.Image:
+    """
+    Load one level of a pyramid.
+
+    Parameters:
+    path (str): The path to the pyramid file.
+    level (int): The level, 0 being the largest.
+
+    Returns:
+    Image.Image: The RGB level.
+    """
+    with np.load(path) as data:
+        return Image.fromarray(data[f'arr_{level}'])
+
+def update_pyramids(image_folder: str, pyramid_folder: str, image_names: List[str], changed: List[str] = None) -> int:
+    """
+    Build the missing or outdated pyramids of the database images and remove the ones of deleted images.
+
+    Parameters:
+    image_folder (str): The folder with the database images.
+    pyramid_folder (str): The folder with the pyramids.
+    image_names (List[str]): The images in the database.
+    changed (List[str]): The images modified since the last update, see update_image_database. Only these and the
+    images without a pyramid are built. Every pyramid is checked against its image modification time if not given.
+
+    Returns:
+    int: The number of pyramids built.
+    """
+    os.makedirs(pyramid_folder, exist_ok=True)
+    expected = {os.path.basename(get_pyramid_path(pyramid_folder, name)) for name in image_names}
+    existing = set(os.listdir(pyramid_folder))
+    for file_name in existing - expected:
+        os.remove(os.path.join(pyramid_folder, file_name))
+    if changed is not None:
+        changed = set(changed)
+        image_names = [name for name in image_names if name in changed or os.path.basename(get_pyramid_path(pyramid_folder, name)) not in existing]
+    built = 0
+    for name in image_names:
+        image_path = os.path.join(image_folder, name)
+        pyramid_path = get_pyramid_path(pyramid_folder, name)
+        if not os.path.exists(image_path):
+            continue
+        if changed is None and os.path.exists(pyramid_path) and os.path.getmtime(pyramid_path) >= os.path.getmtime(image_path):
+            continue
+        try:
+            with Image.open(image_path) as img:
+                save_pyramid(build_pyramid(img), pyramid_path)
+            built += 1
+        except IOError:
+            print(f"Error opening {name} to build its pyramid. Skipping.")
+    return built
@@ -1,7 +1,21 @@
-from PIL import Image, ImageDraw
-from typing import List, Tuple
+from PIL import Image, ImageChops, ImageDraw
+from typing import Callable, Iterator, List, Tuple
+import numpy as np
 from .utils import *
-import json, random, os, time
+from .caches import ImageCache, MaskCache, matches_rhombus_template
+from .image_pool import ImagePool
+from .matching import ColorMatcher, create_matcher, load_database_features, load_match_lut
+from .assignment import assign_tiles
+from .png_stream import PngStreamWriter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import json, math, os, time
+
+# Blend modes of blend_channels
+BLEND_MODES = ('overlay', 'hard_light', 'multiply', 'screen')
+# Image.point table that keeps the alpha channel of an RGBA image
+ALPHA_IDENTITY = list(range(256))
 
 def slice_image(image: Image.Image, tiles: List[Rhombi]) -> List[Img_slice]:
     """
@@ -17,35 +31,203 @@ def slice_image(image: Image.Image, tiles: List[Rhombi]) -> List[Img_slice]:
     slices = []
 
     for tile in tiles:
-        # Convert complex vertices to a list of (x, y) tuples
-        absolute_vertices = [(vertex.real, vertex.imag) for vertex in tile]
-        # Find the top-left position of the tile
-        top_left_x = min(x for x, _ in absolute_vertices)
-        top_left_y = min(y for _, y in absolute_vertices)
-        top_left_position = (top_left_x, top_left_y)
-        # Convert vertices to integer and calculate relative positions
-        relative_vertices = [(x - top_left_x, y - top_left_y) for x, y in absolute_vertices]
+        absolute_vertices, top_left_position, relative_vertices = get_tile_geometry(tile)
         slice_img = get_masked_slice(image, absolute_vertices)
         # Append the image slice, its top-left position, and its relative vertices
         slices.append((slice_img, top_left_position, relative_vertices))
     return slices
 
+def get_tile_geometry(tile: Rhombi) -> Tuple[List[Tuple[float, float]], Tuple[float, float], List[Tuple[float, float]]]:
+    """
+    Get the vertices of a tile as (x, y) tuples, its top-left position and its vertices relative to that position.
+    
+    Parameters:
+    tile (Rhombi): The tile.
+    
+    Returns:
+    Tuple: The absolute vertices, the top-left position and the relative vertices.
+    """
+    # Convert complex vertices to a list of (x, y) tuples
+    absolute_vertices = [(vertex.real, vertex.imag) for vertex in tile]
+    # Find the top-left position of the tile
+    top_left_x = min(x for x, _ in absolute_vertices)
+    top_left_y = min(y for _, y in absolute_vertices)
+    relative_vertices = [(x - top_left_x, y - top_left_y) for x, y in absolute_vertices]
+    return absolute_vertices, (top_left_x, top_left_y), relative_vertices
+
+def rasterize_tiles(tiles: Rhombi_array, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Rasterize every tile once into a map of tile IDs.
+    
+    Parameters:
+    tiles (Rhombi_array): The tiles for the mosaic.
+    size (Tuple[int, int]): The size of the image.
+    
+    Returns:
+    np.ndarray: The (H, W) int32 label map, 0 outside the tiles and i + 1 inside tile i. Later tiles cover earlier ones.
+    """
+    label_map = Image.new('I', size, 0)
+    draw = ImageDraw.Draw(label_map)
+    polygons = np.stack((tiles.real, tiles.imag), axis=-1).reshape(len(tiles), -1).tolist()
+    for label, polygon in enumerate(polygons, start=1):
+        draw.polygon(polygon, fill=label)
+    return np.asarray(label_map, dtype=np.int32)
+
+def calculate_tile_colors(image: Image.Image, tiles: Rhombi_array, label_map: np.ndarray = None, grid: bool = False, band_rows: int = 256) -> Tile_colors:
+    """
+    Calculate the average color, pixel count, color variance and, for grid matching, the grid colors of every tile in one pass.
+    Only the pixels inside each tile are counted. Tiles too small to own a pixel take the color under their centroid,
+    and grid cells without pixels take the color of their tile. The image is summed band_rows rows at a time, so the
+    temporaries stay small for large images.
+    
+    Parameters:
+    image (Image.Image): The original image.
+    tiles (Rhombi_array): The tiles for the mosaic.
+    label_map (np.ndarray): The label map from rasterize_tiles, rasterized here if not given.
+    grid (bool): Calculate the grid colors too, only DescriptorMatcher uses them.
+    band_rows (int): The rows summed at a time.
+    
+    Returns:
+    Tile_colors: The mean colors (N, 3) as ints, the pixel counts (N,), the color variances (N,) and the mean colors
+    (N, GRID_CELLS ** 2, 3) of the cells of a grid over the bounding box of each tile, None without grid.
+    """
+    if label_map is None:
+        label_map = rasterize_tiles(tiles, image.size)
+    rgb = np.asarray(image.convert('RGB'))
+    width, height = image.size
+    bins = len(tiles) + 1
+    counts = np.zeros(bins, dtype=np.int64)
+    sums = np.zeros((bins, 3))
+    squared_sums = np.zeros((bins, 3))
+    if grid:
+        # Bounding box of every tile, label 0 gets a dummy box
+        lefts = np.concatenate(([0], tiles.real.min(axis=1)))
+        tops = np.concatenate(([0], tiles.imag.min(axis=1)))
+        widths = np.concatenate(([1], np.ptp(tiles.real, axis=1)))
+        heights = np.concatenate(([1], np.ptp(tiles.imag, axis=1)))
+        cell_bins = bins * GRID_CELLS ** 2
+        cell_counts = np.zeros(cell_bins, dtype=np.int64)
+        cell_sums = np.zeros((cell_bins, 3))
+    for top in range(0, height, band_rows):
+        labels = label_map[top:top + band_rows].ravel()
+        pixels = rgb[top:top + band_rows].reshape(-1, 3).astype(np.float64)
+        counts += np.bincount(labels, minlength=bins)
+        for channel in range(3):
+            sums[:, channel] += np.bincount(labels, weights=pixels[:, channel], minlength=bins)
+            squared_sums[:, channel] += np.bincount(labels, weights=pixels[:, channel] ** 2, minlength=bins)
+        if grid:
+            # Grid cell of every pixel within the bounding box of its tile
+            ys, xs = np.divmod(np.arange(labels.size), width)
+            columns = np.clip(((xs + 0.5 - lefts[labels]) * GRID_CELLS // widths[labels]).astype(np.int64), 0, GRID_CELLS - 1)
+            rows = np.clip(((ys + top + 0.5 - tops[labels]) * GRID_CELLS // heights[labels]).astype(np.int64), 0, GRID_CELLS - 1)
+            cells = labels * GRID_CELLS ** 2 + rows * GRID_CELLS + columns
+            cell_counts += np.bincount(cells, minlength=cell_bins)
+            for channel in range(3):
+                cell_sums[:, channel] += np.bincount(cells, weights=pixels[:, channel], minlength=cell_bins)
+    counts, sums, squared_sums = counts[1:], sums[1:], squared_sums[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts[:, None]
+        variances = (squared_sums / counts[:, None] - means ** 2).mean(axis=1)
+    empty = counts == 0
+    if np.any(empty):
+        centroids = tiles[empty].mean(axis=1)
+        x = np.clip(centroids.real.astype(np.int64), 0, width - 1)
+        y = np.clip(centroids.imag.astype(np.int64), 0, height - 1)
+        means[empty] = rgb[y, x]
+        variances[empty] = 0
+    grid_colors = None
+    if grid:
+        cell_counts = cell_counts[GRID_CELLS ** 2:].reshape(-1, GRID_CELLS ** 2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid_colors = cell_sums[GRID_CELLS ** 2:].reshape(-1, GRID_CELLS ** 2, 3) / cell_counts[:, :, None]
+        grid_colors = np.where(cell_counts[:, :, None] > 0, grid_colors, means[:, None, :])
+    return means.astype(np.int64), counts, np.maximum(variances, 0), grid_colors
+
 # Adjust blending based on variance and color distance
-def adjust_blend_strength(variance: float, color_distance: int, max_opacity=1.0) -> float:
+def adjust_blend_strength(variance: float, color_distance: int, max_opacity=1.0, strength: float = 1.0) -> float:
     """
     Adjust the blending strength based on the variance and color distance.
+    Works on single values or on arrays of them.
     
     Parameters:
     variance (float): The variance of the image.
     color_distance (int): The distance between the average color of the slice and the replacement image.
     max_opacity (float): The maximum opacity of the replacement image.
+    strength (float): How much the color distance and variance count, 0 for no blending.
     
     Returns:
     float: The adjusted opacity.
     """
-    strength = min(max_opacity, (variance / 10000) + (color_distance / 100))
+    strength = np.minimum(max_opacity, strength * ((np.asarray(variance) / 10000) + (np.asarray(color_distance) / 100)))
     return strength
 
+def calculate_blend_opacities(image_database: dict, image_names: List[str], matches: np.ndarray, tile_colors: Tile_colors, strength: float, max_opacity: float) -> np.ndarray:
+    """
+    Calculate the opacity of the color blend of every tile, see adjust_blend_strength.
+    
+    Parameters:
+    image_database (dict): A dict with the available images.
+    image_names (List[str]): The image names, in the order of matches.
+    matches (np.ndarray): The image (N,) of every tile.
+    tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+    strength (float): How much the color distance and variance count, 0 for no blending.
+    max_opacity (float): The maximum opacity of the blend.
+    
+    Returns:
+    np.ndarray: The opacity (N,) of every tile.
+    """
+    if strength <= 0 or max_opacity <= 0 or len(matches) == 0:
+        return np.zeros(len(matches))
+    profiles = np.array([image_database[name][:4] for name in image_names], dtype=np.float64)[matches]
+    distances = np.linalg.norm(profiles[:, :3] - tile_colors[0], axis=1)
+    return adjust_blend_strength(profiles[:, 3], distances, max_opacity, strength)
+
+def blend_channels(base: np.ndarray, blend: np.ndarray, mode: str = 'overlay') -> np.ndarray:
+    """
+    Blend color channels in one of the BLEND_MODES. The arrays broadcast against each other.
+    
+    Parameters:
+    base (np.ndarray): The channels of the image, 0 to 255.
+    blend (np.ndarray): The channels of the blend color, 0 to 255.
+    mode (str): The blend mode. Overlay and hard light multiply the dark tones and screen the light ones,
+    overlay picks by the image and hard light by the blend color.
+    
+    Returns:
+    np.ndarray: The blended channels (float), 0 to 255.
+    """
+    base = np.asarray(base, dtype=np.float64)
+    blend = np.asarray(blend, dtype=np.float64)
+    multiplied = base * blend / 255
+    screened = 255 - (255 - base) * (255 - blend) / 255
+    if mode == 'multiply':
+        return multiplied
+    if mode == 'screen':
+        return screened
+    if mode == 'overlay':
+        return np.where(base < 128, 2 * multiplied, 2 * screened - 255)
+    if mode == 'hard_light':
+        return np.where(blend < 128, 2 * multiplied, 2 * screened - 255)
+    raise ValueError(f'Unknown blend mode {mode}, expected one of {BLEND_MODES}')
+
+def create_blend_luts(colors: np.ndarray, opacities: np.ndarray, mode: str = 'overlay') -> np.ndarray:
+    """
+    Create the lookup tables that blend an image with a solid color. The blend color and opacity are the same over
+    a whole tile, so every output channel only depends on the input channel, and the blend of a tile is one
+    Image.point with a 768 entry table.
+    
+    Parameters:
+    colors (np.ndarray): The blend color (N, 3) of every tile.
+    opacities (np.ndarray): The opacity (N,) of every blend, 0 to 1.
+    mode (str): The blend mode, see blend_channels.
+    
+    Returns:
+    np.ndarray: The RGB tables (N, 768) as uint8, for Image.point.
+    """
+    levels = np.arange(256, dtype=np.float64)
+    blended = blend_channels(levels, np.asarray(colors, dtype=np.float64)[:, :, None], mode)
+    opacities = np.clip(np.asarray(opacities, dtype=np.float64), 0, 1)[:, None, None]
+    return np.clip(np.floor(blended * opacities + levels * (1 - opacities)), 0, 255).astype(np.uint8).reshape(len(blended), 3 * 256)
+
 def place_slices_on_canvas(canvas: Image.Image, slices: List[Img_slice]) -> None:
     """
     Place each slice on the canvas at its original position. 
@@ -58,84 +240,527 @@ def place_slices_on_canvas(canvas: Image.Image, slices: List[Img_slice]) -> None
         x, y = pos
         canvas.paste(slice_img, (int(x), int(y)), slice_img if slice_img.mode == 'RGBA' else None)
         
-def replace_slices(slices: List[Img_slice], image_database: dict, scale_factor: float, image_database_path: str) -> List[Img_slice]:
+def group_tile_renders(matches: np.ndarray, sizes: np.ndarray, window: int = 4096) -> List[np.ndarray]:
+    """
+    Group the tiles that need the same resized image: the same database image scaled to cover the same size.
+    The size of a template tile is the size of its mask, so it already tells its rhombus class.
+    Groups never span more than one window of window consecutive tiles and are ordered by their first tile,
+    so the slices can be handed out in tile order while holding at most one window of them.
+
+    Parameters:
+    matches (np.ndarray): The image (N,) of every tile.
+    sizes (np.ndarray): The bounding box size (N, 2) of every tile.
+    window (int): The number of consecutive tiles grouped together.
+
+    Returns:
+    List[np.ndarray]: The tiles of every group, in tile order within each group.
     """
-    Replace each slice with a random image from the database.
+    if len(matches) == 0:
+        return []
+    tile_ids = np.arange(len(matches))
+    windows = tile_ids // max(1, window)
+    order = np.lexsort((tile_ids, sizes[:, 1], sizes[:, 0], matches, windows))
+    keys = np.column_stack((windows[order], matches[order], sizes[order]))
+    starts = np.flatnonzero(np.concatenate(([True], np.any(keys[1:] != keys[:-1], axis=1))))
+    groups = np.split(order, starts[1:])
+    return sorted(groups, key=lambda group: group[0])
+
+def match_slices(tiles: Rhombi_array, tile_colors: Tile_colors, matcher: ColorMatcher, max_uses: int = 0, neighbor_distance: int = 0, rng: np.random.Generator = None, verbose: bool = False) -> np.ndarray:
+    """
+    Match every tile to an image in one batched query, see assign_tiles.
     
     Parameters:
-    slices (List[Img_slice]): The image slices.
+    tiles (Rhombi_array): The tiles for the mosaic.
+    tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
+    matcher (ColorMatcher): The matcher over the database, see create_matcher.
+    max_uses (int): The largest number of tiles per image, 0 for no limit.
+    neighbor_distance (int): The tiles within this many edge steps get different images, 0 to allow neighbors to repeat.
+    rng (np.random.Generator): The random generator used to break ties, seed it for the same mosaic on every run.
+    verbose (bool): Print the matching time.
+    
+    Returns:
+    np.ndarray: The image (N,) of every tile in matcher.names.
+    """
+    matching_start = time.time()
+    shapes, orientations = classify_rhombi(np.asarray(tiles, dtype=np.complex128))
+    matches = assign_tiles(tiles, tile_colors, matcher, shapes * 10 + orientations, max_uses, neighbor_distance, rng=rng, verbose=verbose)
+    if verbose:
+        print(f'Matched {len(matches)} slices against {len(matcher.names)} images. Took {round(time.time() - matching_start, 3)}s.')
+    return matches
+
+def iterate_threaded(work: Callable, items: List, threads: int, queue_size: int = 0, verbose: bool = False) -> Iterator:
+    """
+    Run work on every item on a pool of threads and yield the results in order. Pillow releases the GIL while it
+    decodes, resizes and masks, so the threads run side by side with each other and with the caller.
+    At most queue_size items are in flight: when the caller falls behind, no new item is started, so the memory
+    stays flat however many items there are.
+    
+    Parameters:
+    work (Callable): The function run on every item.
+    items (List): The items.
+    threads (int): The number of threads.
+    queue_size (int): The largest number of items started and not yet taken by the caller, 0 for twice the threads.
+    verbose (bool): Print the time spent by the threads and the caller, the throughput and the queue depth.
+    
+    Yields:
+    The result of work on every item, in the order of the items.
+    """
+    queue_size = queue_size if queue_size > 0 else 2 * threads
+    start = time.time()
+    work_time = [0.0] * len(items)
+    depths = []
+    waiting_time = 0.0
+
+    def timed_work(index: int):
+        work_start = time.time()
+        result = work(items[index])
+        work_time[index] = time.time() - work_start
+        return result
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        next_item = 0
+        while next_item < len(items) or pending:
+            # Fill the queue up to its bound
+            while next_item < len(items) and len(pending) < queue_size:
+                pending.append(executor.submit(timed_work, next_item))
+                next_item += 1
+            depths.append(sum(future.done() for future in pending))
+            waiting_start = time.time()
+            result = pending.popleft().result()
+            waiting_time += time.time() - waiting_start
+            yield result
+    if verbose and items:
+        elapsed = max(time.time() - start, 1e-9)
+        print(f'(threads) {len(items)} items on {threads} threads in {round(elapsed, 3)}s, {round(len(items) / elapsed, 1)} items/s. '
+              f'Workers busy {round(sum(work_time), 3)}s ({round(100 * sum(work_time) / (threads * elapsed))}%), caller waited {round(waiting_time, 3)}s. '
+              f'Queue depth mean {round(float(np.mean(depths)), 1)}, max {max(depths)} of {queue_size}.')
+
+def iterate_replaced_slices(tiles: Rhombi_array, tile_colors: Tile_colors, image_database: dict, scale_factor: float, image_database_path: str, mask_cache: MaskCache = None, matcher: ColorMatcher = None, max_uses: int = 0, neighbor_distance: int = 0, image_cache: ImageCache = None, matches: np.ndarray = None, color_slices: bool = True, blend_opacities: np.ndarray = None, blend_mode: str = 'overlay', threads: int = 1, queue_size: int = 0, verbose: bool = False) -> Iterator[Tuple[int, Img_slice, Img_slice]]:
+    """
+    Replace each tile with a random image from the database among the ones closest to its color.
+    All the tiles are matched in one batched query before any image is loaded, then the tiles are grouped by
+    image and size, see group_tile_renders, so each image is loaded and resized once per group.
+    The slices are yielded in tile order as soon as all the earlier ones are made, so the caller can place and drop
+    them, and where tiles overlap the later one covers the earlier one like in rasterize_tiles and render_color_mosaic.
+    With threads, the next groups are loaded, resized and masked while the caller places the slices.
+    
+    Parameters:
+    tiles (Rhombi_array): The tiles for the mosaic.
+    tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
     image_database (dict): A dict with the available images.
     scale_factor (float): The scale factor.
     image_database_path (str): The path to the image database.
+    mask_cache (MaskCache): The cache of rhombus masks, a new one is used if not given.
+    matcher (ColorMatcher): The matcher over the database, see create_matcher. The mean RGB colors are matched if not given.
+    max_uses (int): The largest number of tiles per image, 0 for no limit.
+    neighbor_distance (int): The tiles within this many edge steps get different images, 0 to allow neighbors to repeat.
+    image_cache (ImageCache): The cache of decoded database images, a new one is used if not given.
+    matches (np.ndarray): The image (N,) of every tile in matcher.names, see match_slices. The tiles are matched here if not given.
+    color_slices (bool): Make the solid color slices too. Without them, render_color_mosaic draws the color mosaic much faster.
+    blend_opacities (np.ndarray): The opacity (N,) of the blend of every replacement with the tile color, see calculate_blend_opacities. No blending if not given.
+    blend_mode (str): The blend mode, see blend_channels.
+    threads (int): The threads that load, resize and mask the images of the groups ahead of the caller, see iterate_threaded. 1 to do it in turn.
+    queue_size (int): The largest number of groups done ahead of the caller, 0 for twice the threads.
+    verbose (bool): Print the progress and the statistics of the threads.
     
-    Returns:
-    List[Img_slice]: The image slices with replacements.
+    Yields:
+    Tuple[int, Img_slice, Img_slice]: The index of the tile, its image slice with the replacement and its solid color slice, None without color_slices.
     """
-    mosaic = []
-    color_mosaic = []
-    slices_replaced = 0 
-    elapsed_time = [0, 0, 0]
-    for slice_img, pos, inner_vert in slices:
-        # Start tracking time
-        loop_start = time.time()
-        # Scale up the slice position
-        scaled_pos = (pos[0] * scale_factor, pos[1] * scale_factor)
+    mask_cache = mask_cache if mask_cache is not None else MaskCache()
+    image_cache = image_cache if image_cache is not None else ImageCache()
+    scaled_tiles = np.asarray(tiles, dtype=np.complex128) * scale_factor
+    shapes, orientations = classify_rhombi(scaled_tiles)
+    # Tiles that are not Penrose rhombi get their own mask
+    use_template = matches_rhombus_template(scaled_tiles, shapes, orientations)
+    matcher = matcher if matcher is not None else ColorMatcher(image_database)
+    if matches is None:
+        matches = match_slices(tiles, tile_colors, matcher, max_uses, neighbor_distance, verbose=verbose)
+    # Plan: the geometry of every tile, then the tiles grouped so that each image is resized once per size
+    masks, positions, inner_vertices = [], [], []
+    sizes = np.zeros((len(tiles), 2))
+    for i, tile in enumerate(scaled_tiles):
+        if use_template[i]:
+            mask, scaled_pos = mask_cache.get_mask(tile, shapes[i], orientations[i])
+            scaled_inner_vert = [(vertex.real - scaled_pos[0], vertex.imag - scaled_pos[1]) for vertex in tile]
+            sizes[i] = mask.size
+        else:
+            mask = None
+            _, scaled_pos, scaled_inner_vert = get_tile_geometry(tile)
+            sizes[i] = calculate_bounding_box_dimensions(scaled_inner_vert)
+        masks.append(mask)
+        positions.append(scaled_pos)
+        inner_vertices.append(scaled_inner_vert)
+    groups = group_tile_renders(matches, sizes)
+    # Execute: load and resize the image of each group once and crop it for every tile of the group
+    avg_colors = [tuple(color) for color in tile_colors[0].tolist()]
 
-        # Scale up inner vertices
-        scaled_inner_vert = [(x * scale_factor, y * scale_factor) for x, y in inner_vert]
-        
-        # Track matching time
-        matching_start = time.time()
-        # Get average color of the slice
-        avg_color = calculate_average_color(slice_img)
-        
-        # Replacing with images from the database
-        closest_color = min(image_database.values(), key=lambda color: color_distance(color[:3], avg_color))  
-        
-        # Get image with similar color
-        closest_images = [image_path for image_path, color in image_database.items() if color == closest_color]
-        image_path = random.choice(closest_images)
-        replacement_image = Image.open(os.path.join(image_database_path, image_path))
-        # Calculate matching time
-        elapsed_time[1] += time.time() - matching_start
+    def render_group(group: np.ndarray) -> Tuple[List[Tuple[int, Img_slice, Img_slice]], List[float]]:
+        # Track loading time
+        loading_start = time.time()
+        tile_width, tile_height = sizes[group[0]].tolist()
+        # Replacing with the matched image from the database
+        image_path = matcher.names[matches[group[0]]]
+        replacement_image = image_cache.get_image(os.path.join(image_database_path, image_path), (tile_width, tile_height))
+        # Calculate loading time
+        loading_time = time.time() - loading_start
 
         # Define the bounding box for the replacement image and the scaling factor
         img_width, img_height = replacement_image.size
-        tile_width, tile_height = calculate_bounding_box_dimensions(scaled_inner_vert)
         scale_w = tile_width / img_width
         scale_h = tile_height / img_height
         scale = max(scale_w, scale_h)
-        
+
         resize_start = time.time()
-        # Resize, mask and append the images
-        new_size = (int(img_width * scale), int(img_height * scale))
-        
-        # color_variance = image_database[image_path][3]
-        # color_dist = color_distance(image_database[image_path][:3], avg_color)
-        # blend_strength = adjust_blend_strength(color_variance, color_dist)
+        # Resize once, then mask the images
+        new_size = (math.ceil(img_width * scale), math.ceil(img_height * scale))
+
         replacement_image = replacement_image.resize(new_size)
-        # replacement_image = overlay_blend(replacement_image, avg_color, blend_strength)
-        cropped_replacement = get_masked_slice(replacement_image, scaled_inner_vert)
-
-        # Create solid color image
-        solid_color_img = Image.new('RGB', slice_img.size, avg_color)
-        solid_color_img = solid_color_img.resize(new_size)
-        color_cropped = get_masked_slice(solid_color_img, scaled_inner_vert)
-        elapsed_time[2] += time.time() - resize_start
-        
-        # Append slices
-        mosaic.append((cropped_replacement, scaled_pos, scaled_inner_vert))
-        color_mosaic.append((color_cropped, scaled_pos, scaled_inner_vert))
-        
-        elapsed_time[0] += time.time() - loop_start
-        slices_replaced += 1
-        if slices_replaced % 100 == 0:
-            print(f'Replaced {len(mosaic)} slices. Last 100 took {round(elapsed_time[0], 3)}s. Matching took {round(elapsed_time[1], 3)}s. Resizing took {round(elapsed_time[2], 3)}s.')
+        blend_luts = create_blend_luts(tile_colors[0][group], blend_opacities[group], blend_mode) if blend_opacities is not None else None
+        # Tiles of the same class and phase share their mask, and so their masked replacement before blending
+        masked_replacements = {}
+        group_slices = []
+        for member, i in enumerate(group.tolist()):
+            mask = masks[i]
+            blend_lut = blend_luts[member].tolist() if blend_luts is not None and blend_opacities[i] > 0 else None
+            if mask is not None:
+                cropped_replacement = masked_replacements.get(id(mask))
+                if cropped_replacement is None:
+                    cropped_replacement = replacement_image.crop((0, 0) + mask.size)
+                    cropped_replacement.putalpha(mask)
+                    masked_replacements[id(mask)] = cropped_replacement
+                if blend_lut is not None:
+                    # The alpha channel keeps the mask
+                    cropped_replacement = cropped_replacement.point(blend_lut + ALPHA_IDENTITY)
+            else:
+                cropped_replacement = get_masked_slice(replacement_image.point(blend_lut) if blend_lut is not None else replacement_image, inner_vertices[i])
+            color_slice = None
+            if color_slices and mask is not None:
+                # Create solid color image
+                color_cropped = Image.new('RGB', mask.size, avg_colors[i])
+                color_cropped.putalpha(mask)
+                color_slice = (color_cropped, positions[i], inner_vertices[i])
+            elif color_slices:
+                # Create solid color image
+                solid_color_img = Image.new('RGB', new_size, avg_colors[i])
+                color_slice = (get_masked_slice(solid_color_img, inner_vertices[i]), positions[i], inner_vertices[i])
+            group_slices.append((i, (cropped_replacement, positions[i], inner_vertices[i]), color_slice))
+        return group_slices, [loading_time, time.time() - resize_start]
+
+    if threads > 1:
+        rendered_groups = iterate_threaded(render_group, groups, threads, queue_size, verbose)
+    else:
+        rendered_groups = map(render_group, groups)
+    slices_replaced = 0
+    elapsed_time = [0, 0, 0]
+    loop_start = time.time()
+    # Slices made ahead of an earlier tile wait here, at most one window of them
+    waiting = {}
+    next_tile = 0
+    for group_slices, (loading_time, resizing_time) in rendered_groups:
+        waiting.update((slice_entry[0], slice_entry) for slice_entry in group_slices)
+        while next_tile in waiting:
+            yield waiting.pop(next_tile)
+            next_tile += 1
+        elapsed_time[1] += loading_time
+        elapsed_time[2] += resizing_time
+        slices_replaced += len(group_slices)
+        if slices_replaced >= 100:
+            elapsed_time[0] = time.time() - loop_start
+            if verbose:
+                print(f'Replaced {slices_replaced} slices from {matcher.names[matches[group_slices[0][0]]]}. Last {slices_replaced} took {round(elapsed_time[0], 3)}s. Loading took {round(elapsed_time[1], 3)}s. Resizing took {round(elapsed_time[2], 3)}s.')
             slices_replaced = 0
             elapsed_time = [0, 0, 0]
+            loop_start = time.time()
+    if verbose:
+        print(f'Rendered {len(tiles)} slices from {len(groups)} resized images.')
+
+def replace_slices(tiles: Rhombi_array, tile_colors: Tile_colors, image_database: dict, scale_factor: float, image_database_path: str, mask_cache: MaskCache = None, matcher: ColorMatcher = None, max_uses: int = 0, neighbor_distance: int = 0, image_cache: ImageCache = None) -> Tuple[List[Img_slice], List[Img_slice]]:
+    """
+    Replace each tile with a random image from the database among the ones closest to its color, see iterate_replaced_slices.
+    All the slices are kept, use render_mosaic to place them on the canvas as they are made instead.
+    
+    Parameters:
+    See iterate_replaced_slices.
+    
+    Returns:
+    Tuple[List[Img_slice], List[Img_slice]]: The image slices with replacements and the solid color slices, in tile order.
+    """
+    mosaic = [None] * len(tiles)
+    color_mosaic = [None] * len(tiles)
+    for i, replaced_slice, color_slice in iterate_replaced_slices(tiles, tile_colors, image_database, scale_factor, image_database_path, mask_cache, matcher, max_uses, neighbor_distance, image_cache):
+        mosaic[i] = replaced_slice
+        color_mosaic[i] = color_slice
     return (mosaic, color_mosaic)
 
-def overlay_blend(image: Image.Image, target_color: Tuple[int, int, int], opacity: float = 0.5) -> Image.Image:
+def render_color_mosaic(scaled_tiles: Rhombi_array, colors: np.ndarray, canvas_size: Tuple[int, int], supersample: int = 1, offset: Tuple[int, int] = (0, 0)) -> Image.Image:
+    """
+    Draw the color mosaic: every tile filled with its average color, straight onto the canvas.
+    With supersampling the tiles are drawn on a larger canvas that is then reduced, which anti-aliases the edges
+    of the mosaic without seams between the tiles.
+    
+    Parameters:
+    scaled_tiles (Rhombi_array): The tiles, in canvas pixels.
+    colors (np.ndarray): The color (N, 3) of every tile.
+    canvas_size (Tuple[int, int]): The size of the canvas.
+    supersample (int): The number of samples per pixel along each axis, 1 for no anti-aliasing.
+    offset (Tuple[int, int]): The position of the canvas in the mosaic, for the bands of render_color_band.
+    
+    Returns:
+    Image.Image: The RGBA color mosaic.
+    """
+    supersample = max(1, int(supersample))
+    canvas = create_canvas((canvas_size[0] * supersample, canvas_size[1] * supersample))
+    draw = ImageDraw.Draw(canvas)
+    points = (np.asarray(scaled_tiles, dtype=np.complex128) - complex(*offset)) * supersample
+    polygons = np.stack((points.real, points.imag), axis=-1).reshape(len(points), 2 * points.shape[1]).tolist()
+    fills = [tuple(color) + (255,) for color in np.asarray(colors, dtype=np.int64).tolist()]
+    for polygon, fill in zip(polygons, fills):
+        draw.polygon(polygon, fill=fill, outline=fill)
+    if supersample > 1:
+        # Premultiplied alpha, so the transparent background does not bleed into the edges
+        canvas = canvas.convert('RGBa').reduce(supersample).convert('RGBA')
+    return canvas
+
+def prepare_render(tiles: Rhombi_array, tile_colors: Tile_colors, image_database: dict, matcher: ColorMatcher = None, max_uses: int = 0, neighbor_distance: int = 0, blend_strength: float = 0, blend_opacity: float = 0.5, rng: np.random.Generator = None, verbose: bool = False) -> Tuple[ColorMatcher, np.ndarray, np.ndarray]:
+    """
+    Match every tile and find its blend opacity before rendering, the same way for every render mode.
+    
+    Parameters:
+    See render_mosaic.
+    
+    Returns:
+    Tuple[ColorMatcher, np.ndarray, np.ndarray]: The matcher, the image (N,) of every tile, see match_slices,
+    and the blend opacity (N,) of every tile, see calculate_blend_opacities.
+    """
+    matcher = matcher if matcher is not None else ColorMatcher(image_database)
+    matches = match_slices(tiles, tile_colors, matcher, max_uses, neighbor_distance, rng, verbose)
+    blend_opacities = calculate_blend_opacities(image_database, matcher.names, matches, tile_colors, blend_strength, blend_opacity)
+    return matcher, matches, blend_opacities
+
+def render_mosaic(tiles: Rhombi_array, tile_colors: Tile_colors, image_database: dict, scale_factor: float, image_database_path: str, canvas_size: Tuple[int, int], mask_cache: MaskCache = None, matcher: ColorMatcher = None, max_uses: int = 0, neighbor_distance: int = 0, image_cache: ImageCache = None, supersample: int = 1, blend_mode: str = 'overlay', blend_strength: float = 0, blend_opacity: float = 0.5, rng: np.random.Generator = None, threads: int = 1, queue_size: int = 0, verbose: bool = False) -> Tuple[Image.Image, Image.Image]:
+    """
+    Render the mosaic and the color mosaic straight onto their canvases. Every slice is pasted as soon as it is made
+    and then dropped, so the memory is the two canvases and the slices of one group, not a copy of every slice.
+    
+    Parameters:
+    canvas_size (Tuple[int, int]): The size of the scaled canvas.
+    supersample (int): The anti-aliasing of the color mosaic, see render_color_mosaic.
+    blend_mode (str): The blend mode of the replacements with their tile color, see blend_channels.
+    blend_strength (float): How much the replacements are blended with their tile color, see calculate_blend_opacities. 0 for no blending.
+    blend_opacity (float): The largest opacity of the blend.
+    rng (np.random.Generator): The random generator used to break ties, see match_slices.
+    See iterate_replaced_slices for the others.
+    
+    Returns:
+    Tuple[Image.Image, Image.Image]: The mosaic and the color mosaic.
+    """
+    matcher, matches, blend_opacities = prepare_render(tiles, tile_colors, image_database, matcher, max_uses, neighbor_distance, blend_strength, blend_opacity, rng, verbose)
+    canvas = create_canvas(canvas_size)
+    for _, replaced_slice, _ in iterate_replaced_slices(tiles, tile_colors, image_database, scale_factor, image_database_path, mask_cache, matcher, image_cache=image_cache,
+                                                        matches=matches, color_slices=False, blend_opacities=blend_opacities, blend_mode=blend_mode,
+                                                        threads=threads, queue_size=queue_size, verbose=verbose):
+        place_slices_on_canvas(canvas, [replaced_slice])
+    color_canvas = render_color_mosaic(np.asarray(tiles, dtype=np.complex128) * scale_factor, tile_colors[0], canvas_size, supersample)
+    return canvas, color_canvas
+
+def find_band_tiles(scaled_tiles: Rhombi_array, height: int, band_height: int) -> List[np.ndarray]:
+    """
+    Find the tiles that reach into every horizontal band of the canvas. The tiles are sorted by their top edge,
+    so the tiles of a band are found with two binary searches, without scanning all the tiles.
+    
+    Parameters:
+    scaled_tiles (Rhombi_array): The tiles, in canvas pixels.
+    height (int): The height of the canvas.
+    band_height (int): The height of every band, the last one can be shorter.
+    
+    Returns:
+    List[np.ndarray]: The tiles of every band, from the top, in tile order.
+    """
+    # One pixel of margin for the edges drawn by the masks
+    tops = np.floor(scaled_tiles.imag.min(axis=1)) - 1
+    bottoms = np.ceil(scaled_tiles.imag.max(axis=1)) + 1
+    order = np.argsort(tops, kind='stable')
+    sorted_tops = tops[order]
+    tallest = float((bottoms - tops).max()) if len(scaled_tiles) else 0
+    bands = []
+    for band_top in range(0, height, band_height):
+        band_bottom = band_top + band_height
+        start, end = np.searchsorted(sorted_tops, [band_top - tallest, band_bottom])
+        candidates = order[start:end]
+        bands.append(np.sort(candidates[bottoms[candidates] > band_top]))
+    return bands
+
+def render_color_band(scaled_tiles: Rhombi_array, colors: np.ndarray, width: int, band_top: int, band_height: int, supersample: int = 1) -> Image.Image:
+    """
+    Draw one band of the color mosaic, see render_color_mosaic. PIL does not fill a polygon cut by the top of the canvas
+    like the same polygon drawn whole, which leaves holes along the band edges. So the band is drawn on a canvas with
+    the height of the tallest tile above and below it, where every tile of the band is whole, and then cropped.
+    
+    Parameters:
+    scaled_tiles (Rhombi_array): The tiles that reach into the band, in canvas pixels, see find_band_tiles.
+    colors (np.ndarray): The color (N, 3) of every tile.
+    width (int): The width of the canvas.
+    band_top (int): The first row of the band.
+    band_height (int): The number of rows of the band.
+    supersample (int): The number of samples per pixel along each axis, see render_color_mosaic.
+    
+    Returns:
+    Image.Image: The RGBA band of the color mosaic.
+    """
+    scaled_tiles = np.asarray(scaled_tiles, dtype=np.complex128)
+    padding = int(np.ceil(np.ptp(scaled_tiles.imag, axis=1).max())) + 1 if len(scaled_tiles) else 0
+    canvas = render_color_mosaic(scaled_tiles, colors, (width, band_height + 2 * padding), supersample, (0, band_top - padding))
+    return canvas.crop((0, padding, width, padding + band_height))
+
+def render_mosaic_bands(tiles: Rhombi_array, tile_colors: Tile_colors, image_database: dict, scale_factor: float, image_database_path: str, canvas_size: Tuple[int, int], band_height: int, mosaic_path: str, color_mosaic_path: str, mask_cache: MaskCache = None, matcher: ColorMatcher = None, max_uses: int = 0, neighbor_distance: int = 0, image_cache: ImageCache = None, supersample: int = 1, blend_mode: str = 'overlay', blend_strength: float = 0, blend_opacity: float = 0.5, rng: np.random.Generator = None, threads: int = 1, queue_size: int = 0, verbose: bool = False) -> int:
+    """
+    Render the mosaic and the color mosaic one horizontal band at a time, writing every band to the PNGs before
+    the next one is rendered. The memory depends on the band height, not on the size of the mosaic.
+    All the tiles are matched before the first band, so the bands follow the same repetition rules as a full render.
+    Tiles that cross a band edge are rendered in both bands.
+    
+    Parameters:
+    canvas_size (Tuple[int, int]): The size of the scaled canvas.
+    band_height (int): The height of every band in pixels.
+    mosaic_path (str): The path to the mosaic PNG.
+    color_mosaic_path (str): The path to the color mosaic PNG.
+    supersample (int): The anti-aliasing of the color mosaic, see render_color_mosaic.
+    blend_mode (str): The blend mode of the replacements with their tile color, see blend_channels.
+    blend_strength (float): How much the replacements are blended with their tile color, see calculate_blend_opacities. 0 for no blending.
+    blend_opacity (float): The largest opacity of the blend.
+    rng (np.random.Generator): The random generator used to break ties, see match_slices.
+    See iterate_replaced_slices for the others.
+    
+    Returns:
+    int: The number of bands.
+    """
+    mask_cache = mask_cache if mask_cache is not None else MaskCache()
+    image_cache = image_cache if image_cache is not None else ImageCache()
+    matcher, matches, blend_opacities = prepare_render(tiles, tile_colors, image_database, matcher, max_uses, neighbor_distance, blend_strength, blend_opacity, rng, verbose)
+    bands = find_band_tiles(np.asarray(tiles, dtype=np.complex128) * scale_factor, canvas_size[1], band_height)
+    with PngStreamWriter(mosaic_path, canvas_size) as mosaic_writer, PngStreamWriter(color_mosaic_path, canvas_size) as color_writer:
+        for band, band_tiles in enumerate(bands):
+            band_top = band * band_height
+            band_size = (canvas_size[0], min(band_height, canvas_size[1] - band_top))
+            canvas = create_canvas(band_size)
+            band_colors = tuple(None if values is None else values[band_tiles] for values in tile_colors)
+            for _, (slice_img, pos, _), _ in iterate_replaced_slices(tiles[band_tiles], band_colors, image_database, scale_factor, image_database_path,
+                                                                     mask_cache, matcher, image_cache=image_cache, matches=matches[band_tiles], color_slices=False,
+                                                                     blend_opacities=blend_opacities[band_tiles], blend_mode=blend_mode,
+                                                                     threads=threads, queue_size=queue_size, verbose=verbose):
+                # Same position as place_slices_on_canvas, moved to the band
+                canvas.paste(slice_img, (int(pos[0]), int(pos[1]) - band_top), slice_img)
+            color_canvas = render_color_band(np.asarray(tiles[band_tiles], dtype=np.complex128) * scale_factor, band_colors[0], canvas_size[0], band_top, band_size[1], supersample)
+            mosaic_writer.write_rows(np.asarray(canvas))
+            color_writer.write_rows(np.asarray(color_canvas))
+            if verbose:
+                print(f'Wrote band {band + 1} of {len(bands)}, {len(band_tiles)} slices.')
+    return len(bands)
+
+# State of every render worker process, see init_render_worker
+render_worker_state = {}
+
+def init_render_worker(image_database: dict, scale_factor: float, image_database_path: str, canvas_size: Tuple[int, int], memory_names: Tuple[str, str], image_cache_bytes: int, pyramid_folder: str, image_pool_path: str, supersample: int, blend_mode: str) -> None:
+    """
+    Set up a render worker: attach the shared canvases and create the caches it keeps between bands.
+    The image pool is memory mapped, so the workers share its pages instead of each decoding the images.
+    
+    Parameters:
+    memory_names (Tuple[str, str]): The names of the shared memory of the mosaic and the color mosaic.
+    image_cache_bytes (int): The memory budget of the image cache of the worker.
+    pyramid_folder (str): The folder with the image pyramids, see ImageCache.
+    image_pool_path (str): The path to the image pool, see ImagePool.
+    See render_mosaic_parallel for the others.
+    """
+    memories = [SharedMemory(name=name) for name in memory_names]
+    image_pool = ImagePool(image_pool_path) if image_pool_path else None
+    render_worker_state.update({
+        'image_database': image_database,
+        'scale_factor': scale_factor,
+        'image_database_path': image_database_path,
+        'memories': memories,
+        'canvases': [np.ndarray((canvas_size[1], canvas_size[0], 4), dtype=np.uint8, buffer=memory.buf) for memory in memories],
+        'mask_cache': MaskCache(),
+        'image_cache': ImageCache(image_cache_bytes, pyramid_folder, image_pool),
+        # Only used for the image names, which follow the database like in every matcher
+        'matcher': ColorMatcher(image_database),
+        'supersample': supersample,
+        'blend_mode': blend_mode,
+    })
+
+def render_shared_band(band_top: int, band_height: int, tiles: Rhombi_array, tile_colors: Tile_colors, matches: np.ndarray, blend_opacities: np.ndarray) -> int:
+    """
+    Render one band in a worker, straight into the rows of the shared canvases. The bands do not overlap,
+    so the workers write without locks.
+    
+    Parameters:
+    band_top (int): The first row of the band.
+    band_height (int): The number of rows of the band.
+    tiles (Rhombi_array): The tiles that reach into the band, see find_band_tiles.
+    tile_colors (Tile_colors): The colors of these tiles.
+    matches (np.ndarray): The image of these tiles, see match_slices.
+    blend_opacities (np.ndarray): The blend opacity of these tiles, see calculate_blend_opacities.
+    
+    Returns:
+    int: The number of tiles rendered.
+    """
+    state = render_worker_state
+    mosaic_rows, color_rows = state['canvases']
+    band_size = (mosaic_rows.shape[1], band_height)
+    canvas = create_canvas(band_size)
+    for _, (slice_img, pos, _), _ in iterate_replaced_slices(tiles, tile_colors, state['image_database'], state['scale_factor'], state['image_database_path'], state['mask_cache'], state['matcher'],
+                                                             image_cache=state['image_cache'], matches=matches, color_slices=False, blend_opacities=blend_opacities, blend_mode=state['blend_mode']):
+        # Same position as place_slices_on_canvas, moved to the band
+        canvas.paste(slice_img, (int(pos[0]), int(pos[1]) - band_top), slice_img)
+    mosaic_rows[band_top:band_top + band_height] = np.asarray(canvas)
+    color_canvas = render_color_band(np.asarray(tiles, dtype=np.complex128) * state['scale_factor'], tile_colors[0], band_size[0], band_top, band_height, state['supersample'])
+    color_rows[band_top:band_top + band_height] = np.asarray(color_canvas)
+    return len(tiles)
+
+def render_mosaic_parallel(tiles: Rhombi_array, tile_colors: Tile_colors, image_database: dict, scale_factor: float, image_database_path: str, canvas_size: Tuple[int, int], workers: int, matcher: ColorMatcher = None, max_uses: int = 0, neighbor_distance: int = 0, supersample: int = 1, blend_mode: str = 'overlay', blend_strength: float = 0, blend_opacity: float = 0.5, rng: np.random.Generator = None, image_cache_bytes: int = 512 * 2 ** 20, pyramid_folder: str = None, image_pool_path: str = None, verbose: bool = False) -> Tuple[Image.Image, Image.Image]:
+    """
+    Render the mosaic and the color mosaic on several processes. The tiles are matched once here, the canvas is
+    split in bands, see find_band_tiles, and the workers render whole bands into canvases in shared memory.
+    With the same random generator seed the result does not depend on the number of workers.
+    
+    Parameters:
+    workers (int): The number of worker processes.
+    image_cache_bytes (int): The memory budget of the image cache, split between the workers.
+    pyramid_folder (str): The folder with the image pyramids, see ImageCache.
+    image_pool_path (str): The path to the image pool, see ImagePool.
+    verbose (bool): Print the progress of the bands.
+    See render_mosaic for the others.
+    
+    Returns:
+    Tuple[Image.Image, Image.Image]: The mosaic and the color mosaic.
+    """
+    matcher, matches, blend_opacities = prepare_render(tiles, tile_colors, image_database, matcher, max_uses, neighbor_distance, blend_strength, blend_opacity, rng, verbose)
+    # A few bands per worker, so that no worker waits for a slow one at the end
+    band_height = max(1, math.ceil(canvas_size[1] / (workers * 4)))
+    bands = find_band_tiles(np.asarray(tiles, dtype=np.complex128) * scale_factor, canvas_size[1], band_height)
+    memories = [SharedMemory(create=True, size=max(1, canvas_size[0] * canvas_size[1] * 4)) for _ in range(2)]
+    try:
+        initargs = (image_database, scale_factor, image_database_path, canvas_size, tuple(memory.name for memory in memories),
+                    image_cache_bytes // workers, pyramid_folder, image_pool_path, supersample, blend_mode)
+        with ProcessPoolExecutor(workers, initializer=init_render_worker, initargs=initargs) as executor:
+            futures = []
+            for band, band_tiles in enumerate(bands):
+                band_top = band * band_height
+                futures.append(executor.submit(render_shared_band, band_top, min(band_height, canvas_size[1] - band_top), tiles[band_tiles],
+                                               tuple(None if values is None else values[band_tiles] for values in tile_colors), matches[band_tiles], blend_opacities[band_tiles]))
+            for band, future in enumerate(futures):
+                slices = future.result()
+                if verbose:
+                    print(f'Rendered band {band + 1} of {len(bands)}, {slices} slices.')
+        canvases = [Image.fromarray(np.ndarray((canvas_size[1], canvas_size[0], 4), dtype=np.uint8, buffer=memory.buf).copy(), 'RGBA') for memory in memories]
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+    return canvases[0], canvases[1]
+
+def overlay_blend(image: Image.Image, target_color: Tuple[int, int, int], opacity: float = 0.5, mode: str = 'overlay') -> Image.Image:
     """
     Blend the image with the target color.
     
@@ -143,48 +768,19 @@ def overlay_blend(image: Image.Image, target_color: Tuple[int, int, int], opacit
     image (Image.Image): The image to blend.
     target_color (Tuple[int, int, int]): The target color.
     opacity (float): The opacity of the image.
+    mode (str): The blend mode, see blend_channels.
     
     Returns:
     Image.Image: The blended image.
     """
     if image.mode != 'RGB':
         image = image.convert('RGB')
-    # Ensure opacity is within the correct range
-    opacity = max(0, min(opacity, 1))
-    # Create a solid color image
-    color_image = Image.new("RGB", image.size, color=target_color)
-
-    # Prepare for pixel-wise operation
-    blended_image = Image.new("RGB", image.size)
-    base_pixels = image.load()
-    blend_pixels = color_image.load()
-    result_pixels = blended_image.load()
-
-    for x in range(image.size[0]):
-        for y in range(image.size[1]):
-            base = base_pixels[x, y]
-            blend = blend_pixels[x, y]
-
-            new_pixel = []
-            for i in range(3):  # For R, G, B channels
-                if base[i] < 128:  # Darker than 50% gray
-                    # Multiply mode
-                    new_color = (2 * base[i] * blend[i]) / 255
-                else:
-                    # Screen mode
-                    new_color = 255 - 2 * (255 - base[i]) * (255 - blend[i]) / 255
-                
-                # Apply opacity
-                new_color = int(new_color * opacity + base[i] * (1 - opacity))
-                new_pixel.append(new_color)
-
-            result_pixels[x, y] = tuple(new_pixel)
-
-    return blended_image
+    return image.point(create_blend_luts(np.array([target_color]), np.array([opacity]), mode)[0].tolist())
 
 def get_masked_slice(image: Image.Image, vertices: List[Tuple[float, float]]) -> Image.Image:
     """
     Get the masked slice of the image.
+    The mask is only as large as the bounding box of the slice, so the cost does not depend on the size of the image.
     
     Parameters:
     image (Image.Image): The image to slice.
@@ -193,68 +789,108 @@ def get_masked_slice(image: Image.Image, vertices: List[Tuple[float, float]]) ->
     Returns:
     Image.Image: The masked slice.
     """
-    # Create a mask for the rhomboid shape
-    mask = Image.new('L', image.size, 0)
-    draw = ImageDraw.Draw(mask)
-    # Draw the polygon with white fill
-    draw.polygon(vertices, outline=1, fill=255)
-    # Crop the mask to the bounding box
     bounding_box = (min(int(v[0]) for v in vertices), min(int(v[1]) for v in vertices),
                     max(int(v[0]) for v in vertices), max(int(v[1]) for v in vertices))
-    mask = mask.crop(bounding_box)
+    left, top, right, bottom = bounding_box
+    # Create a mask for the rhomboid shape, in bounding box coordinates
+    mask = Image.new('L', (right - left, bottom - top), 0)
+    draw = ImageDraw.Draw(mask)
+    # Draw the polygon with white fill
+    draw.polygon([(x - left, y - top) for x, y in vertices], outline=1, fill=255)
+    # Nothing outside the image is part of the slice
+    if left < 0 or top < 0 or right > image.size[0] or bottom > image.size[1]:
+        inside = Image.new('L', mask.size, 0)
+        inside.paste(255, (max(0, -left), max(0, -top), min(mask.size[0], image.size[0] - left), min(mask.size[1], image.size[1] - top)))
+        mask = ImageChops.darker(mask, inside)
     # Crop the image slice to the bounding box
     slice_img = image.crop(bounding_box)
     # Apply the mask to the slice
     slice_img.putalpha(mask)
     return slice_img
 
-def slice_and_place_images(image: Image.Image, tiles: List[Rhombi], config: dict) -> List[Img_slice]:
+def slice_and_place_images(image: Image.Image, tiles: Rhombi_array, config: dict) -> Tile_colors:
     """
-    Slice the original image into tiles and place them on a canvas.
+    Slice the original image into tiles and measure the color of every tile.
+    The tiles are rasterized once into a label map, which also gives the preview with borders.
     
     Parameters:
     image (Image.Image): The original image.
-    tiles (List[Rhombi]): The tiles for the mosaic.
+    tiles (Rhombi_array): The tiles for the mosaic.
     config (dict): The configuration settings.
     
     Returns:
-    List[Img_slice]: The slices of the original image.
+    Tile_colors: The colors of the tiles, see calculate_tile_colors.
     """
     config['timing']['slice_image'] = time.time()
     log_message(f'6- Slicing image {config["image_path"]} into {len(tiles)} slices', config)
-    slices = slice_image(image, tiles)
+    label_map = rasterize_tiles(tiles, image.size)
+    tile_colors = calculate_tile_colors(image, tiles, label_map, config.get('match_mode', 'color') == 'grid')
     # Save a copy of the slices with borders
     canvas = create_canvas(image.size)
-    place_slices_on_canvas(canvas, slices)
+    canvas.paste(image.convert('RGB'), (0, 0), Image.fromarray(((label_map > 0) * 255).astype(np.uint8)))
     draw_borders(canvas, tiles)
     canvas.save(os.path.join(config['output_path'], config['image_with_borders_name']), optimize=True)
     elapsed_time = round(time.time() - config["timing"]["slice_image"], 3)
-    log_message(f'7- Created {len(slices)} slices. Took {elapsed_time}s', config)
-    return slices
+    log_message(f'7- Measured {len(tiles)} slices. Took {elapsed_time}s', config)
+    return tile_colors
 
-def create_mosaic(slices: List[Img_slice], size: Tuple[int, int], config: dict) -> Tuple[Image.Image, Image.Image]:
+def create_mosaic(tiles: Rhombi_array, tile_colors: Tile_colors, size: Tuple[int, int], config: dict) -> Tuple[Image.Image, Image.Image]:
     """
     Create the mosaic by replacing the slices with images from the database.
     
     Parameters:
-    slices (List[Img_slice]): The slices of the original image.
+    tiles (Rhombi_array): The tiles for the mosaic.
+    tile_colors (Tile_colors): The colors of the tiles, see calculate_tile_colors.
     size (Tuple[int, int]): The size of the original image.
     config (dict): The configuration settings.
     
     Returns:
-    Image.Image: The mosaic.
+    Image.Image: The mosaic, or None if it was rendered in bands, see render_mosaic_bands, and already saved.
     """
     log_message(f'8- Replacing slices with images from database...', config)
     config['timing']['replace_slices'] = time.time()
     with open(config['database_path'], 'r') as file:
         database_dict = json.load(file)
-    mosaic, color_mosaic = replace_slices(slices, database_dict, config['scale_factor'], config['image_folder'])
+    mask_cache = MaskCache(config.get('mask_cache_mb', 256) * 2 ** 20)
+    image_pool = ImagePool(config['image_pool']) if config.get('image_pool') else None
+    image_cache = ImageCache(config.get('image_cache_mb', 512) * 2 ** 20, config.get('pyramid_folder'), image_pool)
+    color_space = config.get('color_space', 'rgb')
+    features = load_database_features(database_dict, config['database_path'])
+    match_lut = load_match_lut(database_dict, config['database_path'], color_space) if config.get('match_lut', False) else None
+    if config.get('match_lut', False) and match_lut is None:
+        log_message(f'(match lut) The match LUT is missing or stale, matching exactly', config)
+    matcher = create_matcher(database_dict, color_space, config.get('match_mode', 'color'), features, match_lut, config['image_folder'])
     scaled_canvas_size = (int(size[0] * config['scale_factor']), int(size[1] * config['scale_factor']))
-    new_canvas = create_canvas(scaled_canvas_size)
-    color_canvas = create_canvas(scaled_canvas_size)
-    print('TEMP: Placing slices on canvas...')
-    place_slices_on_canvas(new_canvas, mosaic)
-    place_slices_on_canvas(color_canvas, color_mosaic)
+    workers = config.get('render_workers', 1) or os.cpu_count()
+    # The options every render mode shares
+    render_options = {
+        'matcher': matcher,
+        'max_uses': config.get('max_image_uses', 0),
+        'neighbor_distance': config.get('neighbor_exclusion', 0),
+        'supersample': config.get('color_supersample', 1),
+        'blend_mode': config.get('blend_mode', 'overlay'),
+        'blend_strength': config.get('blend_strength', 0),
+        'blend_opacity': config.get('blend_opacity', 0.5),
+        'rng': np.random.default_rng(config.get('seed')),
+        'verbose': config.get('verbose', False),
+    }
+    if workers > 1 and config.get('band_height', 0) <= 0:
+        new_canvas, color_canvas = render_mosaic_parallel(tiles, tile_colors, database_dict, config['scale_factor'], config['image_folder'], scaled_canvas_size, workers,
+                                                          image_cache_bytes=config.get('image_cache_mb', 512) * 2 ** 20, pyramid_folder=config.get('pyramid_folder'),
+                                                          image_pool_path=config.get('image_pool'), **render_options)
+        elapsed_time = round(time.time() - config["timing"]["replace_slices"], 3)
+        log_message(f'9- Replaced {len(tiles)} slices on {workers} processes. Took {elapsed_time}s', config)
+        return new_canvas, color_canvas
+    render_options.update(mask_cache=mask_cache, image_cache=image_cache, threads=config.get('render_threads', 1) or os.cpu_count(), queue_size=config.get('render_queue_size', 0))
+    if config.get('band_height', 0) > 0:
+        bands = render_mosaic_bands(tiles, tile_colors, database_dict, config['scale_factor'], config['image_folder'], scaled_canvas_size, config['band_height'],
+                                    os.path.join(config['output_path'], config['mosaic_name']), os.path.join(config['output_path'], config['color_mosaic_name']), **render_options)
+        elapsed_time = round(time.time() - config["timing"]["replace_slices"], 3)
+        log_message(f'9- Replaced {len(tiles)} slices and saved the mosaics in {bands} bands. Took {elapsed_time}s', config)
+        return None, None
+    new_canvas, color_canvas = render_mosaic(tiles, tile_colors, database_dict, config['scale_factor'], config['image_folder'], scaled_canvas_size, **render_options)
+    log_message(f'(mask cache) {len(mask_cache.masks)} masks, {mask_cache.hits} hits, {mask_cache.misses} misses', config)
+    log_message(f'(image cache) {len(image_cache.images)} images, {round(image_cache.bytes / 2 ** 20, 1)}MB, {image_cache.hits} hits, {image_cache.misses} misses', config)
     elapsed_time = round(time.time() - config["timing"]["replace_slices"], 3)
-    log_message(f'9- Replaced {len(slices)} slices. Took {elapsed_time}s', config)
+    log_message(f'9- Replaced {len(tiles)} slices. Took {elapsed_time}s', config)
     return new_canvas, color_canvas
\ No newline at end of file
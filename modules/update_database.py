@@ -1,9 +1,66 @@
 from .utils import *
-import json, os, re
+from .matching import *
+from .pyramids import update_pyramids
+from .image_pool import get_pool_index_path, update_image_pool
+import hashlib, json, os, re
+
+def get_manifest_path(database_path: str) -> str:
+    """
+    Get the path of the manifest that goes with a database json.
+
+    Parameters:
+    database_path (str): The path to the database.
+
+    Returns:
+    str: The path to the manifest json.
+    """
+    return os.path.splitext(database_path)[0] + '_manifest.json'
+
+def hash_file(path: str, chunk_bytes: int = 2 ** 20) -> str:
+    """
+    Hash the contents of a file, a chunk at a time.
+
+    Parameters:
+    path (str): The path to the file.
+    chunk_bytes (int): The bytes read at a time.
+
+    Returns:
+    str: The sha1 hex digest.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def ingest_image(source_path: str, database_image_path: str, max_size: Tuple[int, int]) -> Tuple[float, float, float, float]:
+    """
+    Measure a source image and save its downscaled copy to the image folder.
+
+    Parameters:
+    source_path (str): The path to the source image.
+    database_image_path (str): The path to the copy in the image folder.
+    max_size (Tuple[int, int]): The maximum size of the copy.
+
+    Returns:
+    Tuple[float, float, float, float]: The average color and the color variance of the image.
+    """
+    with Image.open(source_path) as img:
+        r, b, g = calculate_average_color(img)
+        color_var = calculate_color_variance(img)
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        img.save(database_image_path, optimize=True)
+    return (r, b, g, color_var)
 
 def update_image_database(config: dict, max_size: Tuple[int, int]=(1024, 1024)) -> int:
     """
-    Update the image database if the source folder has been modified since the last update.
+    Update the image database with the changes of the source folder since the last update.
+    A manifest next to the database records the size, modification time and content hash of every source image.
+    Images with the same size and modification time are not read at all, the others are hashed: only new and
+    modified images are decoded again, and an image with the hash of a removed one is a rename, so its entry
+    and its copy in the image folder are moved to the new name. When nothing changed, the features and the match
+    LUT are only loaded to check them and the pyramids and the image pool are left alone, so nothing is written;
+    otherwise the pyramids and the pool only rebuild the images that the manifest found new or modified.
     
     Parameters:
     source_folder (str): The path to the source folder.
@@ -12,65 +69,102 @@ def update_image_database(config: dict, max_size: Tuple[int, int]=(1024, 1024))
     max_size (Tuple[int, int]): The maximum size of the images in the image folder.
     
     Returns:
-    bool: True if the database was updated, False otherwise."""
+    int: The number of files in the source folder."""
     source_folder = config['source_folder']
     database_path = config['database_path']
     image_folder = config['image_folder']
+    manifest_path = get_manifest_path(database_path)
     if os.path.exists(database_path):
         with open(database_path, 'r') as file:
             image_database = json.load(file)
     else:
         image_database = {}
-    source_images = set(os.listdir(source_folder))
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+    else:
+        manifest = {}
+    source_stats = {}
+    for entry in os.scandir(source_folder):
+        if entry.is_file():
+            stat = entry.stat()
+            source_stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
     database_images = set(os.listdir(image_folder))
+    in_database = lambda name: name in image_database and name in database_images
 
-    # Remove entries from the json database if the corresponding image is no longer present
-    for img_name in set(image_database.keys()) - source_images:
-        del image_database[img_name]
-            
-    # Remove deleted images from the image database
-    for image in database_images - source_images:
-        os.remove(os.path.join(image_folder, image))
-        
-    # Add new images to the database
-    for image in source_images - database_images:
+    # Only the images that are new or whose size or modification time changed are hashed
+    recorded = {name: (entry['size'], entry['modified']) for name, entry in manifest.items() if name in image_database and name in database_images}
+    pending = [name for name, stat in source_stats.items() if recorded.get(name) != stat]
+    # Removed images by hash, to find the renamed ones
+    removed_by_hash = {entry['hash']: name for name, entry in manifest.items() if name not in source_stats and in_database(name)}
+    ingested, renamed, failed = set(), 0, 0
+    for image in sorted(pending):
         source_path = os.path.join(source_folder, image)
         database_image_path = os.path.join(image_folder, image)
-        if image not in image_database:
-            try:
-                with Image.open(source_path) as img:
-                    r, b, g = calculate_average_color(img)
-                    color_var = calculate_color_variance(img)
-                    image_database[image] = (r, b, g, color_var)
-                    img.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    img.save(database_image_path, optimize=True)
-            except IOError:
-                print(f"Error opening {image}. Skipping.")
+        content_hash = hash_file(source_path)
+        if in_database(image) and manifest.get(image, {'hash': content_hash})['hash'] == content_hash:
+            # Touched but not modified, or in a database from before the manifest
+            pass
+        elif content_hash in removed_by_hash:
+            previous_name = removed_by_hash.pop(content_hash)
+            image_database[image] = image_database.pop(previous_name)
+            os.replace(os.path.join(image_folder, previous_name), database_image_path)
+            database_images.discard(previous_name)
+            database_images.add(image)
+            renamed += 1
         else:
             try:
-                with Image.open(source_path) as img:
-                    img.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    img.save(database_image_path, optimize=True)
+                image_database[image] = ingest_image(source_path, database_image_path, max_size)
             except IOError:
-                print(f"Error opening {image} already in json database. Skipping.")
-    # Images that are in the source images but we haven't added to the json yet because they 
-    # were already in the database -> this can happen if you modify the database json at some 
-    # point or something went wrong during this process before
-    for image in source_images - set(image_database.keys()):
-        source_path = os.path.join(source_folder, image)
-        try:
-            with Image.open(source_path) as img:
-                r, b, g = calculate_average_color(img)
-                color_var = calculate_color_variance(img)
-                image_database[image] = (r, b, g, color_var)
-        except IOError:
-            print(f"Error opening {image} already in image folder database. Skipping.")
-    # Save the updated database
-    with open(database_path, 'w') as file:
-        json.dump(image_database, file)
-    return len(source_images)
-
-def find_matching_indices(directory: str, pattern_str: str = r'rhombi_(\d+)'):
+                print(f"Error opening {image}. Skipping.")
+                failed += 1
+                continue
+            database_images.add(image)
+            ingested.add(image)
+        manifest[image] = {'size': source_stats[image][0], 'modified': source_stats[image][1], 'hash': content_hash}
+
+    # Remove the entries, the manifest records and the downscaled copies of the images no longer present
+    removed_images = set(image_database.keys()) - set(source_stats)
+    for img_name in removed_images:
+        del image_database[img_name]
+    for image in database_images - set(source_stats):
+        os.remove(os.path.join(image_folder, image))
+    removed_records = set(manifest) - set(source_stats)
+    for img_name in removed_records:
+        del manifest[img_name]
+    # Files that cannot be opened are tried again on every update, without rewriting an unchanged database
+    if len(pending) > failed or removed_images or removed_records:
+        # Save the updated database
+        with open(database_path, 'w') as file:
+            json.dump(image_database, file)
+        with open(manifest_path, 'w') as file:
+            json.dump(manifest, file)
+    log_message(f'(manifest) {len(source_stats) - len(pending)} unchanged, {len(ingested)} ingested, {renamed} renamed, {len(removed_images)} removed', config)
+    database_changed = bool(ingested or renamed or removed_images)
+    # Recalculate the matching features and the match LUT when the database contents changed
+    features = load_database_features(image_database, database_path) if not ingested else {}
+    if not features or 'grid' not in features or 'crop' not in features:
+        previous = load_database_features(image_database, database_path, check_hash=False)
+        # The features of the modified images are stale
+        stale = [row for row, name in enumerate(image_database.keys()) if name in ingested]
+        for values in previous.values():
+            values[stale] = np.nan
+        features = calculate_database_features(image_database, image_folder, previous)
+        save_database_features(features, image_database, database_path)
+    color_space = config.get('color_space', 'rgb')
+    if config.get('match_lut', False) and image_database and load_match_lut(image_database, database_path, color_space) is None:
+        save_match_lut(build_match_lut(image_database, config.get('match_lut_bits', 6), color_space, features), image_database, database_path, color_space)
+        log_message(f'(match lut) Rebuilt the match LUT for {len(image_database)} images', config)
+    # The pyramids and the pool follow the database copies, which only change with the manifest
+    if config.get('pyramid_folder') and (database_changed or not os.path.isdir(config['pyramid_folder'])):
+        built = update_pyramids(image_folder, config['pyramid_folder'], sorted(image_database.keys()), sorted(ingested))
+        log_message(f'(pyramids) Built {built} image pyramids', config)
+    if config.get('image_pool') and (database_changed or not os.path.exists(config['image_pool']) or not os.path.exists(get_pool_index_path(config['image_pool']))):
+        added, removed = update_image_pool(image_folder, config['image_pool'], sorted(image_database.keys()), sorted(ingested))
+        log_message(f'(image pool) Packed {added} images and dropped {removed}', config)
+    return len(source_stats)
+
+def find_matching_indices(directory: str, pattern_str: str = r'rhombi_(\d+)\.npy$'):
     pattern = re.compile(pattern_str)
     indices = []
 
@@ -8,6 +8,22 @@ Triangle = Tuple[str, complex, complex, complex] # shape, v1, v2, v3
 Rhombi = Tuple[complex, complex, complex, complex] # 4 vertices
 Img_slice = Tuple[Image.Image, Tuple[float, float], List[Tuple[float, float]]] # Image, top-left position, relative vertices
 Img_database_object = Tuple[int, int, int, float] # r, g, b, color_variance
+Triangle_arrays = Tuple[np.ndarray, np.ndarray] # shape codes (N,), vertices (N, 3) complex
+Rhombi_array = np.ndarray # vertices (N, 4) complex, sorted by angle around each centroid
+Tile_colors = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] # mean colors (N, 3), pixel counts (N,), color variances (N,), grid colors (N, 4, 3) or None
+
+GRID_CELLS = 2 # the grid colors split the bounding box of a tile or image into GRID_CELLS x GRID_CELLS cells
+
+# Shape codes used by the array based tiling engine
+THIN, THICK = 0, 1
+SHAPE_NAMES = ("thin", "thick")
+TRIANGLE_SIDES = np.array([(0, 1), (1, 2), (0, 2)]) # vertex indices of the sides of a triangle
+
+# sRGB (D65) to CIE XYZ, and the D65 white point
+SRGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
 
 def create_canvas(size: Tuple[int, int]) -> Image.Image:
     """
@@ -75,6 +91,22 @@ def color_distance(color1: Tuple[int, int, int], color2: Tuple[int, int, int]) -
     r2, g2, b2 = color2
     return ((r1 - r2) ** 2 + (g1 - g2) ** 2 + (b1 - b2) ** 2) ** 0.5
 
+def rgb_to_lab(colors: np.ndarray) -> np.ndarray:
+    """
+    Convert sRGB colors to CIELAB, where Euclidean distances follow perceived color differences.
+    
+    Parameters:
+    colors (np.ndarray): The colors (..., 3), 0 to 255.
+    
+    Returns:
+    np.ndarray: The L, a, b values (..., 3).
+    """
+    rgb = np.asarray(colors, dtype=np.float64) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ SRGB_TO_XYZ.T / D65_WHITE
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack((116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])), axis=-1)
+
 def calculate_color_variance(image: Image.Image) -> float:
     """
     Calculate the variance of the colors in an image.
@@ -95,6 +127,53 @@ def calculate_color_variance(image: Image.Image) -> float:
         variance = np.mean(variances)  # Overall variance
     return variance
 
+def calculate_summed_area_tables(image: Image.Image, max_side: int = 1024) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Calculate the summed area tables of the colors and squared colors of an image.
+    Large images are reduced first, so the tables stay small while boxes are still measured in image pixels.
+    
+    Parameters:
+    image (Image.Image): The image.
+    max_side (int): The largest side of the image used for the tables.
+    
+    Returns:
+    Tuple[np.ndarray, np.ndarray, int]: The tables of sums and squared sums (H + 1, W + 1, 3) and the reduction factor.
+    """
+    factor = max(1, math.ceil(max(image.size) / max_side))
+    image = image.convert('RGB')
+    if factor > 1:
+        image = image.reduce(factor)
+    pixels = np.asarray(image, dtype=np.float64)
+    sums = np.zeros((pixels.shape[0] + 1, pixels.shape[1] + 1, 3))
+    squared_sums = np.zeros_like(sums)
+    sums[1:, 1:] = pixels.cumsum(axis=0).cumsum(axis=1)
+    squared_sums[1:, 1:] = (pixels ** 2).cumsum(axis=0).cumsum(axis=1)
+    return sums, squared_sums, factor
+
+def calculate_box_variances(tables: Tuple[np.ndarray, np.ndarray, int], boxes: np.ndarray) -> np.ndarray:
+    """
+    Calculate the color variance inside many boxes at once, averaged over the channels like calculate_color_variance.
+    
+    Parameters:
+    tables (Tuple[np.ndarray, np.ndarray, int]): The summed area tables, see calculate_summed_area_tables.
+    boxes (np.ndarray): The boxes (N, 4) as (min_x, min_y, max_x, max_y) in image pixels.
+    
+    Returns:
+    np.ndarray: The variance (N,) inside each box, 0 for boxes outside the image.
+    """
+    sums, squared_sums, factor = tables
+    height, width = sums.shape[0] - 1, sums.shape[1] - 1
+    x0 = np.clip(np.floor(boxes[:, 0] / factor), 0, width).astype(np.int64)
+    y0 = np.clip(np.floor(boxes[:, 1] / factor), 0, height).astype(np.int64)
+    x1 = np.clip(np.ceil(boxes[:, 2] / factor), 0, width).astype(np.int64)
+    y1 = np.clip(np.ceil(boxes[:, 3] / factor), 0, height).astype(np.int64)
+    area = ((x1 - x0) * (y1 - y0))[:, None]
+    box_sum = lambda table: table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = box_sum(sums) / area
+        variance = box_sum(squared_sums) / area - mean ** 2
+    return np.where(area[:, 0] > 0, variance.mean(axis=1), 0)
+
 def calculate_average_color(image_slice: Image.Image) -> Tuple[int, int, int]:
     """
     Calculate the average color of an image.
@@ -226,6 +305,9 @@ def load_image(config: dict) -> Image.Image:
     return original_image
 
 def save_mosaic(mosaic, color_mosaic, config):
+    if mosaic is None:
+        log_message(f'10- Mosaics already saved band by band', config)
+        return True
     log_message(f'10- Saving mosaics', config)
     config['timing']['save_mosaic'] = time.time()
     mosaic.save(os.path.join(config['output_path'], config['mosaic_name']), optimize=True)
@@ -234,28 +316,91 @@ def save_mosaic(mosaic, color_mosaic, config):
     log_message(f'11- Saved mosaics. Took {elapsed_time}s', config)
     return True
          
-def save_vector(vectors: List[Tuple], name:str, config: dict):
-    serializable_list = serialize_vector_complex(vectors)
-    json_str = json.dumps(serializable_list)
-    with open(f'{config["vector_dir"]}/{name}.json', 'w') as file:
-        file.write(json_str)
+def classify_rhombi(rhombi: Rhombi_array) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Classify rhombi by shape and orientation.
+    Thin rhombi have a 36 degree corner and thick ones a 72 degree corner. The orientation is the
+    direction of the long diagonal modulo 180 degrees in 18 degree steps, so it is one of ten codes.
+    
+    Parameters:
+    rhombi (Rhombi_array): The rhombi, at any scale.
+    
+    Returns:
+    Tuple[np.ndarray, np.ndarray]: The shape codes (N,) and the orientation codes (N,) of the rhombi.
+    """
+    diagonal_a = rhombi[:, 2] - rhombi[:, 0]
+    diagonal_b = rhombi[:, 3] - rhombi[:, 1]
+    long_diagonal = np.where(np.abs(diagonal_a) >= np.abs(diagonal_b), diagonal_a, diagonal_b)
+    # Diagonal ratio: tan(18) ~ 0.32 for thin rhombi, tan(36) ~ 0.73 for thick ones
+    ratio = np.minimum(np.abs(diagonal_a), np.abs(diagonal_b)) / np.maximum(np.abs(diagonal_a), np.abs(diagonal_b))
+    shapes = np.where(ratio < 0.5, THIN, THICK).astype(np.uint8)
+    orientations = np.rint(np.degrees(np.angle(long_diagonal)) / 18).astype(np.int64) % 10
+    return shapes, orientations.astype(np.uint8)
+
+def tile_store_dtype(vertex_dtype: np.dtype = np.float32) -> np.dtype:
+    """
+    Get the record layout of the binary tile vector store.
+    
+    Parameters:
+    vertex_dtype (np.dtype): The float type used for vertices and bounding boxes.
+    
+    Returns:
+    np.dtype: One record per rhombus with its vertices (x, y), shape, orientation and bounding box (min_x, min_y, max_x, max_y).
+    """
+    return np.dtype([
+        ('vertices', vertex_dtype, (4, 2)),
+        ('shape', np.uint8),
+        ('orientation', np.uint8),
+        ('bbox', vertex_dtype, (4,)),
+    ])
+
+def save_vector(rhombi: Rhombi_array, name: str, config: dict, vertex_dtype: np.dtype = np.float32) -> bool:
+    """
+    Save precomputed rhombi to the binary tile vector store ({vector_dir}/{name}.npy).
+    
+    Parameters:
+    rhombi (Rhombi_array): The rhombi.
+    name (str): The name of the vector, e.g. rhombi_9.
+    config (dict): The configuration settings.
+    vertex_dtype (np.dtype): The float type used for vertices, float32 or float64.
+    
+    Returns:
+    bool: True once the vector has been saved.
+    """
+    rhombi = np.asarray(rhombi, dtype=np.complex128).reshape(-1, 4)
+    store = np.empty(len(rhombi), dtype=tile_store_dtype(vertex_dtype))
+    store['vertices'] = np.stack((rhombi.real, rhombi.imag), axis=-1)
+    store['shape'], store['orientation'] = classify_rhombi(rhombi)
+    store['bbox'] = np.stack((rhombi.real.min(axis=1), rhombi.imag.min(axis=1), rhombi.real.max(axis=1), rhombi.imag.max(axis=1)), axis=1)
+    np.save(os.path.join(config["vector_dir"], f'{name}.npy'), store)
     return True
+
+def load_vector_file(file_name: str, vector_dir: str = 'photomosaic/vectors') -> np.ndarray:
+    """
+    Open a binary tile vector store with memory mapping, nothing is read until it is used.
     
-def serialize_vector_complex(vectors: List[Tuple]) -> List[Tuple]:
-    return [[(c.real, c.imag) for c in t] for t in vectors]
+    Parameters:
+    file_name (str): The file name, e.g. rhombi_9.npy.
+    vector_dir (str): The directory with the vectors.
+    
+    Returns:
+    np.ndarray: The read-only store records, see tile_store_dtype.
+    """
+    return np.load(os.path.join(vector_dir, file_name), mmap_mode='r')
 
-def de_serialize_vector_complex(serializable_list: List[Tuple]) -> List[Tuple]:
-    return [tuple(complex(real, imag) for real, imag in t) for t in serializable_list]
-        
-def load_vector(name: str) -> List[Tuple]:
-    with open(f'photomosaic/vectors/{name}.json', 'r') as file:
-        serializable_list = json.load(file)
-    return de_serialize_vector_complex(serializable_list)
-
-def load_vector_file(file_name: str) -> List[List[List[float]]]:
-    with open(f'photomosaic/vectors/{file_name}', 'r') as file:
-        serializable_list = json.load(file)
-    return serializable_list
+def load_vector(name: str, vector_dir: str = 'photomosaic/vectors') -> Rhombi_array:
+    """
+    Load precomputed rhombi from the binary tile vector store.
+    
+    Parameters:
+    name (str): The name of the vector, e.g. rhombi_9.
+    vector_dir (str): The directory with the vectors.
+    
+    Returns:
+    Rhombi_array: The rhombi.
+    """
+    vertices = load_vector_file(f'{name}.npy', vector_dir)['vertices']
+    return vertices[..., 0] + 1j * vertices[..., 1]
 
 def list_files_in_folder(folder_path):
     """
@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+from ..modules.assignment import * # python -m photomosaic.unit_tests.test_assignment
+from ..modules.create_tiles import create_tiles, normalize_and_scale_tiles
+from ..modules.matching import create_matcher
+
+class TestAssignmentFunctions(unittest.TestCase):
+
+    def test_tile_adjacency_is_symmetric(self):
+        tiles = normalize_and_scale_tiles(create_tiles(5, False), (500, 500))
+        indptr, indices = find_tile_adjacency(tiles)
+        degrees = np.diff(indptr)
+        self.assertLessEqual(degrees.max(), 4)
+        # Most tiles are inside the pattern and have 4 neighbors
+        self.assertGreater(np.mean(degrees == 4), 0.8)
+        pairs = set(zip(np.repeat(np.arange(len(tiles)), degrees).tolist(), indices.tolist()))
+        self.assertTrue(all((b, a) in pairs for a, b in pairs))
+        neighborhood_indptr, neighborhood = expand_neighborhoods(indptr, indices, 2)
+        self.assertTrue(np.all(np.diff(neighborhood_indptr) >= degrees))
+        self.assertFalse(np.any(neighborhood == np.repeat(np.arange(len(tiles)), np.diff(neighborhood_indptr))))
+
+    def test_assignment_respects_neighbors_and_caps(self):
+        rng = np.random.default_rng(0)
+        tiles = normalize_and_scale_tiles(create_tiles(6, False), (500, 500))
+        database = {f'{i}.jpg': (120 + i, 120, 120, 0) for i in range(30)}
+        matcher = create_matcher(database)
+        tile_colors = (np.full((len(tiles), 3), 120), None, None, None)
+        max_uses = int(np.ceil(len(tiles) / 20))
+        assignment = assign_tiles(tiles, tile_colors, matcher, max_uses=max_uses, neighbor_distance=2, rng=rng)
+        self.assertLessEqual(np.bincount(assignment).max(), max_uses)
+        indptr, indices = expand_neighborhoods(*find_tile_adjacency(tiles), 2)
+        sources = np.repeat(np.arange(len(tiles)), np.diff(indptr))
+        self.assertFalse(np.any(assignment[sources] == assignment[indices]))
+        # Without the rules the nearest image takes every tile
+        self.assertEqual(set(assign_tiles(tiles, tile_colors, matcher, rng=rng).tolist()), {0})
+
+    def test_assignment_falls_back_when_caps_run_out(self):
+        rng = np.random.default_rng(0)
+        tiles = normalize_and_scale_tiles(create_tiles(5, False), (500, 500))[:160]
+        database = {f'{i}.jpg': (120 + i, 120, 120, 0) for i in range(5)}
+        matcher = create_matcher(database)
+        tile_colors = (np.full((len(tiles), 3), 120), None, None, None)
+        # 5 images used at most 3 times cannot cover 160 tiles, the rest take their nearest image
+        assignment = assign_tiles(tiles, tile_colors, matcher, max_uses=3, rng=rng, verbose=False)
+        self.assertEqual(len(assignment), len(tiles))
+        self.assertGreaterEqual(assignment.min(), 0)
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+import os, tempfile
+from PIL import Image
+from ..modules.caches import * # python -m photomosaic.unit_tests.test_caches
+from ..modules.create_tiles import create_tiles, normalize_and_scale_tiles
+
+class TestCachesFunctions(unittest.TestCase):
+
+    def test_penrose_tiles_match_templates(self):
+        tiles = normalize_and_scale_tiles(create_tiles(5, False), (500, 500))
+        shapes, orientations = classify_rhombi(tiles)
+        self.assertTrue(np.all(matches_rhombus_template(tiles, shapes, orientations)))
+        square = np.array([[0, 10, 10 + 10j, 10j]])
+        self.assertFalse(matches_rhombus_template(square, *classify_rhombi(square))[0])
+
+    def test_mask_cache_reuses_and_evicts(self):
+        tiles = normalize_and_scale_tiles(create_tiles(5, False), (500, 500)) * 4
+        shapes, orientations = classify_rhombi(tiles)
+        cache = MaskCache()
+        for tile, shape, orientation in zip(tiles, shapes, orientations):
+            mask, position = cache.get_mask(tile, shape, orientation)
+            # The mask covers the tile from its integer position, up to the quantized phase
+            self.assertLessEqual(position[0], tile.real.min() + 0.5 / cache.phase_steps)
+            self.assertGreaterEqual(position[0] + mask.size[0] + 1, tile.real.max())
+        self.assertEqual(cache.hits + cache.misses, len(tiles))
+        self.assertLessEqual(cache.misses, 2 * 10 * 4 * 4)
+        small_cache = MaskCache(max_bytes=1)
+        for tile, shape, orientation in zip(tiles[:20], shapes, orientations):
+            small_cache.get_mask(tile, shape, orientation)
+        self.assertEqual(len(small_cache.masks), 1)
+
+
+    def test_image_cache_reuses_and_evicts(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = []
+            for i in range(3):
+                paths.append(os.path.join(folder, f'{i}.png'))
+                Image.new('RGB', (10, 10), (i, 0, 0)).save(paths[-1])
+            cache = ImageCache()
+            for path in paths + paths:
+                cache.get_image(path)
+            self.assertEqual((cache.hits, cache.misses, cache.bytes), (3, 3, 900))
+            self.assertEqual(cache.get_image(paths[1]).getpixel((0, 0)), (1, 0, 0))
+            small_cache = ImageCache(max_bytes=400)
+            for path in paths:
+                small_cache.get_image(path)
+            self.assertEqual(len(small_cache.images), 1)
+            small_cache.get_image(paths[0])
+            self.assertEqual(small_cache.misses, 4)
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+import os, tempfile
+from PIL import Image
+from ..modules.image_pool import * # python -m photomosaic.unit_tests.test_image_pool
+from ..modules.caches import ImageCache
+
+class TestImagePoolFunctions(unittest.TestCase):
+
+    def test_pool_views_match_pyramids(self):
+        with tempfile.TemporaryDirectory() as folder:
+            pool_path = os.path.join(folder, 'pool.bin')
+            rng = np.random.default_rng(0)
+            pixels = {name: rng.integers(0, 255, (200, 300, 3), dtype=np.uint8) for name in ('a.png', 'b.png')}
+            for name, image in pixels.items():
+                Image.fromarray(image).save(os.path.join(folder, name))
+            self.assertEqual(update_image_pool(folder, pool_path, ['a.png', 'b.png']), (2, 0))
+            pool = ImagePool(pool_path)
+            for name, image in pixels.items():
+                levels = build_pyramid(Image.fromarray(image))
+                view, level = pool.get_level(name, (70, 40))
+                self.assertEqual(level, 2)
+                self.assertTrue(np.array_equal(view, levels[2]))
+                self.assertFalse(view.flags.writeable)
+                self.assertTrue(np.array_equal(pool.get_level(name)[0], image))
+            cache = ImageCache(image_pool=pool)
+            self.assertEqual(cache.get_image(os.path.join(folder, 'b.png'), (70, 40)).size, (75, 50))
+
+    def test_incremental_update_and_compaction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            pool_path = os.path.join(folder, 'pool.bin')
+            for index, name in enumerate(('a.png', 'b.png', 'c.png')):
+                Image.new('RGB', (128, 128), (index * 50, 0, 0)).save(os.path.join(folder, name))
+            update_image_pool(folder, pool_path, ['a.png', 'b.png'])
+            size = os.path.getsize(pool_path)
+            # Adding an image only appends its levels
+            self.assertEqual(update_image_pool(folder, pool_path, ['a.png', 'b.png', 'c.png']), (1, 0))
+            self.assertEqual(os.path.getsize(pool_path), size * 3 // 2)
+            # An update with nothing to do does not rewrite the index
+            index_path = get_pool_index_path(pool_path)
+            os.utime(index_path, (0, 0))
+            self.assertEqual(update_image_pool(folder, pool_path, ['a.png', 'b.png', 'c.png']), (0, 0))
+            self.assertEqual(os.path.getmtime(index_path), 0)
+            # Removing one image leaves dead bytes, removing two compacts the pool
+            self.assertEqual(update_image_pool(folder, pool_path, ['b.png', 'c.png']), (0, 1))
+            self.assertEqual(os.path.getsize(pool_path), size * 3 // 2)
+            self.assertEqual(update_image_pool(folder, pool_path, ['c.png']), (0, 1))
+            self.assertEqual(os.path.getsize(pool_path), size // 2)
+            view, _ = ImagePool(pool_path).get_level('c.png')
+            self.assertTrue(np.all(view == (100, 0, 0)))
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+import numpy as np
+import math, os, tempfile
+from PIL import Image, ImageDraw
+from ..modules.matching import * # python -m photomosaic.unit_tests.test_matching
+from ..modules.replace_slices import calculate_tile_colors
+
+class TestMatchingFunctions(unittest.TestCase):
+
+    def test_grid_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        database = {f'{i}.jpg': tuple(int(c) for c in color) + (0,) for i, color in enumerate(rng.integers(0, 256, (300, 3)))}
+        matcher = ColorMatcher(database)
+        colors = rng.integers(0, 256, (2000, 3))
+        features = np.array([color[:3] for color in database.values()])
+        distances = ((colors[:, None, :] - features[None, :, :]) ** 2).sum(axis=2)
+        matched = matcher.match(colors, rng)
+        self.assertTrue(np.array_equal(distances[np.arange(len(colors)), matched], distances.min(axis=1)))
+
+    def test_ties_pick_any_image_with_the_color(self):
+        database = {'a.jpg': (10, 10, 10, 5), 'b.jpg': (10, 10, 10, 7), 'c.jpg': (200, 200, 200, 1)}
+        matcher = ColorMatcher(database)
+        matched = matcher.match(np.tile([[12, 9, 11]], (200, 1)), np.random.default_rng(1))
+        self.assertEqual({matcher.names[i] for i in matched}, {'a.jpg', 'b.jpg'})
+        self.assertEqual(matcher.names[matcher.match(np.array([[255, 250, 180]]))[0]], 'c.jpg')
+
+    def test_empty_database(self):
+        with self.assertRaises(ValueError):
+            ColorMatcher({})
+
+    def test_match_lut_is_close_and_invalidated(self):
+        rng = np.random.default_rng(2)
+        database = {f'{i}.jpg': tuple(int(c) for c in color) + (0,) for i, color in enumerate(rng.integers(0, 256, (100, 3)))}
+        lut_matcher = ColorMatcher(database, lut=build_match_lut(database))
+        exact_matcher = ColorMatcher(database)
+        colors = rng.integers(0, 256, (1000, 3))
+        features = lut_matcher.features
+        exact = np.sqrt(((colors - features[exact_matcher.match(colors)]) ** 2).sum(axis=1))
+        approximate = np.sqrt(((colors - features[lut_matcher.match(colors)]) ** 2).sum(axis=1))
+        # The cell center is at most 2 * sqrt(3) away from the color
+        self.assertTrue(np.all(approximate <= exact + 4 * np.sqrt(3)))
+        with tempfile.TemporaryDirectory() as folder:
+            database_path = os.path.join(folder, 'image_database.json')
+            self.assertIsNone(load_match_lut(database, database_path))
+            save_match_lut(lut_matcher.lut, database, database_path)
+            self.assertTrue(np.array_equal(load_match_lut(dict(reversed(database.items())), database_path), lut_matcher.lut))
+            database['new.jpg'] = (1, 2, 3, 0)
+            self.assertIsNone(load_match_lut(database, database_path))
+
+    def test_lab_matching_and_stored_features(self):
+        rng = np.random.default_rng(3)
+        database = {f'{i}.jpg': tuple(int(c) for c in color) + (0,) for i, color in enumerate(rng.integers(0, 256, (200, 3)))}
+        matcher = ColorMatcher(database, 'lab')
+        colors = rng.integers(0, 256, (1000, 3))
+        distances = ((rgb_to_lab(colors)[:, None, :] - rgb_to_lab(matcher.colors)[None, :, :]) ** 2).sum(axis=2)
+        self.assertTrue(np.allclose(distances[np.arange(len(colors)), matcher.match(colors)], distances.min(axis=1)))
+        with tempfile.TemporaryDirectory() as folder:
+            database_path = os.path.join(folder, 'image_database.json')
+            save_database_features(calculate_database_features(database), database, database_path)
+            reordered = dict(reversed(database.items()))
+            features = load_database_features(reordered, database_path)
+            self.assertTrue(np.allclose(features['lab'], rgb_to_lab([color[:3] for color in reordered.values()])))
+            self.assertEqual(load_database_features({'other.jpg': (1, 2, 3, 0)}, database_path), {})
+
+    def test_ivf_index_finds_near_neighbors(self):
+        rng = np.random.default_rng(4)
+        vectors = rng.normal(size=(6000, 12)) * 40
+        queries = vectors[rng.choice(len(vectors), 500)] + rng.normal(size=(500, 12))
+        index = IVFIndex(vectors, n_probe=8)
+        self.assertGreater(len(index.centroids), 1)
+        exact = nearest_rows(queries, vectors)
+        self.assertGreater(np.mean(index.search(queries) == exact), 0.95)
+        self.assertTrue(np.array_equal(IVFIndex(vectors[:1000]).search(queries), nearest_rows(queries, vectors[:1000])))
+
+    def test_descriptor_matcher_prefers_the_same_split(self):
+        database = {'flat.jpg': (128, 128, 128, 0), 'split.jpg': (128, 128, 128, 0), 'other.jpg': (128, 128, 128, 0)}
+        grid = np.full((3, CROP_CLASSES, GRID_CELLS ** 2, 3), 128.0)
+        # Only the crop of class 3 of 'split.jpg' and the crop of class 0 of 'other.jpg' are split
+        grid[1, 3] = grid[2, 0] = [[0] * 3, [255] * 3, [0] * 3, [255] * 3]
+        matcher = create_matcher(database, match_mode='grid', features={'grid': grid.reshape(3, -1, 3)})
+        tile_colors = (np.full((2, 3), 128), np.array([100, 100]), np.zeros(2), np.array([[[10] * 3, [250] * 3, [10] * 3, [250] * 3]] * 2, dtype=float))
+        matches = matcher.match_tiles(tile_colors, tile_classes=np.array([3, 0]))
+        self.assertEqual([matcher.names[match] for match in matches], ['split.jpg', 'other.jpg'])
+        images, _ = matcher.candidates(tile_colors, 1, np.array([3, 0]))
+        self.assertEqual([matcher.names[image] for image in images[:, 0]], ['split.jpg', 'other.jpg'])
+
+    def test_crop_grid_colors_match_the_tile_grid(self):
+        x, y = np.meshgrid(np.arange(300), np.arange(200))
+        image = Image.fromarray(np.stack((x * 255 // 299, y * 255 // 199, np.full_like(x, 80)), axis=-1).astype(np.uint8))
+        grid_colors = calculate_crop_grid_colors(image).reshape(CROP_CLASSES, GRID_CELLS ** 2, 3)
+        for shape, orientation in ((0, 0), (0, 3), (1, 5), (1, 9)):
+            # The grid calculate_tile_colors measures on the crop replace_slices renders for a large tile of this class
+            vertices = rhombus_template_vertices(shape, orientation, 200.0)
+            vertices = vertices - complex(vertices.real.min(), vertices.imag.min())
+            scale = max(vertices.real.max() / image.size[0], vertices.imag.max() / image.size[1])
+            scaled = image.resize((math.ceil(image.size[0] * scale), math.ceil(image.size[1] * scale)))
+            tile_grid = calculate_tile_colors(scaled, np.array([vertices]), grid=True)[3][0]
+            self.assertTrue(np.allclose(grid_colors[shape * 10 + orientation], tile_grid, atol=4))
+
+    def test_crop_colors_match_the_rendered_crop(self):
+        x, y = np.meshgrid(np.arange(300), np.arange(200))
+        image = Image.fromarray(np.stack((x * 255 // 299, y * 255 // 199, np.full_like(x, 80)), axis=-1).astype(np.uint8))
+        crop_colors = calculate_crop_colors(image)
+        for shape, orientation in ((0, 0), (0, 3), (1, 5), (1, 9)):
+            # The crop replace_slices renders for a large tile of this class
+            vertices = rhombus_template_vertices(shape, orientation, 200.0)
+            vertices = vertices - complex(vertices.real.min(), vertices.imag.min())
+            width, height = vertices.real.max(), vertices.imag.max()
+            scale = max(width / image.size[0], height / image.size[1])
+            scaled = image.resize((math.ceil(image.size[0] * scale), math.ceil(image.size[1] * scale)))
+            mask = Image.new('L', scaled.size, 0)
+            ImageDraw.Draw(mask).polygon([(v.real, v.imag) for v in vertices], fill=255)
+            rendered = np.asarray(scaled, dtype=np.float64)[np.asarray(mask) > 0].mean(axis=0)
+            self.assertTrue(np.allclose(crop_colors[shape * 10 + orientation], rendered, atol=3))
+        # Wide and tall crops see different parts of the image
+        self.assertGreater(np.abs(crop_colors[0] - crop_colors[5]).max(), 20)
+
+    def test_crop_matcher_uses_the_class_crop(self):
+        database = {'a.jpg': (100, 100, 100, 0), 'b.jpg': (100, 100, 100, 0)}
+        crop = np.zeros((2, CROP_CLASSES, 3))
+        crop[0, :10], crop[0, 10:] = 50, 200
+        crop[1, :10], crop[1, 10:] = 200, 50
+        matcher = create_matcher(database, match_mode='crop', features={'crop': crop})
+        tile_colors = (np.array([[60, 60, 60], [60, 60, 60]]), None, None, None)
+        matched = matcher.match_tiles(tile_colors, tile_classes=np.array([3, 13]))
+        self.assertEqual([matcher.names[i] for i in matched], ['a.jpg', 'b.jpg'])
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
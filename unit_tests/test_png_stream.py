@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+import os, tempfile
+from PIL import Image
+from ..modules.png_stream import * # python -m photomosaic.unit_tests.test_png_stream
+
+class TestPngStreamFunctions(unittest.TestCase):
+
+    def test_rows_written_in_bands_read_back(self):
+        pixels = np.random.default_rng(0).integers(0, 255, (50, 30, 4), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'image.png')
+            with PngStreamWriter(path, (30, 50), chunk_bytes=1000) as writer:
+                for top in range(0, 50, 16):
+                    writer.write_rows(pixels[top:top + 16])
+            with Image.open(path) as image:
+                self.assertEqual(image.mode, 'RGBA')
+                self.assertTrue(np.array_equal(np.asarray(image), pixels))
+
+    def test_missing_rows(self):
+        with tempfile.TemporaryDirectory() as folder:
+            writer = PngStreamWriter(os.path.join(folder, 'image.png'), (4, 4), channels=3)
+            writer.write_rows(np.zeros((2, 4, 3), dtype=np.uint8))
+            with self.assertRaises(ValueError):
+                writer.write_rows(np.zeros((2, 5, 3), dtype=np.uint8))
+            with self.assertRaises(ValueError):
+                writer.close()
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
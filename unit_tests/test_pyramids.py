@@ -0,0 +1,39 @@
+import unittest
+import numpy as np
+import os, tempfile
+from PIL import Image
+from ..modules.pyramids import * # python -m photomosaic.unit_tests.test_pyramids
+from ..modules.caches import ImageCache
+
+class TestPyramidsFunctions(unittest.TestCase):
+
+    def test_pyramid_levels_and_choice(self):
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 255, (600, 1000, 3), dtype=np.uint8))
+        levels = build_pyramid(image)
+        self.assertEqual([level.shape[1::-1] for level in levels], [(1000, 600), (500, 300), (250, 150), (125, 75), (63, 38)])
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'image.png.npz')
+            save_pyramid(levels, path)
+            sizes = read_pyramid_sizes(path)
+            self.assertEqual(choose_pyramid_level(sizes, (60, 30)), 4)
+            self.assertEqual(choose_pyramid_level(sizes, (100, 20)), 3)
+            self.assertEqual(choose_pyramid_level(sizes, (2000, 20)), 0)
+            self.assertTrue(np.array_equal(np.asarray(load_pyramid_level(path, 2)), levels[2]))
+
+    def test_update_pyramids_and_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            image_folder, pyramid_folder = os.path.join(folder, 'images'), os.path.join(folder, 'pyramids')
+            os.makedirs(image_folder)
+            for name in ('a.png', 'b.png'):
+                Image.new('RGB', (512, 256), (10, 20, 30)).save(os.path.join(image_folder, name))
+            self.assertEqual(update_pyramids(image_folder, pyramid_folder, ['a.png', 'b.png']), 2)
+            self.assertEqual(update_pyramids(image_folder, pyramid_folder, ['a.png']), 0)
+            self.assertEqual(os.listdir(pyramid_folder), ['a.png.npz'])
+            cache = ImageCache(pyramid_folder=pyramid_folder)
+            self.assertEqual(cache.get_image(os.path.join(image_folder, 'a.png'), (40, 40)).size, (128, 64))
+            self.assertEqual(cache.get_image(os.path.join(image_folder, 'a.png')).size, (512, 256))
+            self.assertEqual(cache.get_image(os.path.join(image_folder, 'b.png'), (40, 40)).size, (512, 256))
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
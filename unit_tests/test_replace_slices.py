@@ -0,0 +1,213 @@
+import unittest
+import numpy as np
+import os, tempfile
+from PIL import Image, ImageDraw
+from ..modules.replace_slices import * # python -m photomosaic.unit_tests.test_replace_slices
+from ..modules.create_tiles import create_tiles, normalize_and_scale_tiles
+
+# A red and a blue image saved in the folder, with their database
+def create_color_database(folder: str) -> dict:
+    database = {'red.png': (250, 10, 10, 0), 'blue.png': (10, 10, 250, 0)}
+    for name, color in database.items():
+        Image.new('RGB', (64, 48), color[:3]).save(os.path.join(folder, name))
+    return database
+
+class TestReplaceSlicesFunctions(unittest.TestCase):
+
+    def test_calculate_tile_colors(self):
+        # Left half red, right half blue
+        image = Image.new('RGB', (100, 50), (255, 0, 0))
+        image.paste((0, 0, 255), (50, 0, 100, 50))
+        tiles = np.array([
+            [10 + 10j, 40 + 10j, 40 + 40j, 10 + 40j],
+            [60 + 10j, 90 + 10j, 90 + 40j, 60 + 40j],
+        ])
+        colors, counts, variances, _ = calculate_tile_colors(image, tiles)
+        self.assertEqual(colors.tolist(), [[255, 0, 0], [0, 0, 255]])
+        self.assertTrue(np.all(counts >= 30 * 30))
+        self.assertTrue(np.allclose(variances, 0))
+
+    def test_calculate_tile_grid_colors(self):
+        image = Image.new('RGB', (100, 50), (255, 0, 0))
+        image.paste((0, 0, 255), (50, 0, 100, 50))
+        tiles = np.array([[30 + 10j, 70 + 10j, 70 + 40j, 30 + 40j]])
+        grid_colors = calculate_tile_colors(image, tiles, grid=True, band_rows=7)[3]
+        self.assertEqual(grid_colors.round().tolist(), [[[255, 0, 0], [0, 0, 255], [255, 0, 0], [0, 0, 255]]])
+        # Only grid matching needs them
+        self.assertIsNone(calculate_tile_colors(image, tiles)[3])
+
+    def test_calculate_tile_colors_bands(self):
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 255, (90, 120, 3), dtype=np.uint8))
+        tiles = np.array([[10 + 5j, 70 + 20j, 60 + 80j, 5 + 60j], [70 + 20j, 115 + 10j, 110 + 85j, 60 + 80j]])
+        whole = calculate_tile_colors(image, tiles, grid=True, band_rows=90)
+        for band_rows in (1, 13, 64):
+            for expected, actual in zip(whole, calculate_tile_colors(image, tiles, grid=True, band_rows=band_rows)):
+                self.assertTrue(np.allclose(expected, actual))
+
+    def test_calculate_tile_colors_tiny_tile(self):
+        image = Image.new('RGB', (20, 20), (0, 255, 0))
+        tiles = np.array([[5.1 + 5.1j, 5.2 + 5.1j, 5.2 + 5.2j, 5.1 + 5.2j]])
+        colors, counts, _, _ = calculate_tile_colors(image, tiles)
+        self.assertEqual(colors.tolist(), [[0, 255, 0]])
+
+    def test_get_masked_slice_matches_full_frame_mask(self):
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 255, (120, 160, 3), dtype=np.uint8))
+        for vertices in ([(20.5, 30.2), (60.1, 10.7), (90.3, 40.9), (50.8, 60.4)], [(140.2, 100.5), (170.6, 90.1), (175.3, 130.8), (150.9, 125.2)]):
+            # Reference: mask drawn on the whole image, then cropped
+            mask = Image.new('L', image.size, 0)
+            ImageDraw.Draw(mask).polygon(vertices, outline=1, fill=255)
+            bounding_box = (min(int(v[0]) for v in vertices), min(int(v[1]) for v in vertices),
+                            max(int(v[0]) for v in vertices), max(int(v[1]) for v in vertices))
+            expected = image.crop(bounding_box)
+            expected.putalpha(mask.crop(bounding_box))
+            self.assertTrue(np.array_equal(np.asarray(get_masked_slice(image, vertices)), np.asarray(expected)))
+
+    def test_group_tile_renders(self):
+        matches = np.array([2, 0, 2, 2, 0])
+        sizes = np.array([[10, 8], [10, 8], [12, 8], [10, 8], [10, 8]])
+        groups = group_tile_renders(matches, sizes)
+        self.assertEqual([group.tolist() for group in groups], [[0, 3], [1, 4], [2]])
+        self.assertEqual([group.tolist() for group in group_tile_renders(matches, sizes, window=4)], [[0, 3], [1], [2], [4]])
+        self.assertEqual(group_tile_renders(np.zeros(0, dtype=np.int64), np.zeros((0, 2))), [])
+
+    def test_replaced_slices_keep_tile_order(self):
+        with tempfile.TemporaryDirectory() as folder:
+            database = create_color_database(folder)
+            # The second and third tiles share an image, the third one covers the first
+            tiles = np.array([[10 + 10j, 40 + 10j, 40 + 40j, 10 + 40j], [60 + 10j, 90 + 10j, 90 + 40j, 60 + 40j], [20 + 20j, 50 + 20j, 50 + 45j, 20 + 45j]])
+            tile_colors = (np.array([[0, 0, 255], [255, 0, 0], [255, 0, 0]]), np.full(3, 900), np.zeros(3), None)
+            rendered = iterate_replaced_slices(tiles, tile_colors, database, 1, folder, matches=np.array([1, 0, 0]), color_slices=False)
+            self.assertEqual([i for i, _, _ in rendered], [0, 1, 2])
+            mosaic, _ = render_mosaic(tiles, tile_colors, database, 1, folder, (100, 50))
+            self.assertEqual(mosaic.getpixel((30, 30))[:3], (250, 10, 10))
+
+    def test_render_mosaic_matches_placed_slices(self):
+        with tempfile.TemporaryDirectory() as folder:
+            database = create_color_database(folder)
+            tiles = np.array([[10 + 10j, 40 + 10j, 40 + 40j, 10 + 40j], [60 + 10j, 90 + 10j, 90 + 40j, 60 + 40j]])
+            tile_colors = (np.array([[255, 0, 0], [0, 0, 255]]), np.array([900, 900]), np.zeros(2), np.zeros((2, 4, 3)))
+            mosaic, color_mosaic = render_mosaic(tiles, tile_colors, database, 2, folder, (200, 100))
+            slices, _ = replace_slices(tiles, tile_colors, database, 2, folder)
+            expected = create_canvas((200, 100))
+            place_slices_on_canvas(expected, slices)
+            self.assertTrue(np.array_equal(np.asarray(mosaic), np.asarray(expected)))
+            self.assertEqual(color_mosaic.getpixel((50, 50)), (255, 0, 0, 255))
+            self.assertEqual(mosaic.getpixel((50, 50))[:3], (250, 10, 10))
+            self.assertEqual(mosaic.getpixel((150, 50))[:3], (10, 10, 250))
+
+    def test_render_color_mosaic(self):
+        tiles = np.array([[10.5 + 10j, 40 + 12.5j, 40 + 40j, 10 + 35.5j], [40 + 12.5j, 70 + 10j, 70 + 40j, 40 + 40j]])
+        colors = np.array([[255, 0, 0], [0, 0, 255]])
+        expected = create_canvas((80, 50))
+        draw = ImageDraw.Draw(expected)
+        for tile, color in zip(tiles, colors.tolist()):
+            draw.polygon([(vertex.real, vertex.imag) for vertex in tile], fill=tuple(color) + (255,), outline=tuple(color) + (255,))
+        self.assertTrue(np.array_equal(np.asarray(render_color_mosaic(tiles, colors, (80, 50))), np.asarray(expected)))
+        # The offset canvas is a window of the full one
+        window = render_color_mosaic(tiles, colors, (80, 20), offset=(0, 20))
+        self.assertTrue(np.array_equal(np.asarray(window), np.asarray(expected)[20:40]))
+        smooth = np.asarray(render_color_mosaic(tiles, colors, (80, 50), supersample=4))
+        self.assertEqual(tuple(smooth[25, 20]), (255, 0, 0, 255))
+        # Partial coverage on the outer edges, none on the seam between the tiles
+        self.assertTrue(np.any((smooth[:, :, 3] > 0) & (smooth[:, :, 3] < 255)))
+        self.assertTrue(np.all(smooth[20:30, 38:42, 3] == 255))
+
+    def test_render_mosaic_bands_matches_full_render(self):
+        with tempfile.TemporaryDirectory() as folder:
+            database = create_color_database(folder)
+            # The first tile crosses the band edge at 32 pixels
+            tiles = np.array([[10 + 10j, 40 + 10j, 40 + 40j, 10 + 40j], [60 + 25j, 90 + 25j, 90 + 45j, 60 + 45j]])
+            tile_colors = (np.array([[255, 0, 0], [0, 0, 255]]), np.array([900, 600]), np.zeros(2), np.zeros((2, 4, 3)))
+            self.assertEqual([band.tolist() for band in find_band_tiles(tiles * 2, 100, 32)], [[0], [0, 1], [0, 1], []])
+            paths = (os.path.join(folder, 'mosaic.png'), os.path.join(folder, 'color_mosaic.png'))
+            self.assertEqual(render_mosaic_bands(tiles, tile_colors, database, 2, folder, (200, 100), 32, *paths), 4)
+            for path, canvas in zip(paths, render_mosaic(tiles, tile_colors, database, 2, folder, (200, 100))):
+                with Image.open(path) as image:
+                    self.assertTrue(np.array_equal(np.asarray(image), np.asarray(canvas)))
+
+    def test_render_mosaic_bands_matches_full_render_on_penrose_tiles(self):
+        with tempfile.TemporaryDirectory() as folder:
+            database = create_color_database(folder)
+            tiles = normalize_and_scale_tiles(create_tiles(6, False), (390, 260))
+            colors = np.random.default_rng(0).integers(0, 255, (len(tiles), 3))
+            tile_colors = (colors, np.full(len(tiles), 100), np.zeros(len(tiles)), None)
+            # The slanted edges of the rhombi cross every band edge
+            paths = (os.path.join(folder, 'mosaic.png'), os.path.join(folder, 'color_mosaic.png'))
+            render_mosaic_bands(tiles, tile_colors, database, 1, folder, (390, 260), 20, *paths)
+            for path, canvas in zip(paths, render_mosaic(tiles, tile_colors, database, 1, folder, (390, 260))):
+                with Image.open(path) as image:
+                    self.assertTrue(np.array_equal(np.asarray(image), np.asarray(canvas)))
+
+    def test_threaded_render_matches_serial(self):
+        with tempfile.TemporaryDirectory() as folder:
+            rng = np.random.default_rng(0)
+            database = {}
+            for index in range(6):
+                name = f'{index}.png'
+                Image.fromarray(rng.integers(0, 255, (40, 50, 3), dtype=np.uint8)).save(os.path.join(folder, name))
+                database[name] = (index * 40, 255 - index * 40, 128, 0)
+            corners = (rng.random((30, 2)) * 80).view(np.complex128)
+            tiles = corners + np.array([0, 12 + 3j, 15 + 15j, 3 + 12j])
+            tile_colors = (rng.integers(0, 255, (30, 3)), np.full(30, 100), np.zeros(30), np.zeros((30, 4, 3)))
+            serial = render_mosaic(tiles, tile_colors, database, 2, folder, (200, 200), rng=np.random.default_rng(1))
+            threaded = render_mosaic(tiles, tile_colors, database, 2, folder, (200, 200), rng=np.random.default_rng(1), threads=3, queue_size=2)
+            for serial_canvas, threaded_canvas in zip(serial, threaded):
+                self.assertTrue(np.array_equal(np.asarray(serial_canvas), np.asarray(threaded_canvas)))
+            # The results come back in order whatever thread finishes first
+            self.assertEqual(list(iterate_threaded(lambda value: value * 2, list(range(20)), 4, 3)), list(range(0, 40, 2)))
+
+    def test_overlay_blend_matches_per_pixel_formula(self):
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 255, (6, 7, 3), dtype=np.uint8))
+        target, opacity = (200, 40, 128), 0.7
+        blended = np.asarray(overlay_blend(image, target, opacity))
+        for (y, x, channel), base in np.ndenumerate(np.asarray(image)):
+            base, blend = int(base), target[channel]
+            if base < 128:
+                expected = 2 * base * blend / 255
+            else:
+                expected = 255 - 2 * (255 - base) * (255 - blend) / 255
+            self.assertEqual(blended[y, x, channel], int(expected * opacity + base * (1 - opacity)))
+
+    def test_blend_modes(self):
+        base, blend = np.array([0, 64, 200, 255]), np.array([[100], [200]])
+        self.assertTrue(np.allclose(blend_channels(base, blend, 'multiply'), base * blend / 255))
+        self.assertTrue(np.allclose(blend_channels(base, blend, 'screen'), 255 - (255 - base) * (255 - blend) / 255))
+        # Hard light is overlay with the layers swapped
+        self.assertTrue(np.allclose(blend_channels(base, blend, 'hard_light'), blend_channels(blend, base, 'overlay')))
+        luts = create_blend_luts(np.array([[10, 20, 30], [200, 100, 0]]), np.array([0, 1]), 'multiply')
+        self.assertEqual(luts[0].tolist(), list(range(256)) * 3)
+        self.assertEqual(luts[1, 255], 200)
+        with self.assertRaises(ValueError):
+            blend_channels(base, blend, 'dodge')
+
+    def test_blend_opacities(self):
+        database = {'red.png': (250, 10, 10, 5000), 'blue.png': (10, 10, 250, 0)}
+        colors = (np.array([[250, 10, 10], [250, 10, 10]]),)
+        opacities = calculate_blend_opacities(database, ['red.png', 'blue.png'], np.array([0, 1]), colors, 1, 0.8)
+        self.assertTrue(np.allclose(opacities, [0.5, 0.8]))
+        self.assertTrue(np.all(calculate_blend_opacities(database, ['red.png', 'blue.png'], np.array([0, 1]), colors, 0, 0.8) == 0))
+
+    def test_render_mosaic_parallel_matches_serial(self):
+        with tempfile.TemporaryDirectory() as folder:
+            database = {f'{index}.png': (index * 20, 100, 250 - index * 20, 0) for index in range(10)}
+            for name, color in database.items():
+                Image.new('RGB', (64, 48), color[:3]).save(os.path.join(folder, name))
+            rng = np.random.default_rng(0)
+            # A grid of separate tiles, so the order they are pasted in does not matter
+            corners = (np.arange(40) % 10 * 19.5 + 1j * (np.arange(40) // 10 * 24.5 + 0.5))[:, None]
+            tiles = corners + np.array([0, 16, 16 + 20j, 20j])
+            tile_colors = (rng.integers(0, 255, (40, 3)), np.full(40, 144), np.zeros(40), np.zeros((40, 4, 3)))
+            serial = render_mosaic(tiles, tile_colors, database, 1, folder, (200, 100), rng=np.random.default_rng(1), blend_strength=1)
+            parallel = render_mosaic_parallel(tiles, tile_colors, database, 1, folder, (200, 100), 2, rng=np.random.default_rng(1), blend_strength=1)
+            for expected, canvas in zip(serial, parallel):
+                self.assertTrue(np.array_equal(np.asarray(canvas), np.asarray(expected)))
+            # Real rhombi, whose slanted edges cross the edges of the bands
+            tiles = normalize_and_scale_tiles(create_tiles(6, False), (390, 260))
+            tile_colors = (rng.integers(0, 255, (len(tiles), 3)), np.full(len(tiles), 144), np.zeros(len(tiles)), None)
+            serial = render_mosaic(tiles, tile_colors, database, 1, folder, (390, 260), rng=np.random.default_rng(1), supersample=2)
+            parallel = render_mosaic_parallel(tiles, tile_colors, database, 1, folder, (390, 260), 3, rng=np.random.default_rng(1), supersample=2)
+            self.assertTrue(np.array_equal(np.asarray(parallel[1]), np.asarray(serial[1])))
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()
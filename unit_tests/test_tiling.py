@@ -3,7 +3,7 @@ import unittest
 # import os
 # print("Current Working Directory:", os.getcwd())
 # print("Python Path:", sys.path)
-from ..penrose_tiling import * # python -m photomosaic.unit_tests.test_tiling
+from ..modules.create_tiles import * # python -m photomosaic.unit_tests.test_tiling
 class TestPenroseTilingFunctions(unittest.TestCase):
         
     def test_create_initial_triangles(self):
@@ -25,6 +25,30 @@ class TestPenroseTilingFunctions(unittest.TestCase):
 
         # Check if the actual count is within the margin of error of the formula count
         self.assertTrue(abs(len(divided_triangles) - formula_count) <= margin_of_error)
+
+    def test_divide_triangle_arrays_matches_reference(self):
+        base = 5
+        divisions = 5
+        phi = (5 ** 0.5 + 1) / 2
+        # Reference: divide the triangles one at a time
+        reference = create_initial_triangles(base)
+        for _ in range(divisions):
+            new_triangles = []
+            for shape, v1, v2, v3 in reference:
+                if shape == "thin":
+                    p1 = v1 + (v2 - v1) / phi
+                    new_triangles += [("thin", v3, p1, v2), ("thick", p1, v3, v1)]
+                else:
+                    p2 = v2 + (v1 - v2) / phi
+                    p3 = v2 + (v3 - v2) / phi
+                    new_triangles += [("thick", p3, v3, v1), ("thick", p2, p3, v2), ("thin", p3, p2, v1)]
+            reference = new_triangles
+        shapes, vertices = divide_triangle_arrays(*triangles_to_arrays(create_initial_triangles(base)), divisions, phi)
+        self.assertEqual(len(shapes), len(reference))
+        self.assertEqual([SHAPE_NAMES[shape] for shape in shapes], [shape for shape, *_ in reference])
+        for (_, *expected), actual in zip(reference, vertices):
+            for v_expected, v_actual in zip(expected, actual):
+                self.assertAlmostEqual(abs(v_expected - v_actual), 0, places=9)
         
     def test_pair_triangles_and_form_rhombi(self):
         base = 5
@@ -35,23 +59,65 @@ class TestPenroseTilingFunctions(unittest.TestCase):
         rhombi = pair_triangles_and_form_rhombi(divided_triangles)
         for rhombus in rhombi:
             self.assertEqual(len(rhombus), 4)
+
+    def test_pair_triangle_arrays_forms_rhombi(self):
+        base = 5
+        divisions = 4
+        phi = (5 ** 0.5 + 1) / 2
+        shapes, vertices = divide_triangle_arrays(*triangles_to_arrays(create_initial_triangles(base)), divisions, phi)
+        rhombi = pair_triangles_and_form_rhombi((shapes, vertices))
+        self.assertEqual(rhombi.shape, (160, 4))
+        # All four sides of a rhombus have the same length
+        sides = np.abs(rhombi - np.roll(rhombi, 1, axis=1))
+        self.assertTrue(np.allclose(sides, sides[:, :1], atol=1e-5))
             
     def test_normalize_and_scale_tiles(self):
         # Convert tuples to complex numbers
         rhombi = [(complex(0, 0), complex(1, 0), complex(1, 1), complex(0, 1))]  # A sample square rhombus
         canvas_size = (100, 100)
         scaled_tiles = normalize_and_scale_tiles(rhombi, canvas_size)
-        for tile in scaled_tiles:
-            # Check if the tile fits within the canvas
-            for i in range(0, len(tile), 2):
-                self.assertTrue(0 <= tile[i] <= canvas_size[0])
-                self.assertTrue(0 <= tile[i+1] <= canvas_size[1])
+        # Check if the tiles fit within the canvas
+        self.assertTrue(np.all((0 <= scaled_tiles.real) & (scaled_tiles.real <= canvas_size[0])))
+        self.assertTrue(np.all((0 <= scaled_tiles.imag) & (scaled_tiles.imag <= canvas_size[1])))
                                 
-    def test_find_long_side_and_hash_edge(self):
+    def test_create_tiles_for_canvas_covers_corners(self):
+        canvas_size = (300, 100)
+        tiles = create_tiles_for_canvas(5, canvas_size)
+        self.assertLessEqual(tiles.real.min(), 0)
+        self.assertLessEqual(tiles.imag.min(), 0)
+        self.assertGreaterEqual(tiles.real.max(), canvas_size[0])
+        self.assertGreaterEqual(tiles.imag.max(), canvas_size[1])
+        # Same tile size as the disk patch for the same number of divisions
+        disk_tiles = normalize_and_scale_tiles(create_tiles(5, False), canvas_size)
+        self.assertAlmostEqual(np.median(np.abs(tiles[:, 0] - tiles[:, 1])), np.median(np.abs(disk_tiles[:, 0] - disk_tiles[:, 1])), places=3)
+
+    def test_create_adaptive_tiles_follows_detail(self):
+        flat = Image.new('RGB', (200, 200), (120, 80, 40))
+        noise = Image.fromarray(np.random.default_rng(0).integers(0, 255, (200, 200, 3), dtype=np.uint8))
+        flat_tiles = create_adaptive_tiles(flat, 6, 3)
+        busy_tiles = create_adaptive_tiles(noise, 6, 3)
+        self.assertEqual(len(flat_tiles), len(create_tiles(3, False)))
+        self.assertEqual(len(busy_tiles), len(create_tiles(6, False)))
+
+    def test_create_adaptive_tiles_do_not_overlap(self):
+        # Flat on the left, noise on the right: the tiles change level along the middle
+        pixels = np.full((200, 200, 3), 100, dtype=np.uint8)
+        pixels[:, 100:] = np.random.default_rng(0).integers(0, 255, (200, 100, 3), dtype=np.uint8)
+        tiles = create_adaptive_tiles(Image.fromarray(pixels), 6, 3, cover_canvas=True)
+        # Some tiles are half rhombi that border a coarser tile
+        self.assertTrue(np.any(np.abs(tiles - np.roll(tiles, 1, axis=1)).min(axis=1) < 1e-9))
+        points = np.random.default_rng(1).uniform(0, 200, 2000) + 1j * np.random.default_rng(2).uniform(0, 200, 2000)
+        edges = np.roll(tiles, -1, axis=1) - tiles
+        cross = (np.conj(edges[None]) * (points[:, None, None] - tiles[None])).imag
+        inside = np.all(cross >= -1e-9, axis=2) | np.all(cross <= 1e-9, axis=2)
+        # Every point of the canvas is covered by exactly one tile
+        self.assertTrue(np.all(inside.sum(axis=1) == 1))
+
+    def test_find_join_side_and_hash_edge(self):
         v1, v2, v3 = complex(0, 0), complex(12, 0), complex(0, 1)
-        long_side = find_long_side(v1, v2, v3)
-        self.assertIn(complex(12, 0), long_side)
-        self.assertIn(complex(0, 1), long_side)
+        # 'thick' triangles join on their longest side, 'thin' ones on their shortest
+        self.assertEqual(set(find_join_side(v1, v2, v3, "thick")), {complex(12, 0), complex(0, 1)})
+        self.assertEqual(set(find_join_side(v1, v2, v3, "thin")), {complex(0, 0), complex(0, 1)})
         hash1 = hash_edge(v1, v2)
         hash2 = hash_edge(v2, v1)  # Should be the same as hash1
         self.assertEqual(hash1, hash2)
@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+import json, os, tempfile
+from unittest import mock
+from PIL import Image
+from ..modules.update_database import * # python -m photomosaic.unit_tests.test_update_database
+from ..modules import update_database
+from ..modules.pyramids import get_pyramid_path
+from ..modules.image_pool import ImagePool
+
+class TestUpdateDatabaseFunctions(unittest.TestCase):
+
+    def test_incremental_update_with_manifest(self):
+        with tempfile.TemporaryDirectory() as folder:
+            config = {'source_folder': os.path.join(folder, 'source'), 'image_folder': os.path.join(folder, 'images'), 'database_path': os.path.join(folder, 'database.json')}
+            os.mkdir(config['source_folder'])
+            os.mkdir(config['image_folder'])
+            source = lambda name: os.path.join(config['source_folder'], name)
+            copy = lambda name: os.path.join(config['image_folder'], name)
+            for index, name in enumerate(('a.png', 'b.png', 'c.png')):
+                Image.new('RGB', (32, 32), (index * 100, 0, 0)).save(source(name))
+            self.assertEqual(update_image_database(config), 3)
+            with open(get_manifest_path(config['database_path'])) as file:
+                self.assertEqual(json.load(file)['b.png']['hash'], hash_file(source('b.png')))
+            copy_modified = {name: os.stat(copy(name)).st_mtime_ns for name in ('a.png', 'b.png', 'c.png')}
+            database_modified = os.stat(config['database_path']).st_mtime_ns
+            # Nothing changed: no image is decoded and the database is not rewritten
+            update_image_database(config)
+            self.assertEqual(os.stat(config['database_path']).st_mtime_ns, database_modified)
+            # A touched image is hashed but not decoded again
+            os.utime(source('a.png'), ns=(0, 0))
+            update_image_database(config)
+            self.assertEqual(os.stat(copy('a.png')).st_mtime_ns, copy_modified['a.png'])
+            # A renamed image keeps its entry and its copy, an image modified in place is decoded again
+            os.rename(source('b.png'), source('renamed.png'))
+            Image.new('RGB', (32, 32), (0, 0, 250)).save(source('c.png'))
+            update_image_database(config)
+            with open(config['database_path']) as file:
+                database = json.load(file)
+            self.assertEqual(sorted(database), ['a.png', 'c.png', 'renamed.png'])
+            self.assertEqual(database['renamed.png'][0], 100)
+            self.assertEqual(database['c.png'][:3], [0, 0, 250])
+            self.assertEqual(sorted(os.listdir(config['image_folder'])), ['a.png', 'c.png', 'renamed.png'])
+            self.assertEqual(os.stat(copy('renamed.png')).st_mtime_ns, copy_modified['b.png'])
+            features = load_database_features(database, config['database_path'])
+            self.assertTrue(np.allclose(features['crop'][list(database).index('c.png')], (0, 0, 250)))
+
+    def test_unchanged_update_writes_nothing(self):
+        with tempfile.TemporaryDirectory() as folder:
+            config = {'source_folder': os.path.join(folder, 'source'), 'image_folder': os.path.join(folder, 'images'), 'database_path': os.path.join(folder, 'database.json'),
+                      'pyramid_folder': os.path.join(folder, 'pyramids'), 'image_pool': os.path.join(folder, 'pool.bin'), 'match_lut': True}
+            os.mkdir(config['source_folder'])
+            os.mkdir(config['image_folder'])
+            for index, name in enumerate(('a.png', 'b.png')):
+                Image.new('RGB', (32, 32), (index * 100, 0, 0)).save(os.path.join(config['source_folder'], name))
+            update_image_database(config)
+            generated = [os.path.join(root, name) for root, _, names in os.walk(folder) for name in names if not root.startswith(config['source_folder'])]
+            for path in generated:
+                os.utime(path, ns=(0, 0))
+            with mock.patch.object(update_database, 'update_pyramids') as pyramids, mock.patch.object(update_database, 'update_image_pool') as pool:
+                self.assertEqual(update_image_database(config), 2)
+            pyramids.assert_not_called()
+            pool.assert_not_called()
+            self.assertTrue(all(os.stat(path).st_mtime_ns == 0 for path in generated))
+            # A modified image only rebuilds its own pyramid and pool levels
+            Image.new('RGB', (32, 32), (0, 0, 250)).save(os.path.join(config['source_folder'], 'b.png'))
+            update_image_database(config)
+            self.assertEqual(os.stat(get_pyramid_path(config['pyramid_folder'], 'a.png')).st_mtime_ns, 0)
+            self.assertNotEqual(os.stat(get_pyramid_path(config['pyramid_folder'], 'b.png')).st_mtime_ns, 0)
+            self.assertTrue(np.all(ImagePool(config['image_pool']).get_level('b.png')[0] == (0, 0, 250)))
+
+# Run the tests
+if __name__ == '__main__':
+    unittest.main()